@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+# @Time    : 10/19/26 2:15 PM
+# @Author  : Ben Chou
+# @Affiliation  : Purdue University
+# @Email   : chou150@purdue.edu
+# @File    : ann_index.py
+
+# approximate nearest-neighbour search over cav-mae embeddings (e.g., the L2-normalized mean-pooled output of forward_feat)
+# IVF index: a k-means coarse quantizer splits the gallery into nlist inverted lists, a query only scans the nprobe closest lists
+# the vectors in the lists are stored in float16, or compressed with product quantization (PQ) of the residual to the list centroid
+# similarity is the inner product (cosine similarity for L2-normalized embeddings), runs on cpu with numpy / torch only
+
+import os
+import json
+import time
+import numpy as np
+import torch
+
+
+def kmeans(x, k, niter=20, seed=0, chunk_size=65536):
+    """
+    Spherical k-means (inner product assignment) on x [N, D], returns the L2-normalized centroids [k, D] as float32.
+    Empty clusters are re-seeded with random points.
+    """
+    x = torch.as_tensor(np.asarray(x), dtype=torch.float32)
+    g = torch.Generator().manual_seed(seed)
+    centroids = x[torch.randperm(x.shape[0], generator=g)[:k]].clone()
+    for it in range(niter):
+        assign = assign_nearest(x, centroids, chunk_size)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        counts = torch.bincount(assign, minlength=k)
+        empty = counts == 0
+        centroids = sums / counts.clamp(min=1)[:, None]
+        if empty.any():
+            centroids[empty] = x[torch.randint(x.shape[0], (int(empty.sum()),), generator=g)]
+        # unit norm, otherwise tight clusters get larger centroids and attract extra points under inner product assignment
+        centroids = torch.nn.functional.normalize(centroids, dim=1)
+    return centroids
+
+
+def assign_nearest(x, centroids, chunk_size=65536, l2=False):
+    # index of the closest centroid of each row of x, by inner product or by L2 distance
+    assign = []
+    bias = -0.5 * (centroids ** 2).sum(1) if l2 else 0
+    for start in range(0, x.shape[0], chunk_size):
+        assign.append((x[start : start + chunk_size] @ centroids.t() + bias).argmax(1))
+    return torch.cat(assign)
+
+
+class IVFIndex(object):
+    def __init__(self, nlist=1024, pq_m=0, pq_ksub=256, niter=20, seed=0):
+        """
+        :param nlist: number of inverted lists (k-means clusters)
+        :param pq_m: number of PQ sub-vectors, 0 means storing the full vectors in float16
+        :param pq_ksub: number of centroids of each PQ sub-quantizer (at most 256, codes are uint8)
+        """
+        self.nlist = nlist
+        self.pq_m = pq_m
+        self.pq_ksub = pq_ksub
+        self.niter = niter
+        self.seed = seed
+        self.centroids = None
+        self.pq_codebooks = None
+        # pq residuals are taken to residual_scale[list] * centroid, the projection of the list mean on its unit centroid
+        self.residual_scale = None
+        self.list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.data = None
+        # (assign, data, ids) of the added batches not yet merged into the lists
+        self.pending = []
+
+    def train(self, x):
+        x = torch.as_tensor(np.asarray(x), dtype=torch.float32)
+        print("train ivf coarse quantizer with {:d} lists on {:d} vectors".format(self.nlist, x.shape[0]))
+        self.centroids = kmeans(x, self.nlist, self.niter, self.seed)
+        if self.pq_m > 0:
+            dim = x.shape[1]
+            assert dim % self.pq_m == 0, "the embedding dimension must be divisible by pq_m"
+            assign = assign_nearest(x, self.centroids)
+            proj = (x * self.centroids[assign]).sum(1)
+            self.residual_scale = torch.zeros(self.nlist).index_add_(0, assign, proj) / torch.bincount(
+                assign, minlength=self.nlist
+            ).clamp(min=1)
+            residual = x - self.residual_scale[assign, None] * self.centroids[assign]
+            sub_dim = dim // self.pq_m
+            print("train pq with {:d} sub-quantizers of {:d} centroids".format(self.pq_m, self.pq_ksub))
+            # residuals are not normalized, the sub-quantizers use L2 k-means
+            self.pq_codebooks = torch.stack(
+                [
+                    self._kmeans_l2(residual[:, j * sub_dim : (j + 1) * sub_dim], self.pq_ksub, self.seed + j + 1)
+                    for j in range(self.pq_m)
+                ]
+            )
+
+    def _kmeans_l2(self, x, k, seed):
+        g = torch.Generator().manual_seed(seed)
+        centroids = x[torch.randperm(x.shape[0], generator=g)[:k]].clone()
+        for it in range(self.niter):
+            assign = assign_nearest(x, centroids, l2=True)
+            sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+            counts = torch.bincount(assign, minlength=k)
+            centroids = torch.where((counts > 0)[:, None], sums / counts.clamp(min=1)[:, None], centroids)
+        return centroids
+
+    def encode(self, x, assign):
+        # uint8 PQ codes [N, pq_m] of the residual of x to its list centroid
+        residual = x - self.residual_scale[assign, None] * self.centroids[assign]
+        sub_dim = x.shape[1] // self.pq_m
+        codes = [
+            assign_nearest(residual[:, j * sub_dim : (j + 1) * sub_dim], self.pq_codebooks[j], l2=True)
+            for j in range(self.pq_m)
+        ]
+        return torch.stack(codes, 1).to(torch.uint8)
+
+    def add(self, x, ids=None):
+        """
+        Add vectors x [N, D] (with int64 ids, default 0..N-1 continuing from the current size).
+        The batches are buffered and merged into the contiguous lists before the next search or save, so adding in many
+        batches sorts the index once.
+        """
+        x = torch.as_tensor(np.asarray(x), dtype=torch.float32)
+        if ids is None:
+            size = len(self.ids) + sum(len(p[2]) for p in self.pending)
+            ids = np.arange(size, size + x.shape[0], dtype=np.int64)
+        assign = assign_nearest(x, self.centroids)
+        data = self.encode(x, assign).numpy() if self.pq_m > 0 else x.numpy().astype(np.float16)
+        self.pending.append((assign.numpy(), data, np.asarray(ids, dtype=np.int64)))
+
+    def merge_pending(self):
+        # merge the added batches with the existing lists, sorted by list id
+        if len(self.pending) == 0:
+            return
+        old_assign = np.repeat(np.arange(self.nlist), np.diff(self.list_offsets))
+        all_assign = np.concatenate([old_assign] + [p[0] for p in self.pending])
+        order = np.argsort(all_assign, kind="stable")
+        data = [p[1] for p in self.pending] if self.data is None else [np.asarray(self.data)] + [p[1] for p in self.pending]
+        self.data = np.concatenate(data)[order]
+        self.ids = np.concatenate([np.asarray(self.ids)] + [p[2] for p in self.pending])[order]
+        self.list_offsets = np.r_[0, np.cumsum(np.bincount(all_assign, minlength=self.nlist))].astype(np.int64)
+        self.pending = []
+
+    def search(self, q, k=10, nprobe=16):
+        """
+        Batched search, returns (scores [Q, k], ids [Q, k]) sorted by decreasing inner product, padded with -inf / -1.
+        Queries are grouped by probed list, so each list is read once per batch.
+        """
+        self.merge_pending()
+        q = torch.as_tensor(np.asarray(q), dtype=torch.float32)
+        nq = q.shape[0]
+        nprobe = min(nprobe, self.nlist)
+        coarse = q @ self.centroids.t()
+        probe_scores, probes = coarse.topk(nprobe, dim=1)
+        if self.pq_m > 0:
+            # lookup table of the inner product of each query sub-vector with each sub-centroid [Q, pq_m, ksub]
+            sub_dim = q.shape[1] // self.pq_m
+            lut = torch.einsum("qmd,mkd->qmk", q.view(nq, self.pq_m, sub_dim), self.pq_codebooks)
+
+        cand_scores = torch.full((nq, nprobe, k), -float("inf"))
+        cand_ids = torch.full((nq, nprobe, k), -1, dtype=torch.long)
+        flat_probes = probes.reshape(-1)
+        order = torch.argsort(flat_probes)
+        list_ids, counts = torch.unique_consecutive(flat_probes[order], return_counts=True)
+        start = 0
+        for list_id, count in zip(list_ids.tolist(), counts.tolist()):
+            pairs = order[start : start + count]
+            start += count
+            begin, end = self.list_offsets[list_id], self.list_offsets[list_id + 1]
+            if end == begin:
+                continue
+            query_idx, slot = pairs // nprobe, pairs % nprobe
+            if self.pq_m > 0:
+                codes = torch.from_numpy(np.array(self.data[begin:end])).long()
+                sub_lut = lut[query_idx]
+                # inner product with the scaled list centroid plus the sum of the sub-vector lookups
+                scores = (self.residual_scale[list_id] * probe_scores[query_idx, slot])[:, None].repeat(1, end - begin)
+                for j in range(self.pq_m):
+                    scores += sub_lut[:, j, codes[:, j]]
+            else:
+                vectors = torch.from_numpy(np.asarray(self.data[begin:end], dtype=np.float32))
+                scores = q[query_idx] @ vectors.t()
+            top = min(k, end - begin)
+            top_scores, top_idx = scores.topk(top, dim=1)
+            cand_scores[query_idx, slot, :top] = top_scores
+            cand_ids[query_idx, slot, :top] = torch.from_numpy(np.array(self.ids[begin:end]))[top_idx]
+
+        scores, idx = cand_scores.view(nq, -1).topk(k, dim=1)
+        return scores.numpy(), cand_ids.view(nq, -1).gather(1, idx).numpy()
+
+    def save(self, path):
+        self.merge_pending()
+        os.makedirs(path, exist_ok=True)
+        meta = {"nlist": self.nlist, "pq_m": self.pq_m, "pq_ksub": self.pq_ksub, "niter": self.niter, "seed": self.seed}
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+        np.save(os.path.join(path, "centroids.npy"), self.centroids.numpy())
+        np.save(os.path.join(path, "list_offsets.npy"), self.list_offsets)
+        np.save(os.path.join(path, "ids.npy"), np.asarray(self.ids))
+        np.save(os.path.join(path, "data.npy"), np.asarray(self.data))
+        if self.pq_m > 0:
+            np.save(os.path.join(path, "pq_codebooks.npy"), self.pq_codebooks.numpy())
+            np.save(os.path.join(path, "residual_scale.npy"), self.residual_scale.numpy())
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        # the stored vectors / codes and ids are memory-mapped, only the lists scanned by a query are read from disk
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        index = cls(**meta)
+        mmap_mode = "r" if mmap else None
+        index.centroids = torch.from_numpy(np.load(os.path.join(path, "centroids.npy")))
+        index.list_offsets = np.load(os.path.join(path, "list_offsets.npy"))
+        index.ids = np.load(os.path.join(path, "ids.npy"), mmap_mode=mmap_mode)
+        index.data = np.load(os.path.join(path, "data.npy"), mmap_mode=mmap_mode)
+        if index.pq_m > 0:
+            index.pq_codebooks = torch.from_numpy(np.load(os.path.join(path, "pq_codebooks.npy")))
+            index.residual_scale = torch.from_numpy(np.load(os.path.join(path, "residual_scale.npy")))
+        return index
+
+
+def exact_search(q, x, k=10, chunk_size=1024):
+    # brute force inner product search, same similarity as retrieval.py
+    q = torch.as_tensor(np.asarray(q), dtype=torch.float32)
+    x = torch.as_tensor(np.asarray(x), dtype=torch.float32)
+    scores, ids = [], []
+    for start in range(0, q.shape[0], chunk_size):
+        s, i = (q[start : start + chunk_size] @ x.t()).topk(k, dim=1)
+        scores.append(s)
+        ids.append(i)
+    return torch.cat(scores).numpy(), torch.cat(ids).numpy()
+
+
+def benchmark(index, q, x, k=10, nprobes=(1, 4, 16, 64), gt_ids=None, batch_size=1024):
+    """
+    Recall of the exact top-k (and R@1/5/10 of the ground truth pair gt_ids if given) vs. query latency for each nprobe.
+    """
+    begin = time.time()
+    exact_ids = exact_search(q, x, k)[1]
+    exact_time = (time.time() - begin) / len(q)
+    print("exact search: {:.3f} ms per query".format(exact_time * 1000))
+    results = []
+    for nprobe in nprobes:
+        begin = time.time()
+        ann_ids = np.concatenate(
+            [index.search(q[start : start + batch_size], k, nprobe)[1] for start in range(0, len(q), batch_size)]
+        )
+        latency = (time.time() - begin) / len(q)
+        recall = np.mean([len(np.intersect1d(a, e)) / float(k) for a, e in zip(ann_ids, exact_ids)])
+        result = {"nprobe": nprobe, "recall@{:d}".format(k): recall, "ms_per_query": latency * 1000}
+        if gt_ids is not None:
+            hit = ann_ids == np.asarray(gt_ids)[:, None]
+            for r in [1, 5, 10]:
+                result["R{:d}".format(r)] = float(hit[:, :r].any(1).mean())
+        print(result)
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--gallery", type=str, default=None, help="gallery embeddings [N, D] .npy (e.g., visual), None uses random data")
+    parser.add_argument("--query", type=str, default=None, help="query embeddings [N, D] .npy (e.g., audio), query i pairs with gallery i")
+    parser.add_argument("--num_samples", type=int, default=100000, help="number of random samples if no embedding is given")
+    parser.add_argument("--nlist", type=int, default=1024, help="number of inverted lists")
+    parser.add_argument("--pq_m", type=int, default=0, help="number of pq sub-vectors, 0 means float16 vectors")
+    parser.add_argument("--nprobe", type=str, default="1,4,16,64", help="nprobe values to benchmark")
+    parser.add_argument("--k", type=int, default=10, help="number of neighbours")
+    parser.add_argument("--num_queries", type=int, default=2000, help="number of benchmarked queries")
+    parser.add_argument("--index_dir", type=str, default=None, help="save the index to and load it (memory-mapped) from this directory")
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    if args.gallery != None:
+        x = np.load(args.gallery, mmap_mode="r").astype(np.float32)
+        q = np.load(args.query, mmap_mode="r")[: args.num_queries].astype(np.float32)
+    else:
+        # paired random embeddings around 1000 cluster centers, the query is a noisy copy of its gallery item
+        rng = np.random.default_rng(0)
+        centers = rng.standard_normal((1000, 768)).astype(np.float32)
+        x = centers[rng.integers(0, 1000, args.num_samples)]
+        x = x + 0.7 * rng.standard_normal(x.shape).astype(np.float32)
+        q = x[: args.num_queries] + 0.7 * rng.standard_normal((args.num_queries, 768)).astype(np.float32)
+    x /= np.linalg.norm(x, axis=1, keepdims=True)
+    q /= np.linalg.norm(q, axis=1, keepdims=True)
+
+    index = IVFIndex(nlist=args.nlist, pq_m=args.pq_m)
+    begin = time.time()
+    index.train(x[np.random.default_rng(0).permutation(len(x))[: max(50 * args.nlist, 10000)]])
+    index.add(x)
+    print("index built in {:.1f} seconds".format(time.time() - begin))
+    if args.index_dir != None:
+        index.save(args.index_dir)
+        index = IVFIndex.load(args.index_dir)
+    benchmark(index, q, x, args.k, [int(n) for n in args.nprobe.split(",")], gt_ids=np.arange(len(q)))
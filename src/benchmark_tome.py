@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# @Time    : 10/19/26 6:40 PM
+# @Author  : Ben Chou
+# @Affiliation  : Purdue University
+# @Email   : chou150@purdue.edu
+# @File    : benchmark_tome.py
+
+# accuracy vs latency of token merging (see models/tome.py) for a finetuned CAVMAEFT or CAVMAEFTAudio.
+# the eval set is preprocessed once and saved (--eval_set), so every setting and every run sees the same inputs
+# and the latency does not include data loading. each --tome_r setting is evaluated on the whole eval set,
+# reports mAP / acc, the agreement with the predictions without merging, and the model latency per clip.
+
+import argparse
+import json
+import os
+import time
+import numpy as np
+import torch
+from models.audio_mdl import CAVMAEFTAudio
+from model_loader import add_model_args, load_model
+from utilities import calculate_stats
+
+def build_eval_set(args):
+    # the first num_samples samples of the data json in eval mode (no augmentation, fixed frame)
+    import dataloader
+    audio_conf = {'num_mel_bins': 128, 'target_length': args.target_length, 'freqm': 0, 'timem': 0, 'mixup': 0, 'dataset': args.dataset,
+                  'mode': 'eval', 'mean': args.dataset_mean, 'std': args.dataset_std, 'noise': False, 'im_res': 224, 'frame_use': args.frame_use}
+    dataset = dataloader.AudiosetDataset(args.data, label_csv=args.label_csv, audio_conf=audio_conf)
+    num_samples = min(args.num_samples, len(dataset)) if args.num_samples > 0 else len(dataset)
+    loader = torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, range(num_samples)), batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+    a, v, labels = [], [], []
+    for a_input, v_input, label in loader:
+        a.append(a_input)
+        v.append(v_input)
+        labels.append(label)
+    eval_set = {'a': torch.cat(a), 'v': torch.cat(v), 'labels': torch.cat(labels)}
+    torch.save(eval_set, args.eval_set)
+    print('saved {:d} samples to {:s}'.format(num_samples, args.eval_set))
+    return eval_set
+
+def predict(audio_model, eval_set, args, tome_r):
+    # returns the predictions [N, n_class] and the model time of each batch
+    audio_model.tome_r = tome_r
+    output, batch_time = [], []
+    with torch.no_grad():
+        for i in range(0, eval_set['a'].shape[0], args.batch_size):
+            a = eval_set['a'][i:i + args.batch_size]
+            v = eval_set['v'][i:i + args.batch_size]
+            begin_time = time.time()
+            if isinstance(audio_model, CAVMAEFTAudio):
+                logits = audio_model.forward_pred(a, v)
+            else:
+                logits = audio_model(a, v, args.ftmode)
+            batch_time.append(time.time() - begin_time)
+            output.append(logits.float())
+    audio_model.tome_r = None
+    output = torch.cat(output)
+    output = torch.softmax(output, dim=-1) if args.loss == 'CE' else torch.sigmoid(output)
+    return output, batch_time
+
+def benchmark(audio_model, eval_set, args):
+    target = eval_set['labels'].numpy()
+    num_samples = target.shape[0]
+    # warm up, not timed
+    predict(audio_model, {k: x[:args.batch_size] for k, x in eval_set.items()}, args, None)
+
+    base_output, res = None, []
+    for tome_r in [None] + args.tome_r:
+        output, batch_time = predict(audio_model, eval_set, args, tome_r)
+        if base_output is None:
+            base_output = output
+        stats = calculate_stats(output.numpy(), target)
+        latency = 1000 * np.sum(batch_time) / num_samples
+        res.append({'tome_r': 'none' if tome_r is None else tome_r,
+                    'mAP': float(np.mean([stat['AP'] for stat in stats])),
+                    'acc': float(stats[0]['acc']),
+                    'top1_agreement': float((output.argmax(dim=-1) == base_output.argmax(dim=-1)).float().mean()),
+                    'max_prob_diff': float((output - base_output).abs().max()),
+                    'ms_per_clip': float(latency),
+                    'speedup': float(res[0]['ms_per_clip'] / latency) if len(res) > 0 else 1.0})
+        print('tome r {:s}: mAP {:.4f}, acc {:.4f}, top-1 agreement {:.4f}, max prob diff {:.4f}, {:.2f} ms per clip, {:.2f}x'.format(
+            str(res[-1]['tome_r']), res[-1]['mAP'], res[-1]['acc'], res[-1]['top1_agreement'], res[-1]['max_prob_diff'], res[-1]['ms_per_clip'], res[-1]['speedup']))
+    return res
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_model_args(parser)
+    parser.add_argument("--ftmode", type=str, default='multimodal', help="the CAVMAEFT mode")
+    parser.add_argument("--loss", type=str, default="BCE", help="the loss the model is finetuned with, sigmoid for BCE, softmax for CE", choices=["BCE", "CE"])
+    parser.add_argument("--eval_set", type=str, required=True, help="the saved eval set (.pt), built from --data if it does not exist")
+    parser.add_argument("--data", type=str, default=None, help="the data json the eval set is built from")
+    parser.add_argument("--label_csv", type=str, default='', help="csv with class labels")
+    parser.add_argument("--dataset", type=str, default="audioset", help="the dataset used")
+    parser.add_argument("--dataset_mean", type=float, default=-5.081, help="the dataset mean, used for input normalization")
+    parser.add_argument("--dataset_std", type=float, default=4.4849, help="the dataset std, used for input normalization")
+    parser.add_argument("--frame_use", type=int, default=5, help="the video frame of the eval set")
+    parser.add_argument("--num_samples", type=int, default=2000, help="number of samples of the eval set, 0 for all")
+    parser.add_argument("--tome_r", type=str, nargs='+', default=['4', '8', '16', '24'], help="token merging settings to compare, each an int or a comma separated list with one value per layer")
+    parser.add_argument('-b', '--batch_size', default=16, type=int, metavar='N', help='mini-batch size')
+    parser.add_argument('-w', '--num_workers', default=8, type=int, metavar='NW', help='# of data loading workers when building the eval set')
+    parser.add_argument("--num_threads", type=int, default=0, help="torch intra-op threads, 0 to keep the default")
+    parser.add_argument("--output", type=str, default='./tome_benchmark.json', help="where the results are saved")
+    args = parser.parse_args()
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    if os.path.exists(args.eval_set):
+        eval_set = torch.load(args.eval_set)
+    else:
+        eval_set = build_eval_set(args)
+    audio_model = load_model(args)[0]
+    print('benchmark on cpu with {:d} threads, {:d} samples, batch size {:d}'.format(torch.get_num_threads(), eval_set['a'].shape[0], args.batch_size))
+    res = benchmark(audio_model, eval_set, args)
+    with open(args.output, 'w') as f:
+        json.dump(res, f, indent=2)
@@ -63,6 +63,36 @@ def preemphasis(signal, coeff=0.97):
     return np.append(signal[0], signal[1:] - coeff * signal[:-1])
 
 
+def wav2fbank(waveform, sr, melbins=128):
+    """
+    The un-padded fbank [n_frames, melbins] of a waveform, same as AudiosetDataset._wav2fbank without mixup.
+    Used by the inference scripts (inference_server.py, long_form.py).
+    """
+    waveform = waveform - waveform.mean()
+    fbank = torchaudio.compliance.kaldi.fbank(
+        waveform,
+        htk_compat=True,
+        sample_frequency=sr,
+        use_energy=False,
+        window_type="hanning",
+        num_mel_bins=melbins,
+        dither=0.0,
+        frame_shift=10,
+    )
+    return fbank
+
+
+def pad_or_truncate(fbank, target_length):
+    # zero pad or cut the fbank to target_length frames, before normalization as in AudiosetDataset
+    p = target_length - fbank.shape[0]
+    if p > 0:
+        m = torch.nn.ZeroPad2d((0, 0, 0, p))
+        fbank = m(fbank)
+    elif p < 0:
+        fbank = fbank[0:target_length, :]
+    return fbank
+
+
 class AudiosetDataset(Dataset):
     def __init__(self, dataset_json_file, audio_conf, label_csv=None):
         """
@@ -141,6 +171,10 @@ class AudiosetDataset(Dataset):
                 self.frame_use, self.total_frame
             )
         )
+        # multi-frame evaluation, return all frames of a clip [total_frame, 3, im_res, im_res] (eval mode only, no mixup)
+        self.multi_frame = self.audio_conf.get("multi_frame", False)
+        if self.multi_frame == True:
+            print("now return all {:d} frames of each clip".format(self.total_frame))
 
         # by default, all models use 224*224, other resolutions are not tested
         self.im_res = self.audio_conf.get("im_res", 224)
@@ -248,15 +282,17 @@ class AudiosetDataset(Dataset):
 
         return fbank
 
-    def randselect_img(self, video_id, video_path):
-        if self.mode == "eval":
-            # if not specified, use the middle frame
-            if self.frame_use == -1:
-                frame_idx = int((self.total_frame) / 2)
+    def randselect_img(self, video_id, video_path, frame_idx=None):
+        # frame_idx is given for multi-frame evaluation, otherwise it is picked by the mode
+        if frame_idx == None:
+            if self.mode == "eval":
+                # if not specified, use the middle frame
+                if self.frame_use == -1:
+                    frame_idx = int((self.total_frame) / 2)
+                else:
+                    frame_idx = self.frame_use
             else:
-                frame_idx = self.frame_use
-        else:
-            frame_idx = random.randint(0, 9)
+                frame_idx = random.randint(0, 9)
 
         while (
             os.path.exists(
@@ -328,13 +364,28 @@ class AudiosetDataset(Dataset):
             except:
                 fbank = torch.zeros([self.target_length, 128]) + 0.01
                 print("there is an error in loading audio")
-            try:
-                image = self.get_image(
-                    self.randselect_img(datum["video_id"], datum["video_path"]), None, 0
-                )
-            except:
-                image = torch.zeros([3, self.im_res, self.im_res]) + 0.01
-                print("there is an error in loading image")
+            if self.multi_frame == True:
+                # an unreadable frame is filled on its own, the other frames of the clip are kept
+                image = []
+                for frame_idx in range(self.total_frame):
+                    try:
+                        image.append(
+                            self.get_image(
+                                self.randselect_img(datum["video_id"], datum["video_path"], frame_idx), None, 0
+                            )
+                        )
+                    except:
+                        image.append(torch.zeros([3, self.im_res, self.im_res]) + 0.01)
+                        print("there is an error in loading image")
+                image = torch.stack(image)
+            else:
+                try:
+                    image = self.get_image(
+                        self.randselect_img(datum["video_id"], datum["video_path"]), None, 0
+                    )
+                except:
+                    image = torch.zeros([3, self.im_res, self.im_res]) + 0.01
+                    print("there is an error in loading image")
             for label_str in datum["labels"].split(","):
                 label_indices[int(self.index_dict[label_str])] = 1.0 - self.label_smooth
             label_indices = torch.FloatTensor(label_indices)
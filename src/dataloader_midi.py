@@ -24,6 +24,16 @@ from PIL import Image
 import PIL
 
 
+# a missing input (e.g., audioset has no midi, cocochorals has no video) is filled with this value,
+# the model detects absent modalities by it (see CAVMAE.get_valid_samples_mask in models/cav_mae_with_midi.py), with
+# skip_missing in the audio_conf it is kept through normalization
+MISSING_FILL = 0.01
+
+
+def is_missing(x, tolerance=1e-6):
+    return bool(torch.all(torch.abs(x - MISSING_FILL) < tolerance))
+
+
 def make_index_dict(label_csv):
     index_lookup = {}
     with open(label_csv, "r") as f:
@@ -127,6 +137,9 @@ class AudiosetDataset(Dataset):
         print("number of classes is {:d}".format(self.label_num))
 
         self.target_length = self.audio_conf.get("target_length")
+        # restore the fill value of missing inputs after normalization, SpecAug and noise, so the model can detect and skip
+        # them (CAVMAE skip_missing), False keeps the old data, where the fill value is normalized like any input
+        self.skip_missing = self.audio_conf.get("skip_missing", False)
 
         # train or eval
         self.mode = self.audio_conf.get("mode")
@@ -233,7 +246,9 @@ class AudiosetDataset(Dataset):
                 frame_shift=10,
             )
         except:
-            fbank = torch.zeros([512, 128]) + 0.01
+            # with skip_missing the full target length, so the fill value is not padded with zeros
+            fill_length = self.target_length if self.skip_missing else 512
+            fbank = torch.zeros([fill_length, 128]) + MISSING_FILL
             print("there is a loading error")
 
         target_length = self.target_length
@@ -346,6 +361,12 @@ class AudiosetDataset(Dataset):
                 label_indices[int(self.index_dict[label_str])] = 1.0 - self.label_smooth
             label_indices = torch.FloatTensor(label_indices)
 
+        # record the missing modalities before SpecAug, normalization and noise change the fill value
+        if self.skip_missing:
+            missing_a1, missing_a2, missing_v = is_missing(fbank1), is_missing(fbank2), is_missing(image)
+        else:
+            missing_a1, missing_a2, missing_v = False, False, False
+
         # SpecAug, not do for eval set
         freqm = torchaudio.transforms.FrequencyMasking(self.freqm)
         timem = torchaudio.transforms.TimeMasking(self.timem)
@@ -396,6 +417,14 @@ class AudiosetDataset(Dataset):
                 fbank2, np.random.randint(-self.target_length, self.target_length), 0
             )
 
+        # restore the fill value of the missing modalities so the model can skip them
+        if missing_a1:
+            fbank1 = torch.zeros_like(fbank1) + MISSING_FILL
+        if missing_a2:
+            fbank2 = torch.zeros_like(fbank2) + MISSING_FILL
+        if missing_v:
+            image = torch.zeros_like(image) + MISSING_FILL
+
         # fbank shape is [time_frame_num, frequency_bins], e.g., [1024, 128]
         return fbank1, fbank2, image, label_indices
 
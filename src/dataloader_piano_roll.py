@@ -17,7 +17,7 @@ import torchaudio
 import numpy as np
 import torch
 import torch.nn.functional
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import random
 import torchvision.transforms as T
 from PIL import Image
@@ -26,6 +26,16 @@ import pretty_midi
 import music21
 
 
+# a missing input (e.g., audioset has no midi, cocochorals has no video) is filled with this value,
+# the model detects absent modalities by it (see CAVMAE.get_valid_samples_mask in models/cav_mae_with_midi.py), with
+# skip_missing in the audio_conf it is kept through normalization
+MISSING_FILL = 0.01
+
+
+def is_missing(x, tolerance=1e-6):
+    return bool(torch.all(torch.abs(x - MISSING_FILL) < tolerance))
+
+
 def make_index_dict(label_csv):
     index_lookup = {}
     with open(label_csv, "r") as f:
@@ -129,6 +139,9 @@ class AudiosetDataset(Dataset):
         print("number of classes is {:d}".format(self.label_num))
 
         self.target_length = self.audio_conf.get("target_length")
+        # restore the fill value of missing inputs after normalization, SpecAug and noise, so the model can detect and skip
+        # them (CAVMAE skip_missing), False keeps the old data, where the fill value is normalized like any input
+        self.skip_missing = self.audio_conf.get("skip_missing", False)
 
         # train or eval
         self.mode = self.audio_conf.get("mode")
@@ -160,6 +173,24 @@ class AudiosetDataset(Dataset):
             ]
         )
 
+    def set_input_size(self, target_length, im_res):
+        # used by the progressive pretraining schedule, takes effect when the dataloader starts its next epoch
+        # (the worker processes get a new copy of the dataset every epoch unless persistent_workers is set)
+        self.target_length = target_length
+        self.im_res = im_res
+        self.preprocess = T.Compose(
+            [
+                T.Resize(self.im_res, interpolation=PIL.Image.BICUBIC),
+                T.CenterCrop(self.im_res),
+                T.ToTensor(),
+                T.Normalize(
+                    # image normalization stats
+                    mean=[0.4850, 0.4560, 0.4060],
+                    std=[0.2290, 0.2240, 0.2250],
+                ),
+            ]
+        )
+
     # change python list to numpy array to avoid memory leak. pro -> process
     def process_data(self, data_json):
         for i in range(len(data_json)):
@@ -237,7 +268,9 @@ class AudiosetDataset(Dataset):
                 frame_shift=10,
             )
         except:
-            fbank = torch.zeros([1024, 128]) + 0.01
+            # with skip_missing the full target length, so the fill value is not padded with zeros
+            fill_length = self.target_length if self.skip_missing else 1024
+            fbank = torch.zeros([fill_length, 128]) + MISSING_FILL
             print("there is a loading error")
 
         target_length = self.target_length
@@ -273,7 +306,9 @@ class AudiosetDataset(Dataset):
             pianoroll = pianoroll.T
             pianoroll = torch.from_numpy(pianoroll).float()
         except:
-            pianoroll = torch.zeros([1024, 128]) + 0.01  # NOTE: this was 512 before
+            # NOTE: this was 512 before, with skip_missing the full target length so the fill value is not padded with zeros
+            fill_length = self.target_length if self.skip_missing else 1024
+            pianoroll = torch.zeros([fill_length, 128]) + MISSING_FILL
 
         target_length = self.target_length
         n_frames = pianoroll.shape[0]
@@ -414,6 +449,12 @@ class AudiosetDataset(Dataset):
                 label_indices[int(self.index_dict[label_str])] = 1.0 - self.label_smooth
             label_indices = torch.FloatTensor(label_indices)
 
+        # record the missing modalities before SpecAug, normalization and noise change the fill value
+        if self.skip_missing:
+            missing_a1, missing_a2, missing_v = is_missing(fbank1), is_missing(piano_roll), is_missing(image)
+        else:
+            missing_a1, missing_a2, missing_v = False, False, False
+
         # SpecAug, not do for eval set
         freqm = torchaudio.transforms.FrequencyMasking(self.freqm)
         timem = torchaudio.transforms.TimeMasking(self.timem)
@@ -466,8 +507,251 @@ class AudiosetDataset(Dataset):
         #         fbank2, np.random.randint(-self.target_length, self.target_length), 0
         #     )
 
+        # restore the fill value of the missing modalities so the model can skip them
+        if missing_a1:
+            fbank1 = torch.zeros_like(fbank1) + MISSING_FILL
+        if missing_a2:
+            piano_roll = torch.zeros_like(piano_roll) + MISSING_FILL
+        if missing_v:
+            image = torch.zeros_like(image) + MISSING_FILL
+
         # fbank shape is [time_frame_num, frequency_bins], e.g., [1024, 128]
         return fbank1, piano_roll, image, label_indices
 
     def __len__(self):
         return self.num_samples
+
+
+# values that mark a missing file in the json, e.g., audioset has no midi and cocochorals has no video
+MISSING_PATHS = ("", "none", "null", "nan")
+
+
+def has_file(path):
+    return str(path).strip().lower() not in MISSING_PATHS and os.path.exists(path)
+
+
+def has_video_frames(video_id, video_path, total_frame=10):
+    # the same frame paths as randselect_img, which falls back to lower frames, so any existing frame means the sample has video
+    return any(
+        os.path.exists(video_path + "/frame_" + str(frame_idx) + "/" + video_id + ".jpg")
+        for frame_idx in range(total_frame)
+    )
+
+
+def get_modality_group(datum, total_frame=10):
+    """
+    Which modalities a sample has, decided as the dataset loads them, i.e., from whether the files exist.
+    The json fields alone are not enough, e.g., create_json_as.py writes the same video base path for every entry.
+    a: audio (wav1), m: midi (wav2), v: video (frame_*/<video_id>.jpg under video_path)
+    e.g., audioset samples are 'av', cocochorals samples are 'am'
+    """
+    group = ""
+    if has_file(datum["wav1"]):
+        group += "a"
+    if has_file(datum["wav2"]):
+        group += "m"
+    if str(datum["video_path"]).strip().lower() not in MISSING_PATHS and has_video_frames(
+        datum["video_id"], datum["video_path"], total_frame
+    ):
+        group += "v"
+    return group
+
+
+def get_modality_groups_key(dataset_json_file, total_frame=10):
+    # the cache is valid for the same json (path, size, modification time) and the same number of frames
+    stat = os.stat(dataset_json_file)
+    return {
+        "json": os.path.abspath(dataset_json_file),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "total_frame": total_frame,
+    }
+
+
+def get_modality_groups(dataset, dataset_json_file, cache_path=None, compute=True):
+    """
+    The modality group of every sample of the dataset (see get_modality_group), as a list in the order of dataset.data.
+    Checking the files takes up to total_frame + 2 stat calls per sample, so the groups are cached to cache_path
+    (default: <json>_modality_groups.json next to the json, as the *_weight.csv sample weights), keyed by the json.
+    With several processes only one process should compute and write the cache (compute=True) while the others wait and
+    read it (compute=False), a missing or stale cache then raises an error instead of checking the files again.
+    """
+    if cache_path is None:
+        cache_path = dataset_json_file[:-5] + "_modality_groups.json"
+    total_frame = getattr(dataset, "total_frame", 10)
+    key = get_modality_groups_key(dataset_json_file, total_frame)
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+        if cache["key"] == key and len(cache["groups"]) == len(dataset.data):
+            print("load the modality groups from " + cache_path)
+            return cache["groups"]
+    if compute == False:
+        raise ValueError("the modality group cache {:s} is missing or stale for {:s}".format(cache_path, dataset_json_file))
+
+    print("check the files of {:d} samples for the modality groups".format(len(dataset.data)))
+    groups = [get_modality_group(dataset.decode_data(datum), total_frame) for datum in dataset.data]
+    # written to a temporary file first, so a reading process never sees a partial cache
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"key": key, "groups": groups}, f)
+    os.replace(tmp_path, cache_path)
+    print("saved the modality groups to " + cache_path)
+    return groups
+
+
+class ModalityBatchSampler(Sampler):
+    def __init__(
+        self,
+        dataset,
+        batch_size,
+        group_weights=None,
+        num_replicas=1,
+        rank=0,
+        num_batches=None,
+        seed=0,
+        modality_groups=None,
+    ):
+        """
+        Batch sampler that makes every batch modality-homogeneous, i.e., all samples in a batch have the same modalities
+        (audio+video, audio+midi, or all three), so the model can skip entire branches in a step.
+        :param dataset: AudiosetDataset (piano roll or midi), only its .data, .decode_data and .total_frame are used
+        :param batch_size: per-process batch size
+        :param group_weights: dict of {group: proportion} of the batches drawn from each group, e.g., {'av': 0.5, 'am': 0.5},
+            groups not listed are not sampled. default is proportional to the group size
+        :param num_replicas: number of DDP processes, all processes draw the same group at each step, each takes its own shard
+        :param rank: rank of the current process
+        :param num_batches: number of batches per epoch, default is one pass over the sampled groups
+        :param modality_groups: the group of every sample from get_modality_groups, default checks the files of every sample
+            here, with several processes compute them once and pass them to every process
+        """
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.start_step = 0
+
+        # the files of every sample are checked once, not in every epoch
+        if modality_groups is None:
+            total_frame = getattr(dataset, "total_frame", 10)
+            modality_groups = [get_modality_group(dataset.decode_data(datum), total_frame) for datum in dataset.data]
+        groups = {}
+        for index, group in enumerate(modality_groups):
+            groups.setdefault(group, []).append(index)
+
+        # one step takes batch_size samples for each process
+        self.global_batch_size = batch_size * num_replicas
+        if group_weights is None:
+            group_weights = {group: len(indices) for group, indices in groups.items()}
+        self.groups = {}
+        for group, weight in group_weights.items():
+            if weight <= 0:
+                continue
+            if len(groups.get(group, [])) < self.global_batch_size:
+                print("modality group {:s} has fewer samples than one global batch, skipped".format(group))
+                continue
+            self.groups[group] = np.array(groups[group], dtype=np.int64)
+        if len(self.groups) == 0:
+            raise ValueError("no modality group has enough samples for a batch of {:d}".format(self.global_batch_size))
+
+        self.group_names = sorted(self.groups.keys())
+        weights = np.array([group_weights[group] for group in self.group_names], dtype=np.float64)
+        self.group_probs = weights / weights.sum()
+
+        if num_batches is None:
+            num_batches = sum(len(self.groups[group]) for group in self.group_names) // self.global_batch_size
+        self.num_batches = num_batches
+
+        for group, prob in zip(self.group_names, self.group_probs):
+            print(
+                "modality group {:s}: {:d} samples, sampled with proportion {:.3f}".format(
+                    group, len(self.groups[group]), prob
+                )
+            )
+
+    def set_epoch(self, epoch):
+        # same seed on all processes so that every process draws the same group at each step
+        self.epoch = epoch
+
+    def set_start_step(self, step):
+        # skip the first step batches of the next epoch, used to resume in the middle of an epoch
+        self.start_step = step
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        steps = rng.choice(len(self.group_names), size=self.num_batches, p=self.group_probs)
+        start_step, self.start_step = self.start_step, 0
+
+        orders = {}
+        positions = {}
+        for step, step_group in enumerate(steps):
+            group = self.group_names[step_group]
+            indices = self.groups[group]
+            # reshuffle a group when it runs out, the leftover samples (less than a global batch) are dropped
+            if group not in orders or positions[group] + self.global_batch_size > len(indices):
+                orders[group] = rng.permutation(indices)
+                positions[group] = 0
+            start = positions[group] + self.rank * self.batch_size
+            positions[group] += self.global_batch_size
+            if step >= start_step:
+                yield orders[group][start : start + self.batch_size].tolist()
+
+    def __len__(self):
+        return self.num_batches - self.start_step
+
+
+class ResumableBatchSampler(Sampler):
+    def __init__(
+        self,
+        num_samples,
+        batch_size,
+        weights=None,
+        num_replicas=1,
+        rank=0,
+        seed=0,
+    ):
+        """
+        Shuffled (or weighted, with replacement) batch sampler that shards every batch across processes and can start
+        in the middle of an epoch, so training can resume from a step checkpoint with the same data order.
+        :param num_samples: number of samples in the dataset
+        :param batch_size: per-process batch size
+        :param weights: per-sample weights for balanced sampling, None means uniform shuffling without replacement
+        :param num_replicas: number of DDP processes, each process takes its own shard of every global batch
+        :param rank: rank of the current process
+        """
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.weights = None if weights is None else torch.as_tensor(weights, dtype=torch.double)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.start_step = 0
+        self.global_batch_size = batch_size * num_replicas
+        # the last incomplete global batch is dropped
+        self.num_batches = num_samples // self.global_batch_size
+
+    def set_epoch(self, epoch):
+        # same seed on all processes so that the shards of a global batch do not overlap
+        self.epoch = epoch
+
+    def set_start_step(self, step):
+        # skip the first step batches of the next epoch, used to resume in the middle of an epoch
+        self.start_step = step
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        if self.weights is None:
+            order = torch.randperm(self.num_samples, generator=g)
+        else:
+            order = torch.multinomial(self.weights, self.num_samples, replacement=True, generator=g)
+        start_step, self.start_step = self.start_step, 0
+
+        for step in range(start_step, self.num_batches):
+            start = step * self.global_batch_size + self.rank * self.batch_size
+            yield order[start : start + self.batch_size].tolist()
+
+    def __len__(self):
+        return self.num_batches - self.start_step
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# @Time    : 10/19/26 8:05 PM
+# @Author  : Ben Chou
+# @Affiliation  : Purdue University
+# @Email   : chou150@purdue.edu
+# @File    : export.py
+
+# export a finetuned CAVMAEFT / CAVMAEFTAudio into standalone TorchScript and ONNX graphs, one graph per mode,
+# traced with fixed input shapes. the string mode dispatch and the DataParallel wrapping stay in this script,
+# the exported graphs only take tensors. run them with export_runtime.py, which does not import the training code.
+# output layout:
+# export_dir/manifest.json                      the modes, input / output names and shapes, and the files of each mode
+# export_dir/{mode}.pt, export_dir/{mode}.onnx  one graph per mode, feat is forward_feat (audio and visual tokens)
+
+import argparse
+import ast
+import inspect
+import json
+import os
+import torch
+from torch import nn
+from models.audio_mdl import CAVMAEFTAudio
+from model_loader import add_model_args, load_model
+
+# mode -> (input names, output names)
+MODES = {
+    'audioonly': (['a'], ['logits']),
+    'missingaudioonly': (['a'], ['logits']),
+    'videoonly': (['v'], ['logits']),
+    'missingvideoonly': (['v'], ['logits']),
+    'multimodal': (['a', 'v'], ['logits']),
+    'feat': (['a', 'v'], ['audio_feat', 'video_feat']),
+}
+# CAVMAEFTAudio only has the audio path, its feat graph only takes the audio
+AUDIO_MODEL_MODES = {
+    'audioonly': (['a'], ['logits']),
+    'feat': (['a'], ['audio_feat']),
+}
+
+def unwrap(audio_model):
+    return audio_model.module if isinstance(audio_model, nn.DataParallel) else audio_model
+
+class ModeGraph(nn.Module):
+    """
+    A model with its mode fixed, forward takes the inputs of MODES[mode] (or AUDIO_MODEL_MODES) as positional tensors.
+    """
+    def __init__(self, audio_model, mode):
+        super().__init__()
+        self.audio_model = unwrap(audio_model)
+        self.mode = mode
+
+    def forward(self, *inputs):
+        if isinstance(self.audio_model, CAVMAEFTAudio):
+            if self.mode == 'feat':
+                return self.audio_model(inputs[0])
+            return self.audio_model.forward_pred(inputs[0], None)
+        input_names = MODES[self.mode][0]
+        a = inputs[input_names.index('a')] if 'a' in input_names else None
+        v = inputs[input_names.index('v')] if 'v' in input_names else None
+        if self.mode == 'feat':
+            return self.audio_model.forward_feat(a, v, 'av')
+        return self.audio_model(a, v, self.mode)
+
+def get_example_inputs(input_names, batch_size, target_length, im_res):
+    shapes = {'a': [batch_size, target_length, 128], 'v': [batch_size, 3, im_res, im_res]}
+    return tuple(torch.randn(*shapes[name]) for name in input_names)
+
+def export_torchscript(graph, example_inputs, path):
+    with torch.no_grad():
+        traced = torch.jit.trace(graph, example_inputs)
+    traced = torch.jit.freeze(traced.eval())
+    traced.save(path)
+    return traced
+
+def export_onnx(graph, example_inputs, path, input_names, output_names, opset_version=17, dynamic_batch=False):
+    kwargs = {}
+    # newer torch exports with dynamo by default, the traced exporter handles the model as is
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+    dynamic_axes = {name: {0: 'batch'} for name in input_names + output_names} if dynamic_batch == True else None
+    with torch.no_grad():
+        torch.onnx.export(graph, example_inputs, path, input_names=input_names, output_names=output_names,
+                          opset_version=opset_version, dynamic_axes=dynamic_axes, **kwargs)
+
+def export_model(audio_model, export_dir, modes=None, formats=('torchscript', 'onnx'), batch_size=1, target_length=1024, im_res=224, opset_version=17, dynamic_batch=False):
+    """
+    Export each mode of audio_model (DataParallel or not) into export_dir and write the manifest, modes None exports all modes.
+    The TorchScript graphs are checked against the eager model on the example inputs.
+    """
+    audio_model = unwrap(audio_model).eval()
+    all_modes = AUDIO_MODEL_MODES if isinstance(audio_model, CAVMAEFTAudio) else MODES
+    modes = list(all_modes) if modes == None else modes
+    os.makedirs(export_dir, exist_ok=True)
+    manifest = {'model': type(audio_model).__name__, 'label_dim': audio_model.mlp_head[-1].out_features, 'batch_size': batch_size,
+                'dynamic_batch': dynamic_batch, 'modes': {}}
+    for mode in modes:
+        if mode not in all_modes:
+            raise ValueError('{:s} does not support mode {:s}, choose from {:s}'.format(manifest['model'], mode, ', '.join(all_modes)))
+        input_names, output_names = all_modes[mode]
+        graph = ModeGraph(audio_model, mode).eval()
+        example_inputs = get_example_inputs(input_names, batch_size, target_length, im_res)
+        with torch.no_grad():
+            outputs = graph(*example_inputs)
+        outputs = outputs if isinstance(outputs, tuple) else (outputs,)
+        entry = {'inputs': {name: list(x.shape) for name, x in zip(input_names, example_inputs)},
+                 'outputs': {name: list(x.shape) for name, x in zip(output_names, outputs)}, 'files': {}}
+        if 'torchscript' in formats:
+            path = os.path.join(export_dir, mode + '.pt')
+            traced = export_torchscript(graph, example_inputs, path)
+            with torch.no_grad():
+                traced_outputs = traced(*example_inputs)
+            traced_outputs = traced_outputs if isinstance(traced_outputs, tuple) else (traced_outputs,)
+            max_diff = max((x - y).abs().max().item() for x, y in zip(outputs, traced_outputs))
+            print('{:s}: torchscript saved to {:s}, max difference to the eager model {:.6f}'.format(mode, path, max_diff))
+            entry['files']['torchscript'] = mode + '.pt'
+        if 'onnx' in formats:
+            path = os.path.join(export_dir, mode + '.onnx')
+            export_onnx(graph, example_inputs, path, input_names, output_names, opset_version, dynamic_batch)
+            print('{:s}: onnx saved to {:s}'.format(mode, path))
+            entry['files']['onnx'] = mode + '.onnx'
+        manifest['modes'][mode] = entry
+    with open(os.path.join(export_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_model_args(parser)
+    parser.add_argument("--modes", type=str, default=None, help="comma separated modes to export, feat is forward_feat, None for all modes of the model")
+    parser.add_argument("--formats", type=str, default='torchscript,onnx', help="comma separated export formats, from torchscript, onnx")
+    parser.add_argument("--im_res", type=int, default=224, help="the image resolution of the exported graphs")
+    parser.add_argument('-b', '--batch_size', default=1, type=int, metavar='N', help='the batch size of the exported graphs')
+    parser.add_argument("--dynamic_batch", help='if True, the onnx graphs take any batch size', type=ast.literal_eval, default=False)
+    parser.add_argument("--opset_version", type=int, default=17, help="the onnx opset")
+    parser.add_argument("--export_dir", type=str, default='./exported', help="where the graphs and the manifest are saved")
+    args = parser.parse_args()
+
+    audio_model = load_model(args)[0]
+    export_model(audio_model, args.export_dir, args.modes.split(',') if args.modes != None else None, args.formats.split(','), args.batch_size, args.target_length, args.im_res, args.opset_version, args.dynamic_batch)
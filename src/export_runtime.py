@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# @Time    : 10/19/26 8:30 PM
+# @Author  : Ben Chou
+# @Affiliation  : Purdue University
+# @Email   : chou150@purdue.edu
+# @File    : export_runtime.py
+
+# cpu runtime for the graphs exported by export.py, only needs numpy and either onnxruntime or torch,
+# the model code, timm and the data loading stack are not imported.
+#   from export_runtime import ExportedModel
+#   audio_model = ExportedModel('./exported', 'audioonly', backend='onnx', num_threads=4)
+#   logits = audio_model(a=fbank)  # fbank [1, 1024, 128] numpy array, the shape in manifest.json
+#   audio_feat, video_feat = ExportedModel('./exported', 'feat')(a=fbank, v=image)
+
+import json
+import os
+import numpy as np
+
+class ExportedModel(object):
+    """
+    Runs one exported mode. backend is onnx (onnxruntime) or torchscript (torch.jit).
+    Inputs are given by name (a: fbank [B, target_length, 128], v: image [B, 3, im_res, im_res]) as numpy arrays,
+    returns a numpy array, or a tuple of arrays for modes with several outputs.
+    """
+    def __init__(self, export_dir, mode, backend='onnx', num_threads=0):
+        with open(os.path.join(export_dir, 'manifest.json'), 'r') as f:
+            self.manifest = json.load(f)
+        if mode not in self.manifest['modes']:
+            raise ValueError('mode {:s} is not exported, exported modes: {:s}'.format(mode, ', '.join(self.manifest['modes'])))
+        self.mode_info = self.manifest['modes'][mode]
+        if backend not in self.mode_info['files']:
+            raise ValueError('mode {:s} is not exported as {:s}'.format(mode, backend))
+        self.input_names = list(self.mode_info['inputs'])
+        self.backend = backend
+        path = os.path.join(export_dir, self.mode_info['files'][backend])
+
+        if backend == 'onnx':
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            if num_threads > 0:
+                options.intra_op_num_threads = num_threads
+            self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        elif backend == 'torchscript':
+            import torch
+            if num_threads > 0:
+                torch.set_num_threads(num_threads)
+            self.torch = torch
+            self.module = torch.jit.load(path, map_location='cpu').eval()
+        else:
+            raise ValueError('unknown backend ' + backend)
+
+    def check_input(self, name, x):
+        shape = self.mode_info['inputs'][name]
+        batch_ok = (self.manifest['dynamic_batch'] == True and self.backend == 'onnx') or x.shape[0] == shape[0]
+        if batch_ok == False or list(x.shape[1:]) != shape[1:]:
+            raise ValueError('input {:s} has shape {:s}, the graph is exported with {:s}'.format(name, str(list(x.shape)), str(shape)))
+        return np.ascontiguousarray(x, dtype=np.float32)
+
+    def __call__(self, **inputs):
+        inputs = [self.check_input(name, inputs[name]) for name in self.input_names]
+        if self.backend == 'onnx':
+            outputs = self.session.run(None, dict(zip(self.input_names, inputs)))
+        else:
+            with self.torch.no_grad():
+                outputs = self.module(*[self.torch.from_numpy(x) for x in inputs])
+            outputs = outputs if isinstance(outputs, tuple) else (outputs,)
+            outputs = [x.numpy() for x in outputs]
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
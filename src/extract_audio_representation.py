@@ -5,94 +5,205 @@
 # @Email   : yuangong@mit.edu
 # @File    : extract_audio_representation.py
 
-# extract un-pooled audio representations (last layer) of a dataset [num_sample, 512, 768], 512 corresponds to 512 patches of each 10 second audios
-# with some modification, this code can also be used for visual representations extraction
+# extract audio (wav1), midi (wav2) and visual representations (last layer) of a dataset,
+# un-pooled [num_sample, 512, 768] (512 corresponds to 512 patches of each 10 second audios) or mean pooled [num_sample, 768].
+# the dataset is split into fixed size shards, each shard is written batch by batch to float16 memory-mapped .npy files
+# and is marked complete by its meta.json, so a killed job resumes from the last completed shard.
+# shards are split across worker processes (one per gpu), and across nodes with --num_nodes / --node_rank.
+# output layout:
+# output_dir/meta.json                                  extraction setting, checked when resuming
+# output_dir/shard_00000/{audio,midi,visual}.npy        features of samples [0, shard_size)
+# output_dir/shard_00000/labels.npy, meta.json          labels and the video ids of the shard
 
 import argparse
+import ast
 import os
+import json
+import shutil
+import time
 import models
-import dataloader as dataloader
+import dataloader_midi as dataloader
 import torch
 import numpy as np
 from torch.cuda.amp import autocast
 from torch import nn
-from numpy import dot
-from numpy.linalg import norm
 
-def get_immediate_subdirectories(a_dir):
-    return [name for name in os.listdir(a_dir) if os.path.isdir(os.path.join(a_dir, name))]
+# branch name -> (model modality, index of the input in the dataset output)
+BRANCHES = {'audio': ('a1', 0), 'midi': ('a2', 1), 'visual': ('v', 2)}
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-print(device)
+def get_shard_dir(output_dir, shard_id):
+    return os.path.join(output_dir, 'shard_{:05d}'.format(shard_id))
 
-def save_audio_feat(audio_model, val_loader, save_path):
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    if not isinstance(audio_model, nn.DataParallel):
-        audio_model = nn.DataParallel(audio_model)
-    audio_model = audio_model.to(device)
-    audio_model.eval()
+def get_extract_meta(args, num_samples):
+    return {'model': args.model, 'model_type': args.model_type, 'data': args.data, 'branches': args.branches,
+            'pooled': args.pooled, 'frame_use': args.frame_use, 'target_length': args.target_length,
+            'num_samples': num_samples, 'shard_size': args.shard_size}
 
-    A_a_feat = []
-    with torch.no_grad():
-        for i, (a_input, v_input, labels) in enumerate(val_loader):
-            audio_input, video_input = a_input.to(device), v_input.to(device)
-            with autocast():
-                audio_output, _ = audio_model.module.forward_feat(audio_input, video_input)
-                print(audio_output.shape)
-            audio_output = audio_output.to('cpu').detach()
-            A_a_feat.append(audio_output)
-    A_a_feat = torch.cat(A_a_feat)
-    array = A_a_feat.numpy()
-    # should be [num_sample, 512, 768], 512 corresponds to 512 patches of each 10 second audios
-    print('The extracted feature shape:', array.shape)
-    np.savez(save_path, array=array)
-
-    # # load the saved feature
-    # loaded_data = np.load('tensor_data.npz')
-    # loaded_array = loaded_data['array']
-
-def extract_audio_feat(model, data, audio_conf, label_csv, num_class, save_path, model_type='pretrain', batch_size=48):
-    print(model)
-    print(data)
-    frame_use = 5
-    # eval setting
-    val_audio_conf = audio_conf
-    val_audio_conf['frame_use'] = frame_use
-    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    args = parser.parse_args()
-    args.data_val = data
-    args.label_csv = label_csv
-    args.exp_dir = './exp/dummy'
-    args.loss_fn = torch.nn.BCELoss()
-    val_loader = torch.utils.data.DataLoader(dataloader.AudiosetDataset(args.data_val, label_csv=args.label_csv, audio_conf=val_audio_conf), batch_size=batch_size, shuffle=False, num_workers=32, pin_memory=True)
+def load_meta(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+# the same computation as forward_feat of CAVMAE / CAVMAEFT, but only for one modality, so unused branches are not computed
+def forward_branch(audio_model, x, modality):
+    if modality != 'v':
+        x = x.unsqueeze(1)
+        x = x.transpose(2, 3)
+    x = getattr(audio_model, 'patch_embed_' + modality)(x)
+    x = x + getattr(audio_model, 'pos_embed_' + modality)
+    x = x + getattr(audio_model, 'modality_' + modality)
+    for blk in getattr(audio_model, 'blocks_' + modality):
+        x = blk(x)
+    for blk in audio_model.blocks_u:
+        x = blk(x, modality)
+    x = getattr(audio_model, 'norm_' + modality)(x)
+    return x
+
+def get_audio_model(args, device):
     # cav-mae only been ssl pretrained
-    if model_type == 'pretrain':
+    if args.model_type == 'pretrain':
         audio_model = models.CAVMAE(modality_specific_depth=11)
     # cav-mae only been ssl pretrained + supervisedly finetuned
-    elif model_type == 'finetune':
-        audio_model = models.CAVMAEFT(label_dim=num_class, modality_specific_depth=11)
-    sdA = torch.load(model, map_location=device)
+    elif args.model_type == 'finetune':
+        audio_model = models.CAVMAEFT(label_dim=args.num_class, modality_specific_depth=11)
+    sdA = torch.load(args.model, map_location='cpu')
     if isinstance(audio_model, torch.nn.DataParallel) == False:
         audio_model = torch.nn.DataParallel(audio_model)
     msg = audio_model.load_state_dict(sdA, strict=True)
     print(msg)
+    audio_model = audio_model.module.to(device)
     audio_model.eval()
-    save_audio_feat(audio_model, val_loader, save_path)
+    return audio_model
+
+def extract_shard(audio_model, dataset, shard_id, args, device):
+    num_samples = len(dataset)
+    start, end = shard_id * args.shard_size, min((shard_id + 1) * args.shard_size, num_samples)
+    shard_dir = get_shard_dir(args.output_dir, shard_id)
+    tmp_dir = shard_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    shard_loader = torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, range(start, end)), batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers, pin_memory=True)
+    arrays = {}
+    pos = 0
+    with torch.no_grad():
+        for i, batch in enumerate(shard_loader):
+            feats = {}
+            with autocast():
+                for branch in args.branches:
+                    modality, input_idx = BRANCHES[branch]
+                    feat = forward_branch(audio_model, batch[input_idx].to(device, non_blocking=True), modality)
+                    if args.pooled == True:
+                        feat = torch.mean(feat, dim=1)
+                    feats[branch] = feat
+            feats['labels'] = batch[3]
+
+            batch_size = batch[3].shape[0]
+            for name, feat in feats.items():
+                if name not in arrays:
+                    arrays[name] = np.lib.format.open_memmap(os.path.join(tmp_dir, name + '.npy'), mode='w+', dtype=np.float32 if name == 'labels' else np.float16, shape=(end - start,) + tuple(feat.shape[1:]))
+                arrays[name][pos: pos + batch_size] = feat.float().to('cpu').numpy()
+            pos += batch_size
+
+    for array in arrays.values():
+        array.flush()
+    del arrays
+    # meta.json is written last, a shard without it is incomplete and extracted again
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump({'start': start, 'end': end, 'video_id': dataset.data[start:end, 3].tolist()}, f)
+    if os.path.exists(shard_dir):
+        shutil.rmtree(shard_dir)
+    os.rename(tmp_dir, shard_dir)
+
+def extract_worker(local_rank, args):
+    worker_id = args.node_rank * args.num_procs + local_rank
+    num_workers = args.num_nodes * args.num_procs
+    if torch.cuda.is_available():
+        device = torch.device('cuda', local_rank % torch.cuda.device_count())
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device('cpu')
 
-# as 20k balanced training data
-data = '/data/sls/scratch/yuangong/cav-mae/pretrained_model/datafiles/audioset/audioset_20k_cleaned.json'
+    audio_conf = {'num_mel_bins': 128, 'target_length': args.target_length, 'freqm': 0, 'timem': 0, 'mixup': 0, 'dataset': args.dataset,
+                  'mode': 'eval', 'mean': args.dataset_mean, 'std': args.dataset_std, 'noise': False, 'im_res': 224, 'frame_use': args.frame_use}
+    dataset = dataloader.AudiosetDataset(args.data, label_csv=args.label_csv, audio_conf=audio_conf)
+    num_shards = (len(dataset) + args.shard_size - 1) // args.shard_size
+    # shards of this worker that are not completed yet
+    todo = [shard_id for shard_id in range(worker_id, num_shards, num_workers)
+            if load_meta(os.path.join(get_shard_dir(args.output_dir, shard_id), 'meta.json')) is None]
+    print('worker {:d}/{:d} on {:s}: {:d} shards to extract'.format(worker_id, num_workers, str(device), len(todo)))
+    if len(todo) == 0:
+        return
 
-label_csv = '/data/sls/scratch/yuangong/cav-mae/pretrained_model/datafiles/audioset/class_labels_indices.csv'
-dataset = 'audioset'
-audio_conf = {'num_mel_bins': 128, 'target_length': 1024, 'freqm': 0, 'timem': 0, 'mixup': 0, 'dataset': dataset,
-              'mode': 'eval', 'mean': -5.081, 'std': 4.4849, 'noise': False, 'im_res': 224, 'frame_use': 5}
+    audio_model = get_audio_model(args, device)
+    for shard_id in todo:
+        begin_time = time.time()
+        extract_shard(audio_model, dataset, shard_id, args, device)
+        print('worker {:d}: shard {:d}/{:d} finished in {:.3f} seconds'.format(worker_id, shard_id, num_shards, time.time() - begin_time), flush=True)
 
-# # download the model from https://www.dropbox.com/s/l5t5geufdy3qvnv/audio_model.21.pth?dl=1
-# # model only been pretrained (not finetuned) with batch size 256, i.e., cav_mae++
-# model = './cav_mae_pretrain.pth'
-# extract_audio_feat(model, data, audio_conf=audio_conf, label_csv=label_csv, num_class=527, save_path = './as_bal_pretrain.npz', model_type='pretrain', batch_size=100)
+def extract_feat(args):
+    # only read the data json to get the number of samples
+    with open(args.data, 'r') as fp:
+        num_samples = len(json.load(fp)['data'])
+    meta = get_extract_meta(args, num_samples)
+    meta_path = os.path.join(args.output_dir, 'meta.json')
+    prev_meta = load_meta(meta_path)
+    if prev_meta is not None and prev_meta != meta:
+        raise ValueError('{:s} holds an extraction with a different setting, use another output_dir'.format(args.output_dir))
+    os.makedirs(args.output_dir, exist_ok=True)
+    if prev_meta is None:
+        if args.node_rank == 0:
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f, indent=2)
+    else:
+        print('resume extraction in ' + args.output_dir)
 
-# download the model from https://www.dropbox.com/s/itfw7p0ueq7z9og/as_46.6.pth?dl=1
-# model pretrained with multi-modal and finetuned on just audio of audioset
-model = './as_46.6.pth'
-extract_audio_feat(model, data, audio_conf=audio_conf, label_csv=label_csv, num_class=527, save_path = './as_bal_ft.npz', model_type='finetune', batch_size=100)
\ No newline at end of file
+    if args.num_procs > 1:
+        torch.multiprocessing.spawn(extract_worker, args=(args,), nprocs=args.num_procs)
+    else:
+        extract_worker(0, args)
+
+# returns the memory-mapped features of a branch ('audio', 'midi', 'visual' or 'labels'), one array per shard in sample order
+def load_extracted_feat(output_dir, branch='audio'):
+    meta = load_meta(os.path.join(output_dir, 'meta.json'))
+    num_shards = (meta['num_samples'] + meta['shard_size'] - 1) // meta['shard_size']
+    feats = []
+    for shard_id in range(num_shards):
+        shard_dir = get_shard_dir(output_dir, shard_id)
+        if load_meta(os.path.join(shard_dir, 'meta.json')) is None:
+            raise ValueError('shard {:d} of {:s} is not extracted yet'.format(shard_id, output_dir))
+        feats.append(np.load(os.path.join(shard_dir, branch + '.npy'), mmap_mode='r'))
+    return feats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    # download the model from https://www.dropbox.com/s/itfw7p0ueq7z9og/as_46.6.pth?dl=1, model pretrained with multi-modal and finetuned on just audio of audioset
+    # or https://www.dropbox.com/s/l5t5geufdy3qvnv/audio_model.21.pth?dl=1, model only been pretrained (not finetuned) with batch size 256, i.e., cav_mae++
+    parser.add_argument("--model", type=str, default='./as_46.6.pth', help="the model checkpoint")
+    parser.add_argument("--model_type", type=str, default='finetune', help="the type of the checkpoint", choices=["pretrain", "finetune"])
+    # as 20k balanced training data
+    parser.add_argument("--data", type=str, default='/data/sls/scratch/yuangong/cav-mae/pretrained_model/datafiles/audioset/audioset_20k_cleaned.json', help="the data json")
+    parser.add_argument("--label_csv", type=str, default='/data/sls/scratch/yuangong/cav-mae/pretrained_model/datafiles/audioset/class_labels_indices.csv', help="csv with class labels")
+    parser.add_argument("--dataset", type=str, default="audioset", help="the dataset used")
+    parser.add_argument("--dataset_mean", type=float, default=-5.081, help="the dataset audio spec mean, used for input normalization")
+    parser.add_argument("--dataset_std", type=float, default=4.4849, help="the dataset audio spec std, used for input normalization")
+    parser.add_argument("--target_length", type=int, default=1024, help="the input length in frames")
+    parser.add_argument("--num_class", type=int, default=527, help="number of classes of the finetuned checkpoint")
+    parser.add_argument("--frame_use", type=int, default=5, help="the video frame used for the visual branch")
+    parser.add_argument("--output_dir", type=str, default='./as_bal_ft_feat', help="directory of the extracted shards")
+    parser.add_argument("--branches", type=str, default='audio', help="comma separated branches to extract, from audio, midi, visual")
+    parser.add_argument("--pooled", help='if True, save mean pooled [num_sample, 768] features, otherwise all patches', type=ast.literal_eval, default=False)
+    parser.add_argument("--shard_size", type=int, default=10000, help="number of samples per shard")
+    parser.add_argument('-b', '--batch_size', default=100, type=int, metavar='N', help='mini-batch size')
+    parser.add_argument('-w', '--num_workers', default=16, type=int, metavar='NW', help='# of data loading workers per extraction process')
+    parser.add_argument("--num_procs", type=int, default=max(torch.cuda.device_count(), 1), help="number of extraction processes on this node, one per gpu")
+    parser.add_argument("--num_nodes", type=int, default=1, help="number of nodes splitting the dataset")
+    parser.add_argument("--node_rank", type=int, default=0, help="rank of this node")
+    args = parser.parse_args()
+    args.branches = args.branches.split(',')
+    for branch in args.branches:
+        if branch not in BRANCHES:
+            raise ValueError('unknown branch {:s}, choose from {:s}'.format(branch, ', '.join(BRANCHES)))
+    extract_feat(args)
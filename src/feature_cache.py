@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# @Time    : 10/19/26 10:02 AM
+# @Author  : Ben Chou
+# @Affiliation  : Purdue University
+# @Email   : chou150@purdue.edu
+# @File    : feature_cache.py
+
+# run a frozen CAVMAEFT backbone once over a dataset and cache its output on disk (float16 memory-mapped .npy),
+# then train the classification head from the cache instead of re-running the backbone every epoch.
+# two cache levels:
+# 'pooled': the pooled representation fed to mlp_head (linear probing, only mlp_head is trained)
+# 'token': the output of the modality-specific blocks (blocks_a / blocks_v), only blocks_u, the final norms and mlp_head are trained
+# note the cache is extracted without data augmentation (no mixup, specaug, noise) and with a fixed frame.
+
+import os
+import json
+import shutil
+import time
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import Dataset
+from torch.cuda.amp import autocast
+
+def get_frame_use(dataset):
+    # the frame actually used by the dataset, -1 in eval mode means the middle frame
+    if dataset.mode == 'eval' and dataset.frame_use == -1:
+        return int(dataset.total_frame / 2)
+    return int(dataset.frame_use)
+
+# the audio_conf of the dataset (mean / std, target_length, im_res, ...) and the label csv are recorded, a cache built with other settings is rebuilt
+def get_cache_meta(dataset, feature_level, ftmode, data, pretrain_path, label_csv=None):
+    return {'feature_level': feature_level, 'ftmode': ftmode, 'frame_use': get_frame_use(dataset), 'num_samples': len(dataset), 'data': data, 'pretrain_path': pretrain_path,
+            'label_csv': label_csv, 'audio_conf': json.loads(json.dumps(dataset.audio_conf, sort_keys=True))}
+
+def write_memmap_cache(compute_fn, data_loader, cache_dir, meta, dtypes=None):
+    """
+    Run compute_fn(a_input, v_input, labels) -> {name: [B, ...] tensor or None} over data_loader (must not shuffle or drop
+    samples) and write each output to cache_dir/<name>.npy [num_samples, ...], float16 unless dtypes gives another type.
+    Outputs are written batch by batch into memory-mapped files in cache_dir.tmp, meta.json is written last and the
+    directory is renamed to cache_dir, so an existing cache_dir is always complete.
+    """
+    dtypes = {} if dtypes is None else dtypes
+    tmp_dir = cache_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    num_samples = meta['num_samples']
+    arrays = {}
+    start = 0
+    with torch.no_grad():
+        for i, (a_input, v_input, labels) in enumerate(data_loader):
+            outputs = compute_fn(a_input, v_input, labels)
+            batch_size = labels.shape[0]
+            for name, x in outputs.items():
+                if x is None:
+                    continue
+                if name not in arrays:
+                    arrays[name] = np.lib.format.open_memmap(os.path.join(tmp_dir, name + '.npy'), mode='w+', dtype=dtypes.get(name, np.float16),
+                                                             shape=(num_samples,) + tuple(x.shape[1:]))
+                arrays[name][start:start + batch_size] = x.float().to('cpu').numpy()
+            start += batch_size
+
+    if start != num_samples:
+        raise ValueError('the cache loader covered {:d} of {:d} samples, do not use shuffle or drop_last'.format(start, num_samples))
+    for array in arrays.values():
+        array.flush()
+    del arrays
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(tmp_dir, cache_dir)
+
+def build_feature_cache(audio_model, data_loader, cache_dir, feature_level, ftmode, meta):
+    """
+    Run the frozen backbone over data_loader (must not shuffle or drop samples) and write
+    cache_dir/{pooled,a,v}.npy [num_samples, ...] in float16 and cache_dir/labels.npy (see write_memmap_cache).
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if not isinstance(audio_model, nn.DataParallel):
+        audio_model = nn.DataParallel(audio_model)
+    audio_model = audio_model.to(device)
+    audio_model.eval()
+
+    def compute_fn(a_input, v_input, labels):
+        with autocast():
+            a, v = audio_model.module.forward_modality_specific(a_input.to(device), v_input.to(device), ftmode)
+            if feature_level == 'pooled':
+                feats = {'pooled': audio_model.module.forward_unified(a, v, ftmode)}
+            else:
+                feats = {'a': a, 'v': v}
+        feats['labels'] = labels
+        return feats
+
+    begin_time = time.time()
+    print('now extract {:s} features of {:d} samples to {:s}'.format(feature_level, meta['num_samples'], cache_dir))
+    write_memmap_cache(compute_fn, data_loader, cache_dir, meta, dtypes={'labels': np.float32})
+    print('feature extraction finished in {:.3f} seconds'.format(time.time() - begin_time))
+
+def load_cache_meta(cache_dir):
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as f:
+        return json.load(f)
+
+class FeatureCacheDataset(Dataset):
+    def __init__(self, cache_dir):
+        """
+        Dataset over a feature cache written by build_feature_cache, returns (a, v, label) like AudiosetDataset,
+        so the training loop is unchanged. For the 'pooled' level a is the pooled feature and v is empty.
+        """
+        self.meta = load_cache_meta(cache_dir)
+        self.feature_level = self.meta['feature_level']
+        self.features = {}
+        for name in ['pooled', 'a', 'v']:
+            path = os.path.join(cache_dir, name + '.npy')
+            if os.path.exists(path):
+                self.features[name] = np.load(path, mmap_mode='r')
+        self.labels = np.load(os.path.join(cache_dir, 'labels.npy'), mmap_mode='r')
+        print('now use {:s} feature cache of {:d} samples, frame {:d}, ftmode {:s}'.format(self.feature_level, len(self.labels), self.meta['frame_use'], self.meta['ftmode']))
+
+    def get_feature(self, name, index):
+        if name not in self.features:
+            return torch.zeros(0)
+        return torch.from_numpy(np.asarray(self.features[name][index], dtype=np.float32))
+
+    def __getitem__(self, index):
+        label = torch.from_numpy(np.asarray(self.labels[index], dtype=np.float32))
+        if self.feature_level == 'pooled':
+            return self.get_feature('pooled', index), torch.zeros(0), label
+        return self.get_feature('a', index), self.get_feature('v', index), label
+
+    def __len__(self):
+        return len(self.labels)
+
+def get_feature_cache_loader(audio_model, data_loader, cache_dir, feature_level, args, data, shuffle=False, sampler=None):
+    """
+    Build the feature cache of data_loader under cache_dir (or reuse it if it matches the current setting),
+    and return a DataLoader over the cached features.
+    """
+    meta = get_cache_meta(data_loader.dataset, feature_level, args.ftmode, data, args.pretrain_path, args.label_csv)
+    if load_cache_meta(cache_dir) == meta:
+        print('reuse the feature cache at ' + cache_dir)
+    else:
+        build_feature_cache(audio_model, data_loader, cache_dir, feature_level, args.ftmode, meta)
+
+    return torch.utils.data.DataLoader(FeatureCacheDataset(cache_dir), batch_size=args.batch_size, shuffle=shuffle if sampler is None else False, sampler=sampler,
+                                       num_workers=args.num_workers, pin_memory=True, drop_last=shuffle or sampler is not None)
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+# @Time    : 10/19/26 2:15 PM
+# @Author  : Ben Chou
+# @Affiliation  : Purdue University
+# @Email   : chou150@purdue.edu
+# @File    : inference_server.py
+
+# local http inference server for a finetuned CAVMAEFT (audio-visual event tagging) or CAVMAEFTAudio (audioonly / missingaudioonly only).
+# the model is loaded once, requests are preprocessed (the same fbank / image preprocessing as dataloader.py in eval mode)
+# in a worker pool, and concurrent requests are grouped into dynamic batches: a batch is run when it is full
+# or when its first request has waited max_latency_ms.
+# POST /predict  {"mode": "audioonly", "wav": <base64 wav bytes> or "wav_path": str or "fbank": [[...]], "image": <base64 jpg bytes> or "image_path": str}
+#                "fbank" is the un-normalized kaldi fbank [n_frames, num_mel_bins], it is padded / truncated and normalized here.
+# GET  /stats    throughput and latency counters
+# GET  /health
+# run with --tiny True to serve a small randomly initialized model on cpu (for testing).
+
+import argparse
+import ast
+import base64
+import io
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+import torchaudio
+import torchvision.transforms as T
+from PIL import Image
+import PIL
+from torch.cuda.amp import autocast
+from models.cav_mae import CAVMAEFT
+from models.audio_mdl import CAVMAEFTAudio
+from model_loader import add_model_args, build_model, get_model_config, load_model
+from dataloader import make_name_dict, pad_or_truncate, wav2fbank
+
+MODES = ["multimodal", "audioonly", "videoonly", "missingaudioonly", "missingvideoonly"]
+AUDIO_MODES = ["multimodal", "audioonly", "missingaudioonly"]
+VIDEO_MODES = ["multimodal", "videoonly", "missingvideoonly"]
+# CAVMAEFTAudio only has the audio only path
+AUDIO_MODEL_MODES = ["audioonly", "missingaudioonly"]
+
+def read_bytes(req, key):
+    if key in req:
+        return io.BytesIO(base64.b64decode(req[key]))
+    if key + '_path' in req:
+        return req[key + '_path']
+    return None
+
+def preprocess_request(req, conf):
+    """
+    Turn a request into model input, run in the preprocessing pool.
+    Returns (mode, fbank [target_length, melbins] or None, image [3, im_res, im_res] or None) as numpy arrays.
+    """
+    mode = req.get('mode', conf['mode'])
+    if mode not in conf['modes']:
+        raise ValueError('unknown mode {:s} for this model, choose from {:s}'.format(str(mode), ', '.join(conf['modes'])))
+    fbank, image = None, None
+    if mode in AUDIO_MODES:
+        if 'fbank' in req:
+            fbank = torch.tensor(req['fbank'], dtype=torch.float32)
+            if fbank.dim() != 2 or fbank.shape[1] != conf['melbins']:
+                raise ValueError('fbank should be [n_frames, {:d}], got {:s}'.format(conf['melbins'], str(list(fbank.shape))))
+        else:
+            wav = read_bytes(req, 'wav')
+            if wav is None:
+                raise ValueError('mode {:s} needs wav, wav_path or fbank'.format(mode))
+            waveform, sr = torchaudio.load(wav)
+            fbank = wav2fbank(waveform, sr, conf['melbins'])
+        fbank = pad_or_truncate(fbank, conf['target_length'])
+        fbank = (fbank - conf['mean']) / conf['std']
+        fbank = fbank.numpy()
+    if mode in VIDEO_MODES:
+        img = read_bytes(req, 'image')
+        if img is None:
+            raise ValueError('mode {:s} needs image or image_path'.format(mode))
+        preprocess = T.Compose([
+            T.Resize(conf['im_res'], interpolation=PIL.Image.BICUBIC),
+            T.CenterCrop(conf['im_res']),
+            T.ToTensor(),
+            T.Normalize(mean=[0.4850, 0.4560, 0.4060], std=[0.2290, 0.2240, 0.2250])])
+        image = preprocess(Image.open(img).convert('RGB')).numpy()
+    return mode, fbank, image
+
+class ServerStats(object):
+    """Thread-safe request / batch counters, latencies are kept for the last window requests."""
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_batches = 0
+        self.num_samples = 0
+        self.forward_time = 0.0
+        self.latency = deque(maxlen=window)
+        self.preprocess_time = deque(maxlen=window)
+        self.queue_time = deque(maxlen=window)
+
+    def add_request(self, latency, preprocess_time, queue_time):
+        with self.lock:
+            self.num_requests += 1
+            self.latency.append(latency)
+            self.preprocess_time.append(preprocess_time)
+            self.queue_time.append(queue_time)
+
+    def add_error(self):
+        with self.lock:
+            self.num_errors += 1
+
+    def add_batch(self, batch_size, forward_time):
+        with self.lock:
+            self.num_batches += 1
+            self.num_samples += batch_size
+            self.forward_time += forward_time
+
+    def summary(self):
+        with self.lock:
+            uptime = time.time() - self.start_time
+            latency = np.array(self.latency) * 1000
+            res = {'uptime': uptime, 'requests': self.num_requests, 'errors': self.num_errors, 'batches': self.num_batches,
+                   'requests_per_sec': self.num_requests / uptime,
+                   'mean_batch_size': self.num_samples / max(self.num_batches, 1),
+                   'mean_forward_ms': self.forward_time / max(self.num_batches, 1) * 1000}
+            if len(latency) > 0:
+                res.update({'latency_mean_ms': float(np.mean(latency)),
+                            'latency_p50_ms': float(np.percentile(latency, 50)),
+                            'latency_p90_ms': float(np.percentile(latency, 90)),
+                            'latency_p99_ms': float(np.percentile(latency, 99)),
+                            'preprocess_mean_ms': float(np.mean(self.preprocess_time) * 1000),
+                            'queue_mean_ms': float(np.mean(self.queue_time) * 1000)})
+            return res
+
+class DynamicBatcher(object):
+    """
+    Groups concurrent requests into batches on a single model thread.
+    A batch is closed when it has max_batch_size requests or max_latency_ms after its first request arrived,
+    requests of different modes in a batch are run as separate forward passes.
+    """
+    def __init__(self, audio_model, device, max_batch_size=32, max_latency_ms=10, stats=None):
+        self.audio_model = audio_model
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.stats = stats
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def submit(self, mode, fbank, image):
+        future = Future()
+        self.queue.put((time.time(), mode, fbank, image, future))
+        return future
+
+    def _worker(self):
+        while True:
+            items = [self.queue.get()]
+            deadline = items[0][0] + self.max_latency
+            while len(items) < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            for mode in MODES:
+                group = [item for item in items if item[1] == mode]
+                if len(group) > 0:
+                    self._run(mode, group)
+
+    def _run(self, mode, group):
+        batch_start = time.time()
+        try:
+            a = torch.from_numpy(np.stack([item[2] for item in group])).to(self.device) if mode in AUDIO_MODES else None
+            v = torch.from_numpy(np.stack([item[3] for item in group])).to(self.device) if mode in VIDEO_MODES else None
+            with torch.no_grad():
+                with autocast(enabled=self.device.type == 'cuda'):
+                    if isinstance(self.audio_model, CAVMAEFTAudio):
+                        output = self.audio_model.forward_pred(a, v)
+                    else:
+                        output = self.audio_model(a, v, mode)
+            output = output.float().to('cpu').numpy()
+        except Exception as e:
+            for item in group:
+                item[4].set_exception(e)
+            return
+        if self.stats is not None:
+            self.stats.add_batch(len(group), time.time() - batch_start)
+        for i, item in enumerate(group):
+            item[4].set_result((output[i], batch_start - item[0]))
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    # set by serve()
+    server_state = None
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.server_state['stats'].summary())
+        elif self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'unknown path ' + self.path})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_json(404, {'error': 'unknown path ' + self.path})
+            return
+        state = self.server_state
+        start_time = time.time()
+        try:
+            req = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if state['pool'] is not None:
+                mode, fbank, image = state['pool'].submit(preprocess_request, req, state['conf']).result()
+            else:
+                mode, fbank, image = preprocess_request(req, state['conf'])
+            preprocess_time = time.time() - start_time
+            logits, queue_time = state['batcher'].submit(mode, fbank, image).result()
+        except ValueError as e:
+            state['stats'].add_error()
+            self.send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            state['stats'].add_error()
+            self.send_json(500, {'error': repr(e)})
+            return
+
+        logits = torch.from_numpy(logits)
+        probs = torch.softmax(logits, dim=-1) if state['conf']['loss'] == 'CE' else torch.sigmoid(logits)
+        top = torch.argsort(probs, descending=True)[:state['conf']['top_k']].tolist()
+        res = {'mode': mode, 'probs': probs.tolist(),
+               'top': [{'index': i, 'label': state['label_names'].get(str(i), str(i)), 'prob': float(probs[i])} for i in top]}
+        state['stats'].add_request(time.time() - start_time, preprocess_time, queue_time)
+        self.send_json(200, res)
+
+    def log_message(self, format, *args):
+        # no per-request logging, use /stats
+        pass
+
+def get_audio_model(args, device):
+    if args.tiny == True:
+        audio_model = CAVMAEFT(label_dim=args.n_class, img_size=args.im_res, audio_length=args.target_length, embed_dim=64, num_heads=4)
+    elif args.model is None:
+        # randomly initialized, e.g., to measure the serving throughput
+        audio_model = build_model(get_model_config(args))
+    else:
+        return load_model(args, device)[0]
+    audio_model = audio_model.to(device)
+    audio_model.eval()
+    audio_model.tome_r = args.tome_r
+    return audio_model
+
+def serve(args):
+    device = torch.device("cuda" if torch.cuda.is_available() and args.tiny == False else "cpu")
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    audio_model = get_audio_model(args, device)
+    modes = AUDIO_MODEL_MODES if isinstance(audio_model, CAVMAEFTAudio) else MODES
+    if args.ftmode not in modes:
+        raise ValueError('the default mode {:s} is not supported by {:s}, choose from {:s}'.format(args.ftmode, type(audio_model).__name__, ', '.join(modes)))
+    stats = ServerStats()
+    conf = {'mode': args.ftmode, 'modes': modes, 'melbins': 128, 'target_length': args.target_length, 'mean': args.dataset_mean, 'std': args.dataset_std,
+            'im_res': args.im_res, 'loss': args.loss, 'top_k': args.top_k}
+    InferenceHandler.server_state = {
+        'conf': conf,
+        'stats': stats,
+        'pool': ProcessPoolExecutor(args.preprocess_workers) if args.preprocess_workers > 0 else None,
+        'batcher': DynamicBatcher(audio_model, device, args.max_batch_size, args.max_latency_ms, stats),
+        'label_names': make_name_dict(args.label_csv) if args.label_csv else {},
+    }
+    server = ThreadingHTTPServer((args.host, args.port), InferenceHandler)
+    print('serving on http://{:s}:{:d} with {:s}, max batch size {:d}, max latency {:.1f} ms'.format(args.host, server.server_address[1], str(device), args.max_batch_size, args.max_latency_ms))
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_model_args(parser, model_required=False)
+    parser.add_argument("--label_csv", type=str, default='', help="csv with class labels, used to return label names")
+    parser.add_argument("--ftmode", type=str, default='multimodal', help="the default mode of a request", choices=MODES)
+    parser.add_argument("--loss", type=str, default="BCE", help="the loss the model is finetuned with, sigmoid for BCE, softmax for CE", choices=["BCE", "CE"])
+    parser.add_argument("--dataset_mean", type=float, default=-5.081, help="the dataset mean, used for input normalization")
+    parser.add_argument("--dataset_std", type=float, default=4.4849, help="the dataset std, used for input normalization")
+    parser.add_argument("--im_res", type=int, default=224, help="the image resolution")
+    parser.add_argument("--tome_r", type=str, default=None, help="number of tokens merged per layer (token merging), an int or a comma separated list with one value per layer, None to disable")
+    parser.add_argument("--top_k", type=int, default=5, help="number of top labels returned")
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch_size", type=int, default=32, help="maximum number of requests in a batch")
+    parser.add_argument("--max_latency_ms", type=float, default=10, help="maximum time the first request of a batch waits for more requests")
+    parser.add_argument("--preprocess_workers", type=int, default=4, help="number of preprocessing processes, 0 to preprocess in the request thread")
+    parser.add_argument("--num_threads", type=int, default=0, help="torch intra-op threads, 0 to keep the default")
+    parser.add_argument("--tiny", help='if True, serve a small randomly initialized model on cpu (for testing)', type=ast.literal_eval, default=False)
+    args = parser.parse_args()
+    if args.tiny == True:
+        args.target_length, args.im_res = 128, 32
+    serve(args).serve_forever()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# @Time    : 10/19/26 3:40 PM
+# @Author  : Ben Chou
+# @Affiliation  : Purdue University
+# @Email   : chou150@purdue.edu
+# @File    : long_form.py
+
+# sliding-window tagging of long recordings with a finetuned CAVMAEFT (audioonly / missingaudioonly mode) or CAVMAEFTAudio.
+# the fbank of the whole file is computed once, the overlapping windows of target_length frames are strided views of it
+# (no copy until a batch is moved to the model), and the windows are run through the model in large batches.
+# outputs window-level predictions with timestamps, segment-level predictions (each hop_length segment aggregates the
+# windows covering it) and clip-level predictions, aggregated by mean, max or attention pooling
+# (attention: each window is weighted by softmax over windows of its logit, per class).
+
+import argparse
+import ast
+import json
+import time
+import torch
+import torchaudio
+from torch.cuda.amp import autocast
+from models.audio_mdl import CAVMAEFTAudio
+from model_loader import add_model_args, load_model
+from dataloader import make_name_dict, pad_or_truncate, wav2fbank
+
+# kaldi fbank frame shift in seconds
+FRAME_SHIFT = 0.01
+
+def get_window_starts(n_frames, window_length, hop_length):
+    starts = list(range(0, max(n_frames - window_length, 0) + 1, hop_length))
+    # the last window is aligned to the end of the file, so the tail is covered
+    if n_frames > window_length and starts[-1] + window_length < n_frames:
+        starts.append(n_frames - window_length)
+    return starts
+
+def get_windows(fbank, window_length, hop_length):
+    """
+    Overlapping windows of fbank [n_frames, melbins] as a strided view [n_windows, window_length, melbins]
+    and the start frame of each window. fbank has at least window_length frames, shorter files are padded by load_fbank.
+    """
+    n_frames = fbank.shape[0]
+    starts = get_window_starts(n_frames, window_length, hop_length)
+    regular = fbank.unfold(0, window_length, hop_length).transpose(1, 2)
+    windows = regular
+    if len(starts) > regular.shape[0]:
+        # the end-aligned last window is not on the hop grid, index it separately, still without copying fbank
+        windows = [regular, fbank[starts[-1]:starts[-1] + window_length].unsqueeze(0)]
+    return windows, torch.tensor(starts)
+
+def iter_batches(windows, batch_size):
+    if isinstance(windows, list):
+        for part in windows:
+            yield from iter_batches(part, batch_size)
+        return
+    for i in range(0, windows.shape[0], batch_size):
+        yield windows[i:i + batch_size]
+
+def forward_windows(audio_model, windows, device, batch_size=64, ftmode='audioonly'):
+    # logits of all windows [n_windows, n_class]
+    output = []
+    with torch.no_grad():
+        for batch in iter_batches(windows, batch_size):
+            a = batch.to(device, non_blocking=True)
+            with autocast(enabled=device.type == 'cuda'):
+                if isinstance(audio_model, CAVMAEFTAudio):
+                    logits = audio_model.forward_pred(a, None)
+                else:
+                    logits = audio_model(a, None, ftmode)
+            output.append(logits.float().to('cpu'))
+    return torch.cat(output)
+
+def pool(logits, probs, pooling, temperature=1.0):
+    # aggregate [n, n_class] window predictions over dim 0
+    if pooling == 'mean':
+        return probs.mean(dim=0)
+    elif pooling == 'max':
+        return probs.max(dim=0)[0]
+    elif pooling == 'attention':
+        weights = torch.softmax(logits / temperature, dim=0)
+        return (weights * probs).sum(dim=0)
+    raise ValueError('unknown pooling ' + pooling)
+
+def pool_segments(logits, probs, starts, window_length, hop_length, n_frames, pooling, temperature=1.0):
+    """
+    Segment-level predictions: the file is divided into segments of hop_length frames,
+    each segment aggregates the windows that overlap it. Returns segment start frames and [n_segments, n_class].
+    """
+    seg_starts = torch.arange(0, max(n_frames, 1), hop_length)
+    seg_ends = torch.clamp(seg_starts + hop_length, max=max(n_frames, 1))
+    # windows cover contiguous segment ranges, [n_segments, n_windows]
+    cover = (seg_starts[:, None] < (starts + window_length)[None, :]) & (seg_ends[:, None] > starts[None, :])
+    if pooling == 'mean':
+        cover = cover.float()
+        seg_probs = cover @ probs / cover.sum(dim=1, keepdim=True)
+    elif pooling == 'max':
+        seg_probs = torch.stack([probs[c].max(dim=0)[0] for c in cover])
+    elif pooling == 'attention':
+        # softmax over covering windows, shifted by the global max per class for stability
+        w = torch.exp((logits - logits.max(dim=0, keepdim=True)[0]) / temperature)
+        cover = cover.float()
+        seg_probs = (cover @ (w * probs)) / (cover @ w)
+    else:
+        raise ValueError('unknown pooling ' + pooling)
+    return seg_starts, seg_probs
+
+def tag_fbank(audio_model, fbank, device, window_length=1024, hop_length=512, batch_size=64, pooling='mean', ftmode='audioonly', loss='BCE', temperature=1.0, n_frames=None):
+    """
+    Tag a normalized fbank [n_frames, melbins] of at least window_length frames (see load_fbank). Timestamps are in seconds.
+    n_frames is the length of the file before padding, None if the fbank is not padded.
+    Returns a dict of window / segment / clip predictions.
+    """
+    if n_frames == None:
+        n_frames = fbank.shape[0]
+    windows, starts = get_windows(fbank, window_length, hop_length)
+    logits = forward_windows(audio_model, windows, device, batch_size, ftmode)
+    probs = torch.softmax(logits, dim=-1) if loss == 'CE' else torch.sigmoid(logits)
+    seg_starts, seg_probs = pool_segments(logits, probs, starts, window_length, hop_length, n_frames, pooling, temperature)
+    return {
+        'window_start': (starts * FRAME_SHIFT).tolist(),
+        'window_end': (torch.clamp(starts + window_length, max=n_frames) * FRAME_SHIFT).tolist(),
+        'window_probs': probs,
+        'segment_start': (seg_starts * FRAME_SHIFT).tolist(),
+        'segment_end': (torch.clamp(seg_starts + hop_length, max=n_frames) * FRAME_SHIFT).tolist(),
+        'segment_probs': seg_probs,
+        'clip_probs': pool(logits, probs, pooling, temperature),
+        'duration': n_frames * FRAME_SHIFT,
+    }
+
+def load_fbank(wav_path, window_length=1024, dataset_mean=-5.081, dataset_std=4.4849, melbins=128):
+    """
+    The normalized fbank of the whole file and its number of frames, same preprocessing as dataloader.py in eval mode
+    but never truncated: files shorter than a window are zero padded before normalization, as in the dataloader.
+    """
+    waveform, sr = torchaudio.load(wav_path)
+    fbank = wav2fbank(waveform, sr, melbins)
+    n_frames = fbank.shape[0]
+    if n_frames < window_length:
+        fbank = pad_or_truncate(fbank, window_length)
+    return (fbank - dataset_mean) / dataset_std, n_frames
+
+def tag_file(audio_model, wav_path, device, args):
+    fbank, n_frames = load_fbank(wav_path, args.target_length, args.dataset_mean, args.dataset_std)
+    return tag_fbank(audio_model, fbank, device, args.target_length, args.hop_length, args.batch_size, args.pooling, args.ftmode, args.loss, args.temperature, n_frames)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_model_args(parser)
+    parser.add_argument("--ftmode", type=str, default='audioonly', help="the CAVMAEFT mode", choices=["audioonly", "missingaudioonly"])
+    parser.add_argument("--wav", type=str, nargs='+', required=True, help="the recordings to tag")
+    parser.add_argument("--label_csv", type=str, default='', help="csv with class labels, used to print label names")
+    parser.add_argument("--loss", type=str, default="BCE", help="the loss the model is finetuned with, sigmoid for BCE, softmax for CE", choices=["BCE", "CE"])
+    parser.add_argument("--dataset_mean", type=float, default=-5.081, help="the dataset mean, used for input normalization")
+    parser.add_argument("--dataset_std", type=float, default=4.4849, help="the dataset std, used for input normalization")
+    parser.add_argument("--hop_length", type=int, default=512, help="the window hop in frames, also the segment length")
+    parser.add_argument("--tome_r", type=str, default=None, help="number of tokens merged per layer (token merging), an int or a comma separated list with one value per layer, None to disable")
+    parser.add_argument("--pooling", type=str, default='mean', help="how windows are aggregated", choices=["mean", "max", "attention"])
+    parser.add_argument("--temperature", type=float, default=1.0, help="softmax temperature of attention pooling")
+    parser.add_argument('-b', '--batch_size', default=64, type=int, metavar='N', help='number of windows per forward pass')
+    parser.add_argument("--top_k", type=int, default=5, help="number of top labels printed")
+    parser.add_argument("--save_segments", help='if True, also save segment-level predictions', type=ast.literal_eval, default=True)
+    parser.add_argument("--output", type=str, default='./long_form_result.json', help="where the predictions are saved")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    audio_model = load_model(args, device)[0]
+    label_names = make_name_dict(args.label_csv) if args.label_csv else {}
+    res = {}
+    for wav_path in args.wav:
+        begin_time = time.time()
+        result = tag_file(audio_model, wav_path, device, args)
+        top = torch.argsort(result['clip_probs'], descending=True)[:args.top_k].tolist()
+        print('{:s}: {:.1f} seconds, {:d} windows, tagged in {:.3f} seconds'.format(wav_path, result['duration'], len(result['window_start']), time.time() - begin_time))
+        for i in top:
+            print('  {:s}: {:.4f}'.format(label_names.get(str(i), str(i)), result['clip_probs'][i].item()))
+        out = {'duration': result['duration'], 'clip_probs': result['clip_probs'].tolist(),
+               'window_start': result['window_start'], 'window_end': result['window_end'], 'window_probs': result['window_probs'].tolist()}
+        if args.save_segments == True:
+            out.update({'segment_start': result['segment_start'], 'segment_end': result['segment_end'], 'segment_probs': result['segment_probs'].tolist()})
+        res[wav_path] = out
+    with open(args.output, 'w') as f:
+        json.dump(res, f)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# @Time    : 10/20/26 10:30 AM
+# @Author  : Ben Chou
+# @Affiliation  : Purdue University
+# @Email   : chou150@purdue.edu
+# @File    : model_loader.py
+
+# loads a finetuned checkpoint for the inference / deployment scripts (quantize.py, export.py, benchmark_tome.py,
+# long_form.py, inference_server.py, prune.py). the model is built from a config: the constructor arguments of CAVMAEFT /
+# CAVMAEFTAudio plus model_type, read from model_config.json if given (written next to the checkpoint by run_cavmae_ft.py,
+# run_cavmae_distill.py and prune.py), so pruned (block_config), early-exit (exit_layers) and distilled (embed_dim, depth, ...)
+# checkpoints load the same way as the default 768-dim model with 11 modality-specific layers.
+
+import json
+import torch
+from models.cav_mae import CAVMAEFT
+from models.audio_mdl import CAVMAEFTAudio
+from models.pos_embed import interpolate_pos_embed_audio
+
+def add_model_args(parser, model_type='ft', model_required=True):
+    parser.add_argument("--model", type=str, required=model_required, default=None, help="the finetuned checkpoint, e.g., exp_dir/models/best_audio_model.pth")
+    parser.add_argument("--model_type", type=str, default=model_type, help="ft for CAVMAEFT, audio for CAVMAEFTAudio, model_config.json overrides it", choices=["ft", "audio"])
+    parser.add_argument("--model_config", type=str, default=None, help="model_config.json of the checkpoint, None for the default model with 11 modality-specific layers")
+    parser.add_argument("--n_class", type=int, default=527, help="number of classes, model_config.json overrides it")
+    parser.add_argument("--target_length", type=int, default=1024, help="the input length in frames")
+    parser.add_argument("--pos_embed_method", type=str, default='truncate', help="how the audio positional embedding is resized if target_length differs from the checkpoint", choices=["truncate", "interpolate", "sincos"])
+
+def get_model_config(args):
+    if args.model_config != None:
+        with open(args.model_config, 'r') as f:
+            config = json.load(f)
+    else:
+        config = {'label_dim': args.n_class, 'modality_specific_depth': 11}
+    config.setdefault('model_type', args.model_type)
+    # the positional embedding of the checkpoint is resized to target_length when it is loaded
+    config['audio_length'] = args.target_length
+    return config
+
+def build_model(config):
+    config = dict(config)
+    model_type = config.pop('model_type', 'ft')
+    if model_type == 'audio':
+        return CAVMAEFTAudio(**config)
+    return CAVMAEFT(**config)
+
+def save_model_config(config, path):
+    with open(path, 'w') as f:
+        json.dump(config, f, indent=2)
+
+def load_model(args, device='cpu'):
+    """
+    Build the model of get_model_config(args) and load args.model (DataParallel state dict) strictly.
+    Returns the unwrapped model in eval mode on device and its config.
+    """
+    config = get_model_config(args)
+    audio_model = torch.nn.DataParallel(build_model(config))
+    sdA = torch.load(args.model, map_location='cpu')
+    sdA = interpolate_pos_embed_audio(audio_model, sdA, args.pos_embed_method)
+    msg = audio_model.load_state_dict(sdA, strict=True)
+    print(msg)
+    audio_model = audio_model.module.to(device)
+    audio_model.eval()
+    # token merging, faster cpu inference with a small accuracy loss (see benchmark_tome.py), None if the script has no --tome_r
+    audio_model.tome_r = getattr(args, 'tome_r', None)
+    return audio_model, config
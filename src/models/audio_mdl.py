@@ -16,6 +16,7 @@ import timm
 from timm.models.layers import to_2tuple, trunc_normal_, DropPath
 from timm.models.vision_transformer import Attention, Mlp, PatchEmbed, Block
 from .pos_embed import get_2d_sincos_pos_embed
+from .tome import parse_tome_r, tome_blocks, init_size, weighted_mean
 
 class PatchEmbed(nn.Module):
     def __init__(self, img_size=224, patch_size=16, in_chans=3, embed_dim=768):
@@ -91,6 +92,9 @@ class CAVMAEFTAudio(nn.Module):
 
         self.mlp_head = nn.Sequential(nn.LayerNorm(embed_dim), nn.Linear(embed_dim, label_dim))
 
+        # number of tokens merged per layer at inference (see tome.py), None disables token merging
+        self.tome_r = None
+
         self.initialize_weights()
 
         print('Audio Positional Embedding Shape:', self.pos_embed_a.shape)
@@ -125,6 +129,8 @@ class CAVMAEFTAudio(nn.Module):
 
     # this is to make it compatible with the multomodal-pipeline, v and mode should be dummy values
     def forward_pred(self, a, v, mode='audioonly'):
+            if self.tome_r is not None and self.training == False:
+                return self.forward_tome(a, self.tome_r)
             a = a.unsqueeze(1)
             a = a.transpose(2, 3)
             a = self.patch_embed_a(a)
@@ -142,6 +148,22 @@ class CAVMAEFTAudio(nn.Module):
             x = self.mlp_head(x)
             return x
 
+    # inference with token merging, r tokens are merged in each layer, with r = 0 the output is the same as forward_pred
+    def forward_tome(self, a, r):
+        r = parse_tome_r(r, len(self.blocks_a) + len(self.blocks_u))
+        a = a.unsqueeze(1)
+        a = a.transpose(2, 3)
+        a = self.patch_embed_a(a)
+        a = a + self.pos_embed_a
+        a = a + self.modality_a
+
+        a, size = tome_blocks(self.blocks_a, a, init_size(a), r[:len(self.blocks_a)])
+        a, size = tome_blocks(self.blocks_u, a, size, r[len(self.blocks_a):], 'a')
+        a = self.norm_a(a)
+        x = weighted_mean(a, size)
+        x = self.mlp_head(x)
+        return x
+
     def forward(self, a):
         a = a.unsqueeze(1)
         a = a.transpose(2, 3)
@@ -15,6 +15,7 @@ import timm
 from timm.models.layers import to_2tuple, trunc_normal_, DropPath
 from timm.models.vision_transformer import Attention, Mlp, PatchEmbed, Block
 from .pos_embed import get_2d_sincos_pos_embed
+from .tome import parse_tome_r, tome_blocks, init_size, weighted_mean
 
 
 class PatchEmbed(nn.Module):
@@ -37,6 +38,48 @@ class PatchEmbed(nn.Module):
         return x
 
 
+# attention with some heads removed (see prune.py), the head dimension stays dim // num_heads of the unpruned model,
+# same parameter names as the timm Attention
+class PrunedAttention(nn.Module):
+    def __init__(
+        self,
+        dim,
+        num_heads,
+        head_dim,
+        qkv_bias=False,
+        qk_scale=None,
+        attn_drop=0.0,
+        proj_drop=0.0,
+    ):
+        super().__init__()
+        self.num_heads = num_heads
+        self.head_dim = head_dim
+        self.scale = qk_scale or head_dim**-0.5
+
+        self.qkv = nn.Linear(dim, num_heads * head_dim * 3, bias=qkv_bias)
+        self.attn_drop = nn.Dropout(attn_drop)
+        self.proj = nn.Linear(num_heads * head_dim, dim)
+        self.proj_drop = nn.Dropout(proj_drop)
+
+    def forward(self, x):
+        B, N, C = x.shape
+        qkv = (
+            self.qkv(x)
+            .reshape(B, N, 3, self.num_heads, self.head_dim)
+            .permute(2, 0, 3, 1, 4)
+        )
+        q, k, v = qkv[0], qkv[1], qkv[2]
+
+        attn = (q @ k.transpose(-2, -1)) * self.scale
+        attn = attn.softmax(dim=-1)
+        attn = self.attn_drop(attn)
+
+        x = (attn @ v).transpose(1, 2).reshape(B, N, self.num_heads * self.head_dim)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x
+
+
 class Block(nn.Module):
     def __init__(
         self,
@@ -50,25 +93,40 @@ class Block(nn.Module):
         drop_path=0.0,
         act_layer=nn.GELU,
         norm_layer=nn.LayerNorm,
+        attn_heads=None,
+        mlp_hidden_dim=None,
     ):
         super().__init__()
         self.norm1 = norm_layer(dim)
         self.norm1_a = norm_layer(dim)
         self.norm1_v = norm_layer(dim)
-        self.attn = Attention(
-            dim,
-            num_heads=num_heads,
-            qkv_bias=qkv_bias,
-            qk_scale=qk_scale,
-            attn_drop=attn_drop,
-            proj_drop=drop,
-        )
+        # attn_heads and mlp_hidden_dim are only set for pruned blocks
+        if attn_heads == None:
+            self.attn = Attention(
+                dim,
+                num_heads=num_heads,
+                qkv_bias=qkv_bias,
+                qk_scale=qk_scale,
+                attn_drop=attn_drop,
+                proj_drop=drop,
+            )
+        else:
+            self.attn = PrunedAttention(
+                dim,
+                attn_heads,
+                dim // num_heads,
+                qkv_bias=qkv_bias,
+                qk_scale=qk_scale,
+                attn_drop=attn_drop,
+                proj_drop=drop,
+            )
         # NOTE: drop path for stochastic depth, we shall see if this is better than dropout here
         self.drop_path = DropPath(drop_path) if drop_path > 0.0 else nn.Identity()
         self.norm2 = norm_layer(dim)
         self.norm2_a = norm_layer(dim)
         self.norm2_v = norm_layer(dim)
-        mlp_hidden_dim = int(dim * mlp_ratio)
+        if mlp_hidden_dim == None:
+            mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(
             in_features=dim,
             hidden_features=mlp_hidden_dim,
@@ -89,6 +147,45 @@ class Block(nn.Module):
         return x
 
 
+# the attention heads and mlp hidden units of block name.i of a pruned model, blocks not in block_config are not pruned,
+# e.g., block_config = {"blocks_a.0": {"attn_heads": 10, "mlp_hidden_dim": 2400}, ...}
+def get_block_config(block_config, name, i):
+    if block_config == None:
+        return {}
+    return block_config.get("{:s}.{:d}".format(name, i), {})
+
+
+# used by both CAVMAE (masking in pretraining) and CAVMAEFT (token drop in finetuning)
+def random_masking_unstructured(x, mask_ratio):
+    """
+    Perform per-sample random masking by per-sample shuffling.
+    Per-sample shuffling is done by argsort random noise.
+    x: [N, L, D], sequence
+    """
+    N, L, D = x.shape  # batch, length, dim
+    len_keep = int(L * (1 - mask_ratio))
+
+    noise = torch.rand(N, L, device=x.device)  # noise in [0, 1]
+
+    # sort noise for each sample
+    ids_shuffle = torch.argsort(
+        noise, dim=1
+    )  # ascend: small is keep, large is remove
+    ids_restore = torch.argsort(ids_shuffle, dim=1)
+
+    # keep the first subset
+    ids_keep = ids_shuffle[:, :len_keep]
+    x_masked = torch.gather(x, dim=1, index=ids_keep.unsqueeze(-1).repeat(1, 1, D))
+
+    # generate the binary mask: 0 is keep, 1 is remove
+    mask = torch.ones([N, L], device=x.device)
+    mask[:, :len_keep] = 0
+    # unshuffle to get the binary mask
+    mask = torch.gather(mask, dim=1, index=ids_restore)
+
+    return x_masked, mask, ids_restore
+
+
 # our main proposed model, for pretraining only, for finetuning, use CAVMAEFT class
 class CAVMAE(nn.Module):
     """CAV-MAE Model"""
@@ -329,33 +426,7 @@ class CAVMAE(nn.Module):
         return imgs
 
     def random_masking_unstructured(self, x, mask_ratio):
-        """
-        Perform per-sample random masking by per-sample shuffling.
-        Per-sample shuffling is done by argsort random noise.
-        x: [N, L, D], sequence
-        """
-        N, L, D = x.shape  # batch, length, dim
-        len_keep = int(L * (1 - mask_ratio))
-
-        noise = torch.rand(N, L, device=x.device)  # noise in [0, 1]
-
-        # sort noise for each sample
-        ids_shuffle = torch.argsort(
-            noise, dim=1
-        )  # ascend: small is keep, large is remove
-        ids_restore = torch.argsort(ids_shuffle, dim=1)
-
-        # keep the first subset
-        ids_keep = ids_shuffle[:, :len_keep]
-        x_masked = torch.gather(x, dim=1, index=ids_keep.unsqueeze(-1).repeat(1, 1, D))
-
-        # generate the binary mask: 0 is keep, 1 is remove
-        mask = torch.ones([N, L], device=x.device)
-        mask[:, :len_keep] = 0
-        # unshuffle to get the binary mask
-        mask = torch.gather(mask, dim=1, index=ids_restore)
-
-        return x_masked, mask, ids_restore
+        return random_masking_unstructured(x, mask_ratio)
 
     def random_masking_structured(self, x, mask_ratio, t=64, f=8, mode="time"):
         """
@@ -730,6 +801,11 @@ class CAVMAEFT(nn.Module):
         norm_layer=nn.LayerNorm,
         norm_pix_loss=False,
         tr_pos=True,
+        token_keep_a=1.0,
+        token_keep_v=1.0,
+        depth=12,
+        block_config=None,
+        exit_layers=None,
     ):
         super().__init__()
         timm.models.vision_transformer.Block = Block
@@ -748,6 +824,14 @@ class CAVMAEFT(nn.Module):
             )
         )
 
+        # fraction of audio / visual tokens kept in training (FLIP-style token drop), all tokens are used in eval mode
+        self.token_keep_a = token_keep_a
+        self.token_keep_v = token_keep_v
+        # number of tokens merged per layer at inference (int, list or string, see tome.py), None disables token merging
+        self.tome_r = None
+        # the pruned blocks (see prune.py), None for the full model
+        self.block_config = block_config
+
         self.modality_a = nn.Parameter(torch.zeros(1, 1, embed_dim))
         self.modality_v = nn.Parameter(torch.zeros(1, 1, embed_dim))
 
@@ -769,6 +853,7 @@ class CAVMAEFT(nn.Module):
                     qkv_bias=True,
                     qk_scale=None,
                     norm_layer=norm_layer,
+                    **get_block_config(block_config, "blocks_a", i),
                 )
                 for i in range(modality_specific_depth)
             ]
@@ -782,6 +867,7 @@ class CAVMAEFT(nn.Module):
                     qkv_bias=True,
                     qk_scale=None,
                     norm_layer=norm_layer,
+                    **get_block_config(block_config, "blocks_v", i),
                 )
                 for i in range(modality_specific_depth)
             ]
@@ -795,8 +881,9 @@ class CAVMAEFT(nn.Module):
                     qkv_bias=True,
                     qk_scale=None,
                     norm_layer=norm_layer,
+                    **get_block_config(block_config, "blocks_u", i),
                 )
-                for i in range(12 - modality_specific_depth)
+                for i in range(depth - modality_specific_depth)
             ]
         )
 
@@ -808,6 +895,17 @@ class CAVMAEFT(nn.Module):
             nn.LayerNorm(embed_dim), nn.Linear(embed_dim, label_dim)
         )
 
+        # early exit, an auxiliary head after each of the exit_layers first layers of blocks_a / blocks_v, empty if not used
+        self.exit_layers = [] if exit_layers == None else list(exit_layers)
+        if any(layer < 1 or layer > modality_specific_depth for layer in self.exit_layers):
+            raise ValueError("exit layers must be in [1, {:d}]".format(modality_specific_depth))
+        self.exit_heads = nn.ModuleList(
+            [
+                nn.Sequential(nn.LayerNorm(embed_dim), nn.Linear(embed_dim, label_dim))
+                for layer in self.exit_layers
+            ]
+        )
+
         self.initialize_weights()
 
         print("Audio Positional Embedding Shape:", self.pos_embed_a.shape)
@@ -857,25 +955,120 @@ class CAVMAEFT(nn.Module):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
 
-    def forward(self, a, v, mode):
-        # multi-modal fine-tuning, our default method for fine-tuning
-        if mode == "multimodal":
+    def random_token_drop(self, x, keep_ratio):
+        """
+        Keep a random keep_ratio of the tokens of each sample, the same per-sample shuffling as the masking in pretraining.
+        Only applied in training mode, all tokens are kept in eval mode.
+        x: [N, L, D], sequence
+        """
+        if self.training == False or keep_ratio >= 1.0:
+            return x
+        x_kept, _, _ = random_masking_unstructured(x, 1.0 - keep_ratio)
+        return x_kept
+
+    def forward_embed(self, a, v, mode):
+        """
+        Patch embedding of the modalities used by mode, None for the unused modality.
+        In training mode only token_keep_a / token_keep_v of the tokens are kept (in random order).
+        """
+        if mode in ["multimodal", "audioonly", "missingaudioonly"]:
             a = a.unsqueeze(1)
             a = a.transpose(2, 3)
             a = self.patch_embed_a(a)
             a = a + self.pos_embed_a
             a = a + self.modality_a
+            a = self.random_token_drop(a, self.token_keep_a)
+        else:
+            a = None
 
+        if mode in ["multimodal", "videoonly", "missingvideoonly"]:
             v = self.patch_embed_v(v)
             v = v + self.pos_embed_v
             v = v + self.modality_v
+            v = self.random_token_drop(v, self.token_keep_v)
+        else:
+            v = None
+        return a, v
 
-            for blk in self.blocks_a:
+    def forward_specific_blocks(self, a, v, start, end):
+        # layers [start, end) of blocks_a / blocks_v, skipped for the unused (None) modality
+        if a is not None:
+            for blk in self.blocks_a[start:end]:
                 a = blk(a)
-
-            for blk in self.blocks_v:
+        if v is not None:
+            for blk in self.blocks_v[start:end]:
                 v = blk(v)
+        return a, v
+
+    def forward_modality_specific(self, a, v, mode):
+        """
+        Patch embedding and the modality-specific blocks (blocks_a, blocks_v) of the modalities used by mode.
+        Returns the token sequences a: [B, 512, 768] and v: [B, 196, 768], None for the unused modality.
+        In training mode only token_keep_a / token_keep_v of the tokens are kept (in random order).
+        The output is the input of forward_unified, it does not depend on blocks_u or mlp_head.
+        """
+        a, v = self.forward_embed(a, v, mode)
+        return self.forward_specific_blocks(a, v, 0, len(self.blocks_a))
+
+    def forward_exit_head(self, a, v, k):
+        # exit head k on the mean of all tokens, as the pooling of forward_unified
+        x = torch.cat([x for x in [a, v] if x is not None], dim=1)
+        return self.exit_heads[k](x.mean(dim=1))
 
+    def forward_exits(self, a, v, mode):
+        """
+        Joint training of the exit heads, the whole model is run.
+        Returns the logits of mlp_head [B, label_dim] and of the exit heads [B, len(exit_layers), label_dim].
+        """
+        a, v = self.forward_embed(a, v, mode)
+        exit_output, start = [], 0
+        for k, layer in enumerate(self.exit_layers):
+            a, v = self.forward_specific_blocks(a, v, start, layer)
+            exit_output.append(self.forward_exit_head(a, v, k))
+            start = layer
+        a, v = self.forward_specific_blocks(a, v, start, len(self.blocks_a))
+        x = self.mlp_head(self.forward_unified(a, v, mode))
+        return x, torch.stack(exit_output, dim=1)
+
+    def forward_early_exit(self, a, v, mode, threshold, softmax=False):
+        """
+        Early-exit inference, a sample exits at the first exit head whose max class probability (sigmoid, or softmax if
+        softmax is True) reaches threshold, the remaining samples continue through the model.
+        Returns the logits [B, label_dim] (float32) and the number of layers used per sample [B].
+        With threshold > 1 no sample exits and the output is the same as forward.
+        """
+        a, v = self.forward_embed(a, v, mode)
+        x = a if a is not None else v
+        num_layers = len(self.blocks_a) + len(self.blocks_u)
+        output = torch.zeros(x.shape[0], self.mlp_head[-1].out_features, device=x.device)
+        layers = torch.full((x.shape[0],), num_layers, dtype=torch.long, device=x.device)
+        # the samples still running
+        index = torch.arange(x.shape[0], device=x.device)
+        start = 0
+        for k, layer in enumerate(self.exit_layers):
+            a, v = self.forward_specific_blocks(a, v, start, layer)
+            start = layer
+            logits = self.forward_exit_head(a, v, k)
+            prob = logits.softmax(dim=-1) if softmax == True else logits.sigmoid()
+            done = prob.max(dim=-1).values >= threshold
+            output[index[done]] = logits[done].float()
+            layers[index[done]] = layer
+            index = index[~done]
+            if index.shape[0] == 0:
+                return output, layers
+            a = a[~done] if a is not None else None
+            v = v[~done] if v is not None else None
+        a, v = self.forward_specific_blocks(a, v, start, len(self.blocks_a))
+        output[index] = self.mlp_head(self.forward_unified(a, v, mode)).float()
+        return output, layers
+
+    def forward_unified(self, a, v, mode):
+        """
+        The modality-sharing blocks_u, normalization and mean pooling.
+        Returns the pooled representation [B, 768] that is fed to mlp_head.
+        """
+        # multi-modal fine-tuning, our default method for fine-tuning
+        if mode == "multimodal":
             x = torch.cat((a, v), dim=1)
 
             for blk in self.blocks_u:
@@ -883,56 +1076,28 @@ class CAVMAEFT(nn.Module):
             x = self.norm(x)
 
             x = x.mean(dim=1)
-            x = self.mlp_head(x)
             return x
 
         # finetune with only audio (and inference with only audio when the model is finetuned with only audio)
         elif mode == "audioonly":
-            a = a.unsqueeze(1)
-            a = a.transpose(2, 3)
-            a = self.patch_embed_a(a)
-            a = a + self.pos_embed_a
-            a = a + self.modality_a
-
-            for blk in self.blocks_a:
-                a = blk(a)
-
             # note here uses the 'a' normalization, it is used in both training and inference, so it is fine
             for blk in self.blocks_u:
                 a = blk(a, "a")
             a = self.norm_a(a)
             x = a.mean(dim=1)
-            x = self.mlp_head(x)
             return x
 
         # finetune with only image (and inference with only audio when the model is finetuned with only image)
         elif mode == "videoonly":
-            v = self.patch_embed_v(v)
-            v = v + self.pos_embed_v
-            v = v + self.modality_v
-
-            for blk in self.blocks_v:
-                v = blk(v)
-
             # note here uses the 'v' normalization, it is used in both training and inference, so it is fine
             for blk in self.blocks_u:
                 v = blk(v, "v")
             v = self.norm_v(v)
             x = v.mean(dim=1)
-            x = self.mlp_head(x)
             return x
 
         # used in case that the model is finetuned with both modality, but in inference only audio is given
         elif mode == "missingaudioonly":
-            a = a.unsqueeze(1)
-            a = a.transpose(2, 3)
-            a = self.patch_embed_a(a)
-            a = a + self.pos_embed_a
-            a = a + self.modality_a
-
-            for blk in self.blocks_a:
-                a = blk(a)
-
             # two forward passes to the block_u, one with modality-specific normalization, another with unified normalization
             u = a
             for blk in self.blocks_u:
@@ -947,18 +1112,10 @@ class CAVMAEFT(nn.Module):
 
             # average the output of the two forward passes
             x = (u + a) / 2
-            x = self.mlp_head(x)
             return x
 
         # used in case that the model is fine-tuned with both modality, but in inference only image is given
         elif mode == "missingvideoonly":
-            v = self.patch_embed_v(v)
-            v = v + self.pos_embed_v
-            v = v + self.modality_v
-
-            for blk in self.blocks_v:
-                v = blk(v)
-
             # two forward passes to the block_u, one with modality-specific normalization, another with unified normalization
             u = v
             for blk in self.blocks_u:
@@ -973,9 +1130,89 @@ class CAVMAEFT(nn.Module):
 
             # average the output of the two forward passes
             x = (u + v) / 2
-            x = self.mlp_head(x)
             return x
 
+    def forward_multiframe(self, a, v, mode):
+        """
+        Multi-frame evaluation, a: [B, 1024, 128], v: all frames of each clip [B, F, 3, 224, 224].
+        blocks_a runs once per clip, blocks_v runs on all B*F frames as one batch, blocks_u runs per frame.
+        Returns the logits of each frame [B, F, label_dim], the same as calling forward with each frame.
+        """
+        B, F = v.shape[0], v.shape[1]
+        a, v = self.forward_modality_specific(a, v.reshape(B * F, *v.shape[2:]), mode)
+        if v is None:
+            # audio only modes, the prediction does not depend on the frame
+            x = self.mlp_head(self.forward_unified(a, v, mode))
+            return x.unsqueeze(1).expand(-1, F, -1)
+        if a is not None:
+            a = a.unsqueeze(1).expand(-1, F, -1, -1).reshape(B * F, a.shape[1], a.shape[2])
+        x = self.forward_unified(a, v, mode)
+        x = self.mlp_head(x)
+        return x.reshape(B, F, -1)
+
+    def forward_tome(self, a, v, mode, r):
+        """
+        Inference with token merging, r tokens of each modality are merged in each layer (see tome.py).
+        r is parsed by parse_tome_r, a list has one value per layer, blocks_a and blocks_v use the same values.
+        With r = 0 the output is the same as forward.
+        """
+        r = parse_tome_r(r, len(self.blocks_a) + len(self.blocks_u))
+        r_s, r_u = r[: len(self.blocks_a)], r[len(self.blocks_a) :]
+        if mode in ["multimodal", "audioonly", "missingaudioonly"]:
+            a = a.unsqueeze(1)
+            a = a.transpose(2, 3)
+            a = self.patch_embed_a(a)
+            a = a + self.pos_embed_a
+            a = a + self.modality_a
+            a, size_a = tome_blocks(self.blocks_a, a, init_size(a), r_s)
+
+        if mode in ["multimodal", "videoonly", "missingvideoonly"]:
+            v = self.patch_embed_v(v)
+            v = v + self.pos_embed_v
+            v = v + self.modality_v
+            v, size_v = tome_blocks(self.blocks_v, v, init_size(v), r_s)
+
+        if mode == "multimodal":
+            x, size = tome_blocks(
+                self.blocks_u, torch.cat((a, v), dim=1), torch.cat((size_a, size_v), dim=1), r_u
+            )
+            x = weighted_mean(self.norm(x), size)
+        else:
+            x, size, modality = (a, size_a, "a") if mode in ["audioonly", "missingaudioonly"] else (v, size_v, "v")
+            norm = getattr(self, "norm_" + modality)
+            if mode in ["audioonly", "videoonly"]:
+                x, size = tome_blocks(self.blocks_u, x, size, r_u, modality)
+                x = weighted_mean(norm(x), size)
+            else:
+                # two forward passes to the block_u, one with unified normalization, another with modality-specific normalization
+                u, size_u = tome_blocks(self.blocks_u, x, size, r_u)
+                u = weighted_mean(self.norm(u), size_u)
+                x, size = tome_blocks(self.blocks_u, x, size, r_u, modality)
+                x = weighted_mean(norm(x), size)
+                x = (u + x) / 2
+        x = self.mlp_head(x)
+        return x
+
+    def forward(self, a, v, mode, feature_level=None):
+        # feature_level is only set when training from a feature cache (see feature_cache.py)
+        # 'pooled': a is the cached output of forward_unified, only mlp_head is run
+        # 'token': a, v are the cached output of forward_modality_specific, blocks_u and mlp_head are run
+        if feature_level == "pooled":
+            return self.mlp_head(a)
+        # all frames of each clip are given (dataset built with multi_frame=True), returns [B, F, label_dim]
+        if feature_level == None and v is not None and v.dim() == 5:
+            return self.forward_multiframe(a, v, mode)
+        if feature_level == None and self.tome_r is not None and self.training == False:
+            return self.forward_tome(a, v, mode, self.tome_r)
+        # with exit heads, training returns the logits of mlp_head and of the exit heads (see forward_exits)
+        if feature_level == None and len(self.exit_layers) > 0 and self.training == True:
+            return self.forward_exits(a, v, mode)
+        if feature_level != "token":
+            a, v = self.forward_modality_specific(a, v, mode)
+        x = self.forward_unified(a, v, mode)
+        x = self.mlp_head(x)
+        return x
+
     # for retrieval
     def forward_feat(self, a, v, mode="av"):
         # return both audio and visual
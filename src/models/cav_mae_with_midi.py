@@ -120,11 +120,17 @@ class CAVMAE(nn.Module):
         norm_layer=nn.LayerNorm,
         norm_pix_loss=False,
         tr_pos=False,
+        skip_missing=False,
     ):
         super().__init__()
         print("A CAV-MAE Model")
         print("Use norm_pix_loss: ", norm_pix_loss)
         print("Learnable Positional Embedding: ", tr_pos)
+        # skip_missing=True: samples without a modality skip its encoder / decoder compute and the shared blocks only attend
+        # over the modalities a sample has, this changes the losses of batches that mix complete and incomplete samples.
+        # False keeps the full joint attention over all (filled) inputs.
+        self.skip_missing = skip_missing
+        print("Skip missing modalities: ", skip_missing)
 
         # the encoder part
         # overide the timm package
@@ -373,6 +379,30 @@ class CAVMAE(nn.Module):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
 
+    def set_input_size(self, audio_length, img_size):
+        """
+        Change the audio / piano-roll length and the image size the model takes, used by the progressive pretraining schedule.
+        The fixed sin-cos positional embeddings (encoder and decoder) are regenerated for the new patch grids,
+        audio: 8 x audio_length / 16, image: img_size / 16 x img_size / 16. Only for tr_pos=False.
+        """
+        if self.pos_embed_a1.requires_grad:
+            raise ValueError("learnable positional embeddings (tr_pos=True) can not be regenerated for another input size")
+        self.patch_embed_a1.num_patches = int(audio_length * 128 / 256)
+        self.patch_embed_a2.num_patches = int(audio_length * 128 / 256)
+        self.patch_embed_v.num_patches = (img_size // self.patch_embed_v.patch_size[0]) ** 2
+        grids = {
+            "a1": (8, self.patch_embed_a1.num_patches // 8),
+            "a2": (8, self.patch_embed_a2.num_patches // 8),
+            "v": (img_size // self.patch_embed_v.patch_size[0], img_size // self.patch_embed_v.patch_size[0]),
+        }
+        for modality, grid in grids.items():
+            for name in ["pos_embed_" + modality, "decoder_pos_embed_" + modality]:
+                param = getattr(self, name)
+                if param.shape[1] != grid[0] * grid[1]:
+                    # replace the data of the same parameter, so optimizer / DDP references stay valid
+                    pos_embed = get_2d_sincos_pos_embed(param.shape[-1], grid[0], grid[1], cls_token=False)
+                    param.data = torch.from_numpy(pos_embed).float().unsqueeze(0).to(param.device)
+
     def patchify(self, imgs, c, h, w, p=16):
         """
         imgs: (N, 3, H, W)
@@ -475,6 +505,75 @@ class CAVMAE(nn.Module):
 
         return x_masked, mask, ids_restore
 
+    def get_valid_samples_mask(self, x, fill_value=0.01, tolerance=1e-6):
+        """
+        Samples with a missing modality are filled with fill_value by the dataloader, with skip_missing in its audio_conf
+        the fill value is restored after normalization, SpecAug and noise (see MISSING_FILL in dataloader_piano_roll.py /
+        dataloader_midi.py), otherwise only inputs that are not normalized keep it.
+        x: [N, ...], returns a [N] bool mask, True for samples that actually have the modality
+        """
+        missing = (torch.abs(x - fill_value) < tolerance).flatten(1).all(dim=1)
+        return ~missing
+
+    def forward_present(self, x, blocks, valid=None, modality=None):
+        """
+        Run the modality-specific blocks only on the samples that have the modality.
+        x: [N, L, D], valid: [N] bool mask (None means all samples are valid)
+        Absent samples are returned as zeros, they are filtered out of every loss anyway.
+        """
+        if valid is None or bool(valid.all()):
+            for blk in blocks:
+                x = blk(x, modality)
+            return x
+
+        if not bool(valid.any()):
+            return torch.zeros_like(x)
+        h = x[valid]
+        for blk in blocks:
+            h = blk(h, modality)
+        # allocate after the blocks so the output follows the autocast dtype
+        out = h.new_zeros((x.shape[0],) + h.shape[1:])
+        out[valid] = h
+        return out
+
+    def forward_present_joint(self, x, blocks, norm, seg_lens, valid_masks=None):
+        """
+        Run shared blocks over a concatenated multi-modal sequence x: [N, sum(seg_lens), D],
+        where seg_lens gives the number of tokens of each modality segment.
+        Samples are grouped by which modalities they have (e.g., audioset has no midi, cocochorals has no video),
+        and each group only attends over the segments of its present modalities. Absent segments are returned as zeros.
+        """
+        if valid_masks is None or all(m is None or bool(m.all()) for m in valid_masks):
+            for blk in blocks:
+                x = blk(x)
+            return norm(x)
+
+        valid = torch.stack(
+            [
+                torch.ones(x.shape[0], dtype=torch.bool, device=x.device) if m is None else m
+                for m in valid_masks
+            ],
+            dim=1,
+        )  # [N, num_modality]
+        patterns, group = torch.unique(valid, dim=0, return_inverse=True)
+        segs = torch.split(torch.arange(x.shape[1], device=x.device), seg_lens)
+
+        out = None
+        for g, pattern in enumerate(patterns.tolist()):
+            # no modality at all, nothing to compute
+            if not any(pattern):
+                continue
+            rows = torch.nonzero(group == g, as_tuple=True)[0]
+            cols = torch.cat([seg for seg, present in zip(segs, pattern) if present])
+            h = x[rows][:, cols]
+            for blk in blocks:
+                h = blk(h)
+            h = norm(h)
+            if out is None:
+                out = h.new_zeros(x.shape)
+            out[rows.unsqueeze(1), cols.unsqueeze(0)] = h
+        return torch.zeros_like(x) if out is None else out
+
     def forward_encoder(
         self,
         a1,
@@ -484,6 +583,9 @@ class CAVMAE(nn.Module):
         mask_ratio_a2,
         mask_ratio_v,
         mask_mode="unstructured",
+        valid_a1=None,
+        valid_a2=None,
+        valid_v=None,
     ):
         # embed patches
         a1 = a1.unsqueeze(1)
@@ -510,7 +612,7 @@ class CAVMAE(nn.Module):
         # in ablation study, we tried time/freq/tf masking. mode in ['freq', 'time', 'tf']
         else:
             a1, mask_a1, ids_restore_a1 = self.random_masking_structured(
-                a1, mask_ratio_a1, t=64, f=8, mode=mask_mode
+                a1, mask_ratio_a1, t=self.patch_embed_a1.num_patches // 8, f=8, mode=mask_mode
             )
 
         if mask_mode == "unstructured":
@@ -520,41 +622,40 @@ class CAVMAE(nn.Module):
         # in ablation study, we tried time/freq/tf masking. mode in ['freq', 'time', 'tf']
         else:
             a2, mask_a2, ids_restore_a2 = self.random_masking_structured(
-                a2, mask_ratio_a2, t=64, f=8, mode=mask_mode
+                a2, mask_ratio_a2, t=self.patch_embed_a2.num_patches // 8, f=8, mode=mask_mode
             )
 
         # visual branch always use unstructured masking
         v, mask_v, ids_restore_v = self.random_masking_unstructured(v, mask_ratio_v)
 
         # audio and visual stream, independent blocks
-        for blk in self.blocks_a1:
-            a1 = blk(a1)
+        # only samples that have the modality go through its branch, absent ones stay as zeros
+        a1 = self.forward_present(a1, self.blocks_a1, valid_a1)
 
         # Apply transformer blocks to the second audio stream
-        for blk in self.blocks_a2:
-            a2 = blk(a2)
+        a2 = self.forward_present(a2, self.blocks_a2, valid_a2)
 
-        for blk in self.blocks_v:
-            v = blk(v)
+        v = self.forward_present(v, self.blocks_v, valid_v)
 
         x = torch.cat((a1, a2, v), dim=1)
 
         # unified stream, shared blocks_u, but independent normalization layers
-        for blk in self.blocks_u:
-            x = blk(x)
-        x = self.norm(x)
+        # each sample only attends over the modalities it has
+        x = self.forward_present_joint(
+            x,
+            self.blocks_u,
+            self.norm,
+            [a1.shape[1], a2.shape[1], v.shape[1]],
+            [valid_a1, valid_a2, valid_v],
+        )
 
-        for blk in self.blocks_u:
-            ca1 = blk(a1, "a1")
-        ca1 = self.norm_a1(ca1)
+        # as in the original loop (ca1 = blk(a1, "a1") for each blk), every block is applied to the input and only the
+        # output of the last block is kept, so only the last block is run (the same as chaining when blocks_u has depth 1)
+        ca1 = self.norm_a1(self.forward_present(a1, self.blocks_u[-1:], valid_a1, "a1"))
 
-        for blk in self.blocks_u:
-            ca2 = blk(a2, "a2")
-        ca2 = self.norm_a2(ca2)
+        ca2 = self.norm_a2(self.forward_present(a2, self.blocks_u[-1:], valid_a2, "a2"))
 
-        for blk in self.blocks_u:
-            cv = blk(v, "v")
-        cv = self.norm_v(cv)
+        cv = self.norm_v(self.forward_present(v, self.blocks_u[-1:], valid_v, "v"))
 
         return (
             x,
@@ -570,7 +671,17 @@ class CAVMAE(nn.Module):
         )
 
     def forward_decoder(
-        self, x, mask_a1, ids_restore_a1, mask_a2, ids_restore_a2, mask_v, ids_restore_v
+        self,
+        x,
+        mask_a1,
+        ids_restore_a1,
+        mask_a2,
+        ids_restore_a2,
+        mask_v,
+        ids_restore_v,
+        valid_a1=None,
+        valid_a2=None,
+        valid_v=None,
     ):
         x = self.decoder_embed(x)
 
@@ -662,10 +773,18 @@ class CAVMAE(nn.Module):
             + self.decoder_modality_v
         )
 
-        # apply Transformer blocks
-        for blk in self.decoder_blocks:
-            x = blk(x)
-        x = self.decoder_norm(x)
+        # apply Transformer blocks, each sample only decodes the modalities it has
+        x = self.forward_present_joint(
+            x,
+            self.decoder_blocks,
+            self.decoder_norm,
+            [
+                self.patch_embed_a1.num_patches,
+                self.patch_embed_a2.num_patches,
+                self.patch_embed_v.num_patches,
+            ],
+            [valid_a1, valid_a2, valid_v],
+        )
 
         # predictor projection
         x_a1 = self.decoder_pred_a1(x[:, : self.patch_embed_a1.num_patches, :])
@@ -846,34 +965,15 @@ class CAVMAE(nn.Module):
         # TODO: define how missing samples filled with 0.01 will be dealt with.
 
         # Check if audio1, audio2, and imgs are not all 0.01 (within tolerance)
-        tolerance = 1e-6
-
-        # Create masks for each modality
-        valid_samples_mask_audio1 = [
-            not torch.all(torch.abs(a1 - 0.01) < tolerance) for a1 in audio1
-        ]
-        valid_samples_mask_audio2 = [
-            not torch.all(torch.abs(a2 - 0.01) < tolerance) for a2 in audio2
-        ]
-        valid_samples_mask_imgs = [
-            not torch.all(torch.abs(img - 0.01) < tolerance) for img in imgs
-        ]
-        # valid_samples_mask_audio1 = ~(audio1 == 0).all(dim=1).all(dim=1)
-        # valid_samples_mask_audio2 = ~(audio2 == 0).all(dim=1).all(dim=1)
-        # valid_samples_mask_imgs = ~(imgs == 0).all(dim=1).all(dim=1).all(dim=1)
-
-        # print(valid_samples_mask_imgs)
-
-        # Convert lists to tensors
-        valid_samples_mask_audio1 = torch.tensor(
-            valid_samples_mask_audio1, dtype=torch.bool, device=audio1.device
-        )
-        valid_samples_mask_audio2 = torch.tensor(
-            valid_samples_mask_audio2, dtype=torch.bool, device=audio1.device
-        )
-        valid_samples_mask_imgs = torch.tensor(
-            valid_samples_mask_imgs, dtype=torch.bool, device=audio1.device
-        )
+        # Create masks for each modality, computed on device in one pass over the batch
+        valid_samples_mask_audio1 = self.get_valid_samples_mask(audio1)
+        valid_samples_mask_audio2 = self.get_valid_samples_mask(audio2)
+        valid_samples_mask_imgs = self.get_valid_samples_mask(imgs)
+        # the encoder / decoder only skip absent modalities with skip_missing, the masks always filter the losses
+        if self.skip_missing:
+            valid_a1, valid_a2, valid_v = valid_samples_mask_audio1, valid_samples_mask_audio2, valid_samples_mask_imgs
+        else:
+            valid_a1, valid_a2, valid_v = None, None, None
 
         # Encoding with two audio inputs
         (
@@ -895,6 +995,9 @@ class CAVMAE(nn.Module):
             mask_ratio_a2,
             mask_ratio_v,
             mask_mode=mask_mode,
+            valid_a1=valid_a1,
+            valid_a2=valid_a2,
+            valid_v=valid_v,
         )
         # if mae loss is used
         # Decoding and loss calculation for two audio inputs
@@ -907,6 +1010,9 @@ class CAVMAE(nn.Module):
                 ids_restore_a2,
                 mask_v,
                 ids_restore_v,
+                valid_a1=valid_a1,
+                valid_a2=valid_a2,
+                valid_v=valid_v,
             )
             bs_a1, loss_mae_a1 = self.forward_mae_loss(
                 audio1, pred_a1, mask_a1, "a1", valid_samples_mask_audio1
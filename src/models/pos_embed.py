@@ -121,3 +121,64 @@ def interpolate_pos_embed(model, checkpoint_model):
             pos_tokens = pos_tokens.permute(0, 2, 3, 1).flatten(1, 2)
             new_pos_embed = torch.cat((extra_tokens, pos_tokens), dim=1)
             checkpoint_model["pos_embed"] = new_pos_embed
+
+
+# --------------------------------------------------------
+# Rectangular grids (the audio / piano-roll patch grid is 8 x T, 8 frequency patches and T = target_length / 16 time patches)
+# --------------------------------------------------------
+def resize_pos_embed(pos_embed, orig_grid, new_grid, method="interpolate"):
+    """
+    Resize a [1, orig_h * orig_w, D] positional embedding (row-major grid, no extra tokens) to new_grid (h, w).
+    method: 'interpolate' bicubic interpolation, 'sincos' regenerate the fixed 2d sin-cos embedding,
+    'truncate' keep the top-left new_h x new_w positions (only for a smaller grid, the same as 'sincos' for a sin-cos embedding).
+    """
+    orig_h, orig_w = orig_grid
+    new_h, new_w = new_grid
+    if (orig_h, orig_w) == (new_h, new_w):
+        return pos_embed
+    embedding_size = pos_embed.shape[-1]
+    if method == "sincos":
+        new_pos_embed = get_2d_sincos_pos_embed(embedding_size, new_h, new_w, cls_token=False)
+        return torch.from_numpy(new_pos_embed).to(pos_embed).unsqueeze(0)
+    pos_tokens = pos_embed.reshape(-1, orig_h, orig_w, embedding_size)
+    if method == "truncate":
+        if new_h > orig_h or new_w > orig_w:
+            raise ValueError("can not truncate a %dx%d grid to %dx%d" % (orig_h, orig_w, new_h, new_w))
+        return pos_tokens[:, :new_h, :new_w].flatten(1, 2).contiguous()
+    elif method == "interpolate":
+        pos_tokens = pos_tokens.permute(0, 3, 1, 2).float()
+        pos_tokens = torch.nn.functional.interpolate(
+            pos_tokens, size=(new_h, new_w), mode="bicubic", align_corners=False
+        )
+        return pos_tokens.permute(0, 2, 3, 1).flatten(1, 2).to(pos_embed.dtype)
+    raise ValueError("unknown method " + method)
+
+
+def interpolate_pos_embed_audio(model, checkpoint_model, method="interpolate", freq_size=8):
+    """
+    Resize the audio and piano-roll / midi positional embeddings (pos_embed_a*, decoder_pos_embed_a*) of a checkpoint
+    to the audio length of model, e.g., a checkpoint pretrained with 1024 frames (8 x 64 patches) for a model built with
+    audio_length=512 (8 x 32 patches). Only the time axis is resized. checkpoint_model is modified in place,
+    keys with or without the DataParallel 'module.' prefix are matched to the model.
+    """
+    model_state = model.state_dict()
+    for key in list(checkpoint_model.keys()):
+        name = key[len("module."):] if key.startswith("module.") else key
+        if not (name.startswith("pos_embed_a") or name.startswith("decoder_pos_embed_a")):
+            continue
+        model_key = [k for k in [key, name, "module." + name] if k in model_state]
+        if len(model_key) == 0:
+            continue
+        orig_num, new_num = checkpoint_model[key].shape[-2], model_state[model_key[0]].shape[-2]
+        if orig_num != new_num:
+            print(
+                "Position interpolate %s from %dx%d to %dx%d (%s)"
+                % (name, freq_size, orig_num // freq_size, freq_size, new_num // freq_size, method)
+            )
+            checkpoint_model[key] = resize_pos_embed(
+                checkpoint_model[key],
+                (freq_size, orig_num // freq_size),
+                (freq_size, new_num // freq_size),
+                method,
+            )
+    return checkpoint_model
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# @Time    : 10/19/26 6:10 PM
+# @Author  : Ben Chou
+# @Affiliation  : Purdue University
+# @Email   : chou150@purdue.edu
+# @File    : tome.py
+
+# token merging (ToMe, Bolya et al. 2023) for faster inference of the finetuned models, no retraining needed.
+# after the attention of a block, r tokens are merged into their most similar tokens by bipartite soft matching
+# (similarity of the attention keys), the merged token is the size weighted average of its source tokens.
+# each token keeps its size (number of patches it represents), the attention is size weighted (proportional attention,
+# log(size) is added to the attention logits), and the final mean pooling is size weighted,
+# so a merged token counts as the tokens it replaced.
+
+import torch
+
+def parse_tome_r(r, num_layers):
+    """
+    Number of tokens merged in each layer. r is an int (the same for all layers), a list with one value per layer,
+    or a string of either form, e.g., '16' or '32,32,16,16,8,8,0,0,0,0,0,0'.
+    """
+    if isinstance(r, str):
+        r = [int(x) for x in r.split(',')]
+        r = r[0] if len(r) == 1 else r
+    if isinstance(r, int):
+        return [r] * num_layers
+    if len(r) != num_layers:
+        raise ValueError('tome r has {:d} values, the model has {:d} layers'.format(len(r), num_layers))
+    return list(r)
+
+def bipartite_soft_matching(metric, r):
+    """
+    metric: [B, N, C], the token similarity metric (the mean attention key over heads).
+    Tokens are split into two alternating sets, each token of the first set is matched with its most similar token
+    of the second set, and the r most similar pairs are merged. Returns the merge function of [B, N, C] tensors.
+    """
+    t = metric.shape[1]
+    r = min(r, t // 2)
+    if r <= 0:
+        return None
+
+    with torch.no_grad():
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = metric[..., ::2, :], metric[..., 1::2, :]
+        scores = a @ b.transpose(-1, -2)
+
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        # unmerged tokens of the first set, and the merged ones with their destination in the second set
+        unm_idx = edge_idx[..., r:, :]
+        src_idx = edge_idx[..., :r, :]
+        dst_idx = node_idx[..., None].gather(dim=-2, index=src_idx)
+
+    def merge(x, mode='sum'):
+        src, dst = x[..., ::2, :], x[..., 1::2, :]
+        n, t1, c = src.shape
+        unm = src.gather(dim=-2, index=unm_idx.expand(n, t1 - r, c))
+        src = src.gather(dim=-2, index=src_idx.expand(n, r, c))
+        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce=mode)
+        return torch.cat([unm, dst], dim=1)
+
+    return merge
+
+def merge_wavg(merge, x, size):
+    # size weighted average of the merged tokens, size: [B, N, 1]
+    x = merge(x * size)
+    size = merge(size)
+    return x / size, size
+
+def tome_attention(attn, x, size):
+    """
+    The timm Attention (or PrunedAttention) forward with proportional attention. Returns the output and the mean key over heads [B, N, head_dim].
+    """
+    B, N, C = x.shape
+    head_dim = getattr(attn, 'head_dim', C // attn.num_heads)
+    qkv = attn.qkv(x).reshape(B, N, 3, attn.num_heads, head_dim).permute(2, 0, 3, 1, 4)
+    q, k, v = qkv[0], qkv[1], qkv[2]
+
+    # a token of size s attends as s copies of the token
+    size_bias = size.log()[:, None, None, :, 0]
+    if hasattr(torch.nn.functional, 'scaled_dot_product_attention'):
+        x = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=size_bias.to(q.dtype), scale=attn.scale)
+    else:
+        logits = (q * attn.scale) @ k.transpose(-2, -1) + size_bias
+        x = logits.softmax(dim=-1) @ v
+
+    x = x.transpose(1, 2).reshape(B, N, attn.num_heads * head_dim)
+    x = attn.proj(x)
+    return x, k.mean(dim=1)
+
+def tome_block(blk, x, size, r, modality=None):
+    """
+    Inference forward of a Block (see cav_mae.py / audio_mdl.py) with token merging between the attention and the mlp.
+    modality selects the normalization layers like Block.forward, None for the unified normalization.
+    """
+    suffix = '' if modality == None else '_' + modality
+    x_attn, metric = tome_attention(blk.attn, getattr(blk, 'norm1' + suffix)(x), size)
+    x = x + x_attn
+    merge = bipartite_soft_matching(metric, r)
+    if merge is not None:
+        x, size = merge_wavg(merge, x, size)
+    x = x + blk.mlp(getattr(blk, 'norm2' + suffix)(x))
+    return x, size
+
+def tome_blocks(blocks, x, size, r, modality=None):
+    # r: the number of merged tokens of each block
+    for blk, blk_r in zip(blocks, r):
+        x, size = tome_block(blk, x, size, blk_r, modality)
+    return x, size
+
+def init_size(x):
+    # every token starts as one patch
+    return torch.ones(x.shape[0], x.shape[1], 1, device=x.device, dtype=x.dtype)
+
+def weighted_mean(x, size):
+    # mean pooling over the original patches
+    return (x * size).sum(dim=1) / size.sum(dim=1)
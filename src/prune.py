@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# @Time    : 10/19/26 10:10 PM
+# @Author  : Ben Chou
+# @Affiliation  : Purdue University
+# @Email   : chou150@purdue.edu
+# @File    : prune.py
+
+# structured pruning of the attention heads and mlp hidden units of a finetuned CAVMAEFT.
+# each head / unit is scored by |activation x gradient| of the loss (first order taylor estimate of the loss change when it
+# is removed) on a calibration set, the lowest scored ones in each block are physically removed, i.e., the qkv / proj and
+# fc1 / fc2 weights are sliced, so the pruned model is smaller and faster without sparse kernels.
+# output layout:
+# output_dir/model_config.json   the CAVMAEFT constructor arguments, block_config holds the heads / units kept per block
+# output_dir/pruned_model.pth    the pruned state dict (DataParallel 'module.' prefix)
+# recover the accuracy with a short finetuning:
+#   python run_cavmae_ft.py --model cav-mae-ft-pruned --model_config output_dir/model_config.json --pretrain_path output_dir/pruned_model.pth ...
+
+import argparse
+import os
+import time
+import torch
+from torch import nn
+from model_loader import add_model_args, build_model, load_model, save_model_config
+
+def get_blocks(audio_model):
+    # (name, block) of all transformer blocks, name as in block_config, e.g., blocks_a.0
+    return [('{:s}.{:d}'.format(group, i), blk) for group in ['blocks_a', 'blocks_v', 'blocks_u'] for i, blk in enumerate(getattr(audio_model, group))]
+
+def score_units(audio_model, calib_loader, args):
+    """
+    Accumulate |sum of activation x gradient| per sample of each attention head (the input of attn.proj) and mlp hidden unit
+    (the input of mlp.fc2) over at most args.calib_batches batches. Returns {block name: (head scores [H], unit scores [M])}.
+    """
+    device = next(audio_model.parameters()).device
+    audio_model.eval()
+    scores, hooks = {}, []
+
+    def get_hook(name, index, num_heads):
+        def save_score(score):
+            scores[name][index] += score.detach().float().cpu()
+        def hook(module, inputs):
+            x = inputs[0]
+            if x.requires_grad == False:
+                return
+            def grad_hook(grad):
+                # [B, N, C] -> [B, N, heads, head_dim] for heads, the contribution of a head / unit is summed over its
+                # channels and the tokens, then the absolute value per sample
+                act = x.detach() * grad
+                if num_heads != None:
+                    act = act.reshape(act.shape[0], act.shape[1], num_heads, -1).sum(dim=-1)
+                save_score(act.sum(dim=1).abs().sum(dim=0))
+            x.register_hook(grad_hook)
+        return hook
+
+    for name, blk in get_blocks(audio_model):
+        scores[name] = [torch.zeros(blk.attn.num_heads), torch.zeros(blk.mlp.fc1.out_features)]
+        hooks.append(blk.attn.proj.register_forward_pre_hook(get_hook(name, 0, blk.attn.num_heads)))
+        hooks.append(blk.mlp.fc2.register_forward_pre_hook(get_hook(name, 1, None)))
+
+    loss_fn = nn.BCEWithLogitsLoss() if args.loss == 'BCE' else nn.CrossEntropyLoss()
+    num_samples = 0
+    for i, (a_input, v_input, labels) in enumerate(calib_loader):
+        if i >= args.calib_batches:
+            break
+        a_input, v_input, labels = a_input.to(device), v_input.to(device), labels.to(device)
+        audio_model.zero_grad()
+        loss = loss_fn(audio_model(a_input, v_input, args.ftmode), labels)
+        loss.backward()
+        num_samples += a_input.shape[0]
+        print('calibration batch {:d}, loss {:.4f}'.format(i, loss.item()))
+    for hook in hooks:
+        hook.remove()
+    audio_model.zero_grad()
+    print('scored the heads and mlp units on {:d} calibration samples'.format(num_samples))
+    return {name: (head_score / num_samples, unit_score / num_samples) for name, (head_score, unit_score) in scores.items()}
+
+def get_keep_index(score, prune_ratio):
+    # the indices of the kept heads / units in their original order, at least one is kept
+    num_keep = max(1, int(round(score.shape[0] * (1 - prune_ratio))))
+    return torch.sort(torch.topk(score, num_keep).indices).values
+
+def select_heads(w, keep, num_heads, dim=0, groups=1):
+    # slice the heads of a weight / bias along dim, the dim is [groups, num_heads, head_dim], e.g., 3 groups (q, k, v) for qkv
+    shape = list(w.shape)
+    w = w.reshape(shape[:dim] + [groups, num_heads, -1] + shape[dim + 1:])
+    w = torch.index_select(w, dim + 1, keep)
+    return w.reshape(shape[:dim] + [-1] + shape[dim + 1:])
+
+def prune_model(audio_model, config, scores, head_prune_ratio, mlp_prune_ratio):
+    """
+    Build the pruned CAVMAEFT from the config and copy the kept weights of audio_model.
+    Returns the pruned model and its config, the block_config of config (if already pruned) is updated.
+    """
+    state_dict = {k: v.clone() for k, v in audio_model.state_dict().items()}
+    block_config = {}
+    for name, blk in get_blocks(audio_model):
+        head_score, unit_score = scores[name]
+        num_heads = blk.attn.num_heads
+        keep_heads = get_keep_index(head_score, head_prune_ratio)
+        keep_units = get_keep_index(unit_score, mlp_prune_ratio)
+        for k in ['attn.qkv.weight', 'attn.qkv.bias']:
+            if name + '.' + k in state_dict:
+                state_dict[name + '.' + k] = select_heads(state_dict[name + '.' + k], keep_heads, num_heads, dim=0, groups=3)
+        state_dict[name + '.attn.proj.weight'] = select_heads(state_dict[name + '.attn.proj.weight'], keep_heads, num_heads, dim=1)
+        state_dict[name + '.mlp.fc1.weight'] = state_dict[name + '.mlp.fc1.weight'][keep_units]
+        state_dict[name + '.mlp.fc1.bias'] = state_dict[name + '.mlp.fc1.bias'][keep_units]
+        state_dict[name + '.mlp.fc2.weight'] = state_dict[name + '.mlp.fc2.weight'][:, keep_units]
+        block_config[name] = {'attn_heads': keep_heads.shape[0], 'mlp_hidden_dim': keep_units.shape[0]}
+        print('{:s}: kept {:d} / {:d} heads, {:d} / {:d} mlp units'.format(name, keep_heads.shape[0], num_heads, keep_units.shape[0], unit_score.shape[0]))
+
+    config = dict(config)
+    config['block_config'] = block_config
+    pruned_model = build_model(config)
+    msg = pruned_model.load_state_dict(state_dict, strict=True)
+    print(msg)
+    return pruned_model, config
+
+def get_cpu_latency(audio_model, mode, target_length, num_iter=10):
+    a_input, v_input = torch.randn(1, target_length, 128), torch.randn(1, 3, 224, 224)
+    audio_model = audio_model.to('cpu').eval()
+    with torch.no_grad():
+        audio_model(a_input, v_input, mode)
+        begin_time = time.time()
+        for i in range(num_iter):
+            audio_model(a_input, v_input, mode)
+    return 1000 * (time.time() - begin_time) / num_iter
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    # --model_config of an already pruned checkpoint to prune it again
+    add_model_args(parser)
+    parser.add_argument("--ftmode", type=str, default='multimodal', help="the mode the heads / units are scored in")
+    parser.add_argument("--loss", type=str, default="BCE", help="the loss function of the scores", choices=["BCE", "CE"])
+    parser.add_argument("--head_prune_ratio", type=float, default=0.25, help="fraction of the attention heads removed in each block")
+    parser.add_argument("--mlp_prune_ratio", type=float, default=0.25, help="fraction of the mlp hidden units removed in each block")
+    parser.add_argument("--data_calib", type=str, required=True, help="the calibration json, e.g., a subset of the training set")
+    parser.add_argument("--calib_batches", type=int, default=50, help="the maximum number of calibration batches")
+    parser.add_argument("--label_csv", type=str, default='', help="csv with class labels")
+    parser.add_argument("--dataset", type=str, default="audioset", help="the dataset used")
+    parser.add_argument("--dataset_mean", type=float, default=-5.081, help="the dataset mean, used for input normalization")
+    parser.add_argument("--dataset_std", type=float, default=4.4849, help="the dataset std, used for input normalization")
+    parser.add_argument('-b', '--batch_size', default=16, type=int, metavar='N', help='mini-batch size')
+    parser.add_argument('-w', '--num_workers', default=8, type=int, metavar='NW', help='# of workers for dataloading')
+    parser.add_argument("--output_dir", type=str, default='./pruned', help="where model_config.json and pruned_model.pth are saved")
+    args = parser.parse_args()
+
+    import dataloader
+    calib_audio_conf = {'num_mel_bins': 128, 'target_length': args.target_length, 'freqm': 0, 'timem': 0, 'mixup': 0, 'dataset': args.dataset,
+                        'mode': 'eval', 'mean': args.dataset_mean, 'std': args.dataset_std, 'noise': False, 'im_res': 224}
+    calib_loader = torch.utils.data.DataLoader(
+        dataloader.AudiosetDataset(args.data_calib, label_csv=args.label_csv, audio_conf=calib_audio_conf),
+        batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers)
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    audio_model, config = load_model(args)
+    if config['model_type'] != 'ft':
+        raise ValueError('only CAVMAEFT (model_type ft) checkpoints can be pruned, got model_type ' + config['model_type'])
+    scores = score_units(audio_model.to(device), calib_loader, args)
+    pruned_model, config = prune_model(audio_model.to('cpu'), config, scores, args.head_prune_ratio, args.mlp_prune_ratio)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    save_model_config(config, os.path.join(args.output_dir, 'model_config.json'))
+    torch.save(torch.nn.DataParallel(pruned_model).state_dict(), os.path.join(args.output_dir, 'pruned_model.pth'))
+    print('saved the pruned model to ' + args.output_dir)
+
+    latency = {}
+    for name, mdl in [('full', audio_model), ('pruned', pruned_model)]:
+        latency[name] = get_cpu_latency(mdl, args.ftmode, args.target_length)
+        print('{:s}: {:.3f} million parameters, {:.1f} ms per clip on cpu'.format(name, sum(p.numel() for p in mdl.parameters()) / 1e6, latency[name]))
+    print('the pruned model is {:.2f}x faster, finetune it with run_cavmae_ft.py --model_config to recover the accuracy'.format(latency['full'] / latency['pruned']))
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# @Time    : 10/19/26 7:20 PM
+# @Author  : Ben Chou
+# @Affiliation  : Purdue University
+# @Email   : chou150@purdue.edu
+# @File    : quantize.py
+
+# cpu inference of finetuned CAVMAEFT / CAVMAEFTAudio models.
+# the Linear layers of the transformer blocks (attn.qkv, attn.proj, mlp.fc1, mlp.fc2) and mlp_head are dynamically
+# quantized to int8 (weights int8, activations quantized per batch). alternatively the float model runs with bf16 autocast
+# (on cpus with bf16 support), the two can not be combined as the dynamic int8 Linear layers take float32 inputs.
+# the quantized model is validated against the float model on an eval json and saved as a single artifact
+# (model config (see model_loader.py), mode, precision + quantized state dict, no DataParallel 'module.' prefix),
+# load it with load_inference_model:
+#   from quantize import load_inference_model
+#   audio_model = load_inference_model('as_audio_int8.pth', num_threads=4)
+#   logits = audio_model(fbank)  # fbank [B, 1024, 128]
+
+import argparse
+import time
+import numpy as np
+import torch
+from torch import nn
+from models.audio_mdl import CAVMAEFTAudio
+from model_loader import add_model_args, build_model, load_model
+from utilities import calculate_stats
+
+def set_threads(num_threads=0, num_interop_threads=0):
+    # 0 keeps the torch default, the inter-op threads can only be set once per process
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads > 0:
+        torch.set_num_interop_threads(num_interop_threads)
+
+def get_quantized_layers(audio_model):
+    # the Linear layers of the transformer blocks and of the classification head, the patch embeddings stay float
+    return set(name for name, m in audio_model.named_modules()
+               if isinstance(m, nn.Linear) and (name.startswith('blocks_') or name.startswith('mlp_head')))
+
+def quantize_model(audio_model):
+    audio_model.eval()
+    return torch.ao.quantization.quantize_dynamic(audio_model, get_quantized_layers(audio_model), dtype=torch.qint8)
+
+class InferenceModel(nn.Module):
+    """
+    Wraps a float, bf16 or int8 model for cpu inference, forward(a, v=None) returns the float32 logits.
+    CAVMAEFTAudio always runs the audio only path, CAVMAEFT runs the mode of the config (a or v may be None if unused).
+    """
+    def __init__(self, audio_model, config):
+        super().__init__()
+        self.audio_model = audio_model
+        self.config = config
+
+    def forward(self, a, v=None):
+        with torch.no_grad():
+            with torch.autocast('cpu', dtype=torch.bfloat16, enabled=self.config['precision'] == 'bf16'):
+                if isinstance(self.audio_model, CAVMAEFTAudio):
+                    x = self.audio_model.forward_pred(a, v)
+                else:
+                    x = self.audio_model(a, v, self.config['ftmode'])
+        return x.float()
+
+def load_float_model(args):
+    audio_model, model_config = load_model(args)
+    config = {'model': model_config, 'ftmode': args.ftmode, 'precision': 'fp32'}
+    return InferenceModel(audio_model, config)
+
+def save_inference_model(inference_model, path):
+    torch.save({'config': inference_model.config, 'state_dict': inference_model.audio_model.state_dict()}, path)
+
+def load_inference_model(path, num_threads=0, num_interop_threads=0):
+    """
+    Load an artifact of save_inference_model, the model is rebuilt from its config (quantized if it was saved int8).
+    """
+    set_threads(num_threads, num_interop_threads)
+    artifact = torch.load(path, map_location='cpu')
+    config = artifact['config']
+    audio_model = build_model(config['model'])
+    if config['precision'] == 'int8':
+        audio_model = quantize_model(audio_model)
+    audio_model.load_state_dict(artifact['state_dict'], strict=True)
+    audio_model.eval()
+    return InferenceModel(audio_model, config)
+
+def build_inference_model(float_model, precision='int8'):
+    # float_model is not modified, precision is int8, bf16 or fp32
+    if precision not in ['int8', 'bf16', 'fp32']:
+        raise ValueError('unknown precision ' + precision)
+    config = dict(float_model.config)
+    config['precision'] = precision
+    audio_model = quantize_model(float_model.audio_model) if precision == 'int8' else float_model.audio_model
+    return InferenceModel(audio_model, config)
+
+def validate(inference_model, val_loader):
+    # returns the predictions, targets and the model time per sample in ms
+    output, target, model_time = [], [], 0.0
+    for i, (a_input, v_input, labels) in enumerate(val_loader):
+        begin_time = time.time()
+        logits = inference_model(a_input, v_input)
+        model_time += time.time() - begin_time
+        output.append(torch.sigmoid(logits))
+        target.append(labels)
+    output, target = torch.cat(output), torch.cat(target)
+    return output, target, 1000 * model_time / target.shape[0]
+
+def compare(float_model, inference_model, val_loader):
+    res = {}
+    for name, mdl in [('float', float_model), ('inference', inference_model)]:
+        output, target, latency = validate(mdl, val_loader)
+        stats = calculate_stats(output.numpy(), target.numpy())
+        res[name] = {'output': output, 'mAP': np.mean([stat['AP'] for stat in stats]), 'ms_per_clip': latency}
+        print('{:s} model: mAP {:.4f}, {:.2f} ms per clip'.format(mdl.config['precision'], res[name]['mAP'], latency))
+    max_diff = (res['float']['output'] - res['inference']['output']).abs().max().item()
+    print('mAP difference {:.4f}, max prob difference {:.4f}, speedup {:.2f}x'.format(
+        res['inference']['mAP'] - res['float']['mAP'], max_diff, res['float']['ms_per_clip'] / res['inference']['ms_per_clip']))
+    return res
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_model_args(parser, model_type='audio')
+    parser.add_argument("--ftmode", type=str, default='audioonly', help="the CAVMAEFT mode used in inference")
+    parser.add_argument("--precision", type=str, default='int8', help="int8: dynamic quantization of the Linear layers, bf16: float model with bf16 autocast, fp32: float model", choices=["int8", "bf16", "fp32"])
+    parser.add_argument("--num_threads", type=int, default=0, help="torch intra-op threads, 0 to keep the default")
+    parser.add_argument("--num_interop_threads", type=int, default=0, help="torch inter-op threads, 0 to keep the default")
+    parser.add_argument("--data_val", type=str, default=None, help="the eval json the quantized model is validated on, None to skip validation")
+    parser.add_argument("--label_csv", type=str, default='', help="csv with class labels")
+    parser.add_argument("--dataset", type=str, default="audioset", help="the dataset used")
+    parser.add_argument("--dataset_mean", type=float, default=-5.081, help="the dataset mean, used for input normalization")
+    parser.add_argument("--dataset_std", type=float, default=4.4849, help="the dataset std, used for input normalization")
+    parser.add_argument("--frame_use", type=int, default=5, help="the video frame used in validation")
+    parser.add_argument('-b', '--batch_size', default=16, type=int, metavar='N', help='mini-batch size')
+    parser.add_argument('-w', '--num_workers', default=8, type=int, metavar='NW', help='# of workers for dataloading')
+    parser.add_argument("--output", type=str, default='./audio_model_int8.pth', help="where the inference artifact is saved")
+    args = parser.parse_args()
+
+    set_threads(args.num_threads, args.num_interop_threads)
+    float_model = load_float_model(args)
+    inference_model = build_inference_model(float_model, args.precision)
+    print('{:s} inference model, {:d} Linear layers quantized, {:d} threads'.format(args.precision, len(get_quantized_layers(float_model.audio_model)) if args.precision == 'int8' else 0, torch.get_num_threads()))
+
+    if args.data_val != None:
+        import dataloader
+        val_audio_conf = {'num_mel_bins': 128, 'target_length': args.target_length, 'freqm': 0, 'timem': 0, 'mixup': 0, 'dataset': args.dataset,
+                          'mode': 'eval', 'mean': args.dataset_mean, 'std': args.dataset_std, 'noise': False, 'im_res': 224, 'frame_use': args.frame_use}
+        val_loader = torch.utils.data.DataLoader(
+            dataloader.AudiosetDataset(args.data_val, label_csv=args.label_csv, audio_conf=val_audio_conf),
+            batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+        compare(float_model, inference_model, val_loader)
+
+    save_inference_model(inference_model, args.output)
+    print('saved the inference model to ' + args.output)
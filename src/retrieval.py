@@ -9,14 +9,15 @@
 
 import argparse
 import os
+import hashlib
+import json
 import models
 import dataloader as dataloader
 import torch
 import numpy as np
 from torch.cuda.amp import autocast
 from torch import nn
-from numpy import dot
-from numpy.linalg import norm
+from utilities import get_gt_ranks, compute_rank_metrics
 
 def get_immediate_subdirectories(a_dir):
     return [name for name in os.listdir(a_dir) if os.path.isdir(os.path.join(a_dir, name))]
@@ -24,32 +25,10 @@ def get_immediate_subdirectories(a_dir):
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 print(device)
 
-def get_similarity(a, b):
-    cos_sim = dot(a, b) / (norm(a) * norm(b))
-    return cos_sim
-
-# get mean
-def get_sim_mat(a, b):
-    B = a.shape[0]
-    sim_mat = np.empty([B, B])
-    for i in range(B):
-        for j in range(B):
-            sim_mat[i, j] = get_similarity(a[i, :], b[j, :])
-    return sim_mat
-
-def compute_metrics(x):
-    sx = np.sort(-x, axis=1)
-    d = np.diag(-x)
-    d = d[:, np.newaxis]
-    ind = sx - d
-    ind = np.where(ind == 0)
-    ind = ind[1]
-    metrics = {}
-    metrics['R1'] = float(np.sum(ind == 0)) / len(ind)
-    metrics['R5'] = float(np.sum(ind < 5)) / len(ind)
-    metrics['R10'] = float(np.sum(ind < 10)) / len(ind)
-    metrics['MR'] = np.median(ind) + 1
-    return metrics
+# rank of the ground truth by chunked matmul, the full similarity matrix is never materialized or sorted
+def compute_metrics(query, gallery, chunk_size=1024):
+    ranks = get_gt_ranks(query, gallery, chunk_size=chunk_size)
+    return compute_rank_metrics(ranks)
 
 def print_computed_metrics(metrics):
     r1 = metrics['R1']
@@ -58,8 +37,7 @@ def print_computed_metrics(metrics):
     mr = metrics['MR']
     print('R@1: {:.4f} - R@5: {:.4f} - R@10: {:.4f} - Median R: {}'.format(r1, r5, r10, mr))
 
-# direction: 'audio' means audio->visual retrieval, 'video' means visual->audio retrieval
-def get_retrieval_result(audio_model, val_loader, direction='audio'):
+def get_retrieval_feat(audio_model, val_loader):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     if not isinstance(audio_model, nn.DataParallel):
         audio_model = nn.DataParallel(audio_model)
@@ -84,30 +62,36 @@ def get_retrieval_result(audio_model, val_loader, direction='audio'):
             A_v_feat.append(video_output)
     A_a_feat = torch.cat(A_a_feat)
     A_v_feat = torch.cat(A_v_feat)
+    return A_a_feat, A_v_feat
+
+# direction: 'audio' means audio->visual retrieval, 'video' means visual->audio retrieval
+def get_retrieval_result(A_a_feat, A_v_feat, direction='audio'):
     if direction == 'audio':
         # audio->visual retrieval
-        sim_mat = get_sim_mat(A_a_feat, A_v_feat)
+        result = compute_metrics(A_a_feat, A_v_feat)
     elif direction == 'video':
         # visual->audio retrieval
-        sim_mat = get_sim_mat(A_v_feat, A_a_feat)
-    result = compute_metrics(sim_mat)
+        result = compute_metrics(A_v_feat, A_a_feat)
     print_computed_metrics(result)
     return result['R1'], result['R5'], result['R10'], result['MR']
 
-def eval_retrieval(model, data, audio_conf, label_csv, direction, num_class, model_type='pretrain', batch_size=48):
-    print(model)
-    print(data)
-    frame_use = 5
-    # eval setting
-    val_audio_conf = audio_conf
-    val_audio_conf['frame_use'] = frame_use
-    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    args = parser.parse_args()
-    args.data_val = data
-    args.label_csv = label_csv
-    args.exp_dir = './exp/dummy'
-    args.loss_fn = torch.nn.BCELoss()
-    val_loader = torch.utils.data.DataLoader(dataloader.AudiosetDataset(args.data_val, label_csv=args.label_csv, audio_conf=val_audio_conf), batch_size=batch_size, shuffle=False, num_workers=32, pin_memory=True)
+def get_checkpoint_hash(model):
+    sha1 = hashlib.sha1()
+    with open(model, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 24), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+# the embeddings of a (checkpoint, data json, label csv, eval audio_conf) are extracted once and cached on disk, both retrieval directions use them
+def load_retrieval_feat(model, data, audio_conf, label_csv, num_class, model_type='pretrain', batch_size=48, cache_dir='./exp/retrieval_cache'):
+    key = '{:s}|{:s}|{:s}|{:s}|{:s}'.format(get_checkpoint_hash(model), os.path.abspath(data), os.path.abspath(label_csv), model_type, json.dumps(audio_conf, sort_keys=True))
+    cache_path = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.npz')
+    if os.path.exists(cache_path):
+        print('load cached retrieval embeddings from ' + cache_path)
+        cache = np.load(cache_path)
+        return torch.from_numpy(cache['a_feat']), torch.from_numpy(cache['v_feat'])
+
+    val_loader = torch.utils.data.DataLoader(dataloader.AudiosetDataset(data, label_csv=label_csv, audio_conf=audio_conf), batch_size=batch_size, shuffle=False, num_workers=32, pin_memory=True)
     # cav-mae only been ssl pretrained
     if model_type == 'pretrain':
         audio_model = models.CAVMAE(modality_specific_depth=11)
@@ -120,30 +104,49 @@ def eval_retrieval(model, data, audio_conf, label_csv, direction, num_class, mod
     msg = audio_model.load_state_dict(sdA, strict=False)
     print(msg)
     audio_model.eval()
-    r1, r5, r10, mr = get_retrieval_result(audio_model, val_loader, direction)
-    return r1, r5, r10, mr
+    A_a_feat, A_v_feat = get_retrieval_feat(audio_model, val_loader)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = cache_path[:-len('.npz')] + '.tmp.npz'
+    np.savez(tmp_path, a_feat=A_a_feat.numpy(), v_feat=A_v_feat.numpy(), key=key)
+    os.replace(tmp_path, cache_path)
+    print('retrieval embeddings cached at ' + cache_path)
+    return A_a_feat, A_v_feat
+
+# returns [[direction, r1, r5, r10, mr], ...], the embeddings are extracted once for all directions
+def eval_retrieval(model, data, audio_conf, label_csv, num_class, directions=('video', 'audio'), model_type='pretrain', batch_size=48, cache_dir='./exp/retrieval_cache'):
+    print(model)
+    print(data)
+    frame_use = 5
+    # eval setting
+    val_audio_conf = dict(audio_conf)
+    val_audio_conf['frame_use'] = frame_use
+    A_a_feat, A_v_feat = load_retrieval_feat(model, data, val_audio_conf, label_csv, num_class, model_type, batch_size, cache_dir)
+    res = []
+    for direction in directions:
+        r1, r5, r10, mr = get_retrieval_result(A_a_feat, A_v_feat, direction)
+        res.append([direction, r1, r5, r10, mr])
+    return res
 
 # use cav-mae scale 108 (batch size) model that has only been pretrained
 model = '/data/sls/scratch/yuangong/cav-mae/pretrained_model/cav_mae_models/audioset/main/cav-mae-scale-108/audio_model.25.pth'
 res = []
 
 # for audioset
-for direction in ['video', 'audio']:
-    data = '/data/sls/scratch/yuangong/cav-mae/pretrained_model/datafiles/audioset/audioset_eval_5_per_class_for_retrieval_cleaned.json'
-    label_csv = '/data/sls/scratch/yuangong/cav-mae/pretrained_model/datafiles/audioset/class_labels_indices.csv'
-    dataset = 'audioset'
-    audio_conf = {'num_mel_bins': 128, 'target_length': 1024, 'freqm': 0, 'timem': 0, 'mixup': 0, 'dataset': dataset,
-                  'mode': 'eval', 'mean': -5.081, 'std': 4.4849, 'noise': False, 'im_res': 224, 'frame_use': 5}
-    r1, r5, r10, mr = eval_retrieval (model, data, audio_conf=audio_conf, label_csv=label_csv, num_class=309, direction=direction, model_type='pretrain', batch_size=100)
+data = '/data/sls/scratch/yuangong/cav-mae/pretrained_model/datafiles/audioset/audioset_eval_5_per_class_for_retrieval_cleaned.json'
+label_csv = '/data/sls/scratch/yuangong/cav-mae/pretrained_model/datafiles/audioset/class_labels_indices.csv'
+dataset = 'audioset'
+audio_conf = {'num_mel_bins': 128, 'target_length': 1024, 'freqm': 0, 'timem': 0, 'mixup': 0, 'dataset': dataset,
+              'mode': 'eval', 'mean': -5.081, 'std': 4.4849, 'noise': False, 'im_res': 224, 'frame_use': 5}
+for direction, r1, r5, r10, mr in eval_retrieval(model, data, audio_conf=audio_conf, label_csv=label_csv, num_class=309, directions=['video', 'audio'], model_type='pretrain', batch_size=100):
     res.append([dataset, direction, r1, r5, r10, mr])
 
 # for vggsound
-for direction in ['video', 'audio']:
-    data = '/data/sls/scratch/yuangong/cav-mae/pretrained_model/datafiles/vggsound/vgg_test_5_per_class_for_retrieval_cleaned.json'
-    label_csv = '/data/sls/scratch/yuangong/cav-mae/pretrained_model/datafiles/vggsound/class_labels_indices_vgg.csv'
-    dataset = 'vggsound'
-    audio_conf = {'num_mel_bins': 128, 'target_length': 1024, 'freqm': 0, 'timem': 0, 'mixup': 0, 'dataset': dataset,
-                  'mode': 'eval', 'mean': -5.081, 'std': 4.4849, 'noise': False, 'im_res': 224, 'frame_use': 5}
-    r1, r5, r10, mr = eval_retrieval(model, data, audio_conf=audio_conf, label_csv=label_csv, num_class=309, direction=direction, model_type='pretrain', batch_size=100)
+data = '/data/sls/scratch/yuangong/cav-mae/pretrained_model/datafiles/vggsound/vgg_test_5_per_class_for_retrieval_cleaned.json'
+label_csv = '/data/sls/scratch/yuangong/cav-mae/pretrained_model/datafiles/vggsound/class_labels_indices_vgg.csv'
+dataset = 'vggsound'
+audio_conf = {'num_mel_bins': 128, 'target_length': 1024, 'freqm': 0, 'timem': 0, 'mixup': 0, 'dataset': dataset,
+              'mode': 'eval', 'mean': -5.081, 'std': 4.4849, 'noise': False, 'im_res': 224, 'frame_use': 5}
+for direction, r1, r5, r10, mr in eval_retrieval(model, data, audio_conf=audio_conf, label_csv=label_csv, num_class=309, directions=['video', 'audio'], model_type='pretrain', batch_size=100):
     res.append([dataset, direction, r1, r5, r10, mr])
-np.savetxt('./retrieval_result.csv', res, delimiter=',', fmt='%s')
\ No newline at end of file
+np.savetxt('./retrieval_result.csv', res, delimiter=',', fmt='%s')
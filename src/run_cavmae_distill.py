@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# @Time    : 10/19/26 9:30 PM
+# @Author  : Ben Chou
+# @Affiliation  : Purdue University
+# @Email   : chou150@purdue.edu
+# @File    : run_cavmae_distill.py
+
+import argparse
+import os
+os.environ['MPLCONFIGDIR'] = './plt/'
+import ast
+import pickle
+import sys
+import time
+import torch
+from torch.utils.data import WeightedRandomSampler
+basepath = os.path.dirname(os.path.dirname(sys.path[0]))
+sys.path.append(basepath)
+import dataloader as dataloader
+from model_loader import build_model, load_model, save_model_config
+import numpy as np
+import json
+from traintest_distill import train, get_teacher_cache_loader, LogitFeatureModel
+from traintest_ft import validate
+
+# distill a finetuned cav-mae model into a smaller student
+
+print("I am process %s, running on %s: starting (%s)" % (os.getpid(), os.uname()[1], time.asctime()))
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("--data-train", type=str, default='', help="training data json")
+parser.add_argument("--data-val", type=str, default='', help="validation data json")
+parser.add_argument("--label-csv", type=str, default='', help="csv with class labels")
+parser.add_argument("--n_class", type=int, default=527, help="number of classes")
+parser.add_argument("--dataset", type=str, default="audioset", help="the dataset used", choices=["audioset", "esc50", "speechcommands", "fsd50k", "vggsound", "epic", "k400"])
+parser.add_argument("--dataset_mean", type=float, help="the dataset mean, used for input normalization")
+parser.add_argument("--dataset_std", type=float, help="the dataset std, used for input normalization")
+parser.add_argument("--target_length", type=int, help="the input length in frames")
+parser.add_argument("--noise", help='if use balance sampling', type=ast.literal_eval)
+
+parser.add_argument("--exp-dir", type=str, default="", help="directory to dump experiments")
+parser.add_argument('--lr', '--learning-rate', default=0.0005, type=float, metavar='LR', help='initial learning rate of the student')
+parser.add_argument('-b', '--batch-size', default=48, type=int, metavar='N', help='mini-batch size')
+parser.add_argument('-w', '--num-workers', default=32, type=int, metavar='NW', help='# of workers for dataloading (default: 32)')
+parser.add_argument("--n-epochs", type=int, default=20, help="number of maximum training epochs")
+parser.add_argument("--metrics", type=str, default="mAP", help="the main evaluation metrics", choices=["mAP", "acc"])
+parser.add_argument("--loss", type=str, default="BCE", help="the loss function, depend on the task", choices=["BCE", "CE"])
+parser.add_argument("--lrscheduler_start", default=10, type=int, help="when to start decay")
+parser.add_argument("--lrscheduler_step", default=1, type=int, help="the number of step to decrease the learning rate")
+parser.add_argument("--lrscheduler_decay", default=0.75, type=float, help="the learning rate decay ratio")
+parser.add_argument('--freqm', help='frequency mask max length', type=int, default=0)
+parser.add_argument('--timem', help='time mask max length', type=int, default=0)
+parser.add_argument("--n-print-steps", type=int, default=100, help="number of steps to print statistics")
+parser.add_argument('--save_model', help='save the model or not', type=ast.literal_eval)
+parser.add_argument("--mixup", type=float, default=0, help="how many (0-1) samples need to be mixup during training")
+parser.add_argument("--bal", type=str, default=None, help="use balanced sampling or not")
+parser.add_argument("--label_smooth", type=float, default=0.1, help="label smoothing factor")
+parser.add_argument("--weight_file", type=str, default=None, help="path to weight file")
+parser.add_argument("--ftmode", type=str, default='multimodal', help="the mode of the teacher and the student")
+parser.add_argument("--pos_embed_method", type=str, default='truncate', help="how the audio positional embedding of the teacher is resized if target_length differs", choices=["truncate", "interpolate", "sincos"])
+
+parser.add_argument("--teacher_path", type=str, required=True, help="the finetuned teacher checkpoint")
+parser.add_argument("--teacher_config", type=str, default=None, help="model_config.json of the teacher (e.g., a pruned or early-exit model), None for the default CAVMAEFT with 11 modality-specific layers")
+parser.add_argument("--teacher_type", type=str, default='ft', help="ft for CAVMAEFT, audio for CAVMAEFTAudio, the teacher_config overrides it", choices=["ft", "audio"])
+parser.add_argument("--student_embed_dim", type=int, default=384, help="embedding dimension of the student")
+parser.add_argument("--student_num_heads", type=int, default=6, help="number of attention heads of the student")
+parser.add_argument("--student_depth", type=int, default=6, help="number of transformer layers of the student")
+parser.add_argument("--student_modality_specific_depth", type=int, default=5, help="number of modality-specific layers of the student, the rest are modality-sharing")
+parser.add_argument("--student_pretrain_path", type=str, default='None', help="optional initialization of the student with the same architecture")
+parser.add_argument("--kd_alpha", type=float, default=0.9, help="weight of the logit distillation loss, the label loss has weight 1 - kd_alpha")
+parser.add_argument("--kd_temperature", type=float, default=2.0, help="temperature of the logit distillation loss")
+parser.add_argument("--feat_weight", type=float, default=1.0, help="weight of the pooled feature distillation loss")
+parser.add_argument("--teacher_cache", help='cache the teacher outputs once instead of running the teacher every step, the student is then trained without augmentation', type=ast.literal_eval, default='False')
+parser.add_argument("--teacher_cache_dir", type=str, default=None, help="directory of the teacher cache, default exp_dir/teacher_cache")
+parser.add_argument("--cache_frame", type=int, default=-1, help="the frame used when building the teacher cache, -1 means the middle frame")
+
+args = parser.parse_args()
+
+# all exp in this work is based on 224 * 224 image
+im_res = 224
+audio_conf = {'num_mel_bins': 128, 'target_length': args.target_length, 'freqm': args.freqm, 'timem': args.timem, 'mixup': args.mixup,
+              'dataset': args.dataset, 'mode':'train', 'mean':args.dataset_mean, 'std':args.dataset_std,
+              'noise':args.noise, 'label_smooth': args.label_smooth, 'im_res': im_res}
+val_audio_conf = {'num_mel_bins': 128, 'target_length': args.target_length, 'freqm': 0, 'timem': 0, 'mixup': 0, 'dataset': args.dataset,
+                  'mode':'eval', 'mean': args.dataset_mean, 'std': args.dataset_std, 'noise': False, 'im_res': im_res}
+
+sampler = None
+if args.bal == 'bal':
+    print('balanced sampler is being used')
+    if args.weight_file == None:
+        samples_weight = np.loadtxt(args.data_train[:-5]+'_weight.csv', delimiter=',')
+    else:
+        samples_weight = np.loadtxt(args.data_train[:-5] + '_' + args.weight_file + '.csv', delimiter=',')
+    sampler = WeightedRandomSampler(samples_weight, len(samples_weight), replacement=True)
+
+val_loader = torch.utils.data.DataLoader(
+    dataloader.AudiosetDataset(args.data_val, label_csv=args.label_csv, audio_conf=val_audio_conf),
+    batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers, pin_memory=True, drop_last=True)
+
+# the teacher is loaded as by the inference scripts, so pruned, early-exit and audio only teachers can be distilled
+teacher_args = argparse.Namespace(model=args.teacher_path, model_config=args.teacher_config, model_type=args.teacher_type, n_class=args.n_class,
+                                  target_length=args.target_length, pos_embed_method=args.pos_embed_method)
+teacher, teacher_config = load_model(teacher_args)
+print('now load the teacher from ', args.teacher_path)
+
+# saved as exp_dir/models/model_config.json, model_loader.py loads the student checkpoints with it
+student_config = {'model_type': 'ft', 'label_dim': args.n_class, 'audio_length': args.target_length, 'embed_dim': args.student_embed_dim,
+                  'num_heads': args.student_num_heads, 'depth': args.student_depth, 'modality_specific_depth': args.student_modality_specific_depth}
+student = build_model(student_config)
+if args.student_pretrain_path != 'None':
+    student = torch.nn.DataParallel(student)
+    # the same architecture as the student, a mismatched checkpoint fails here
+    msg = student.load_state_dict(torch.load(args.student_pretrain_path, map_location='cpu'), strict=True)
+    print('now load the student from ', args.student_pretrain_path)
+    print(msg)
+
+print("\nCreating experiment directory: %s" % args.exp_dir)
+try:
+    os.makedirs("%s/models" % args.exp_dir)
+except:
+    pass
+with open("%s/args.pkl" % args.exp_dir, "wb") as f:
+    pickle.dump(args, f)
+with open(args.exp_dir + '/args.json', 'w') as f:
+    json.dump(args.__dict__, f, indent=2)
+save_model_config(student_config, args.exp_dir + '/models/model_config.json')
+
+if args.teacher_cache == True:
+    # the cache is built without augmentation and with a fixed frame, the same input is used in every epoch
+    cache_dir = args.teacher_cache_dir if args.teacher_cache_dir != None else args.exp_dir + '/teacher_cache'
+    cache_audio_conf = dict(val_audio_conf)
+    cache_audio_conf['frame_use'] = args.cache_frame
+    train_loader = get_teacher_cache_loader(teacher,
+        torch.utils.data.DataLoader(dataloader.AudiosetDataset(args.data_train, label_csv=args.label_csv, audio_conf=cache_audio_conf),
+                                    batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers, pin_memory=True),
+        cache_dir, args, args.data_train, shuffle=True, sampler=sampler)
+    # the teacher is not needed any more
+    teacher = None
+else:
+    train_loader = torch.utils.data.DataLoader(
+        dataloader.AudiosetDataset(args.data_train, label_csv=args.label_csv, audio_conf=audio_conf),
+        batch_size=args.batch_size, shuffle=sampler == None, sampler=sampler, num_workers=args.num_workers, pin_memory=True, drop_last=True)
+
+print('Now starting distillation for {:d} epochs.'.format(args.n_epochs))
+train(student, teacher, train_loader, val_loader, args)
+
+# evaluate the best student and compare its cpu latency with the teacher
+student = torch.nn.DataParallel(build_model(student_config))
+msg = student.load_state_dict(torch.load(args.exp_dir + '/models/best_audio_model.pth', map_location='cpu'), strict=True)
+print(msg)
+stats, _ = validate(student, val_loader, args)
+mAP = np.mean([stat['AP'] for stat in stats])
+print('student mAP is {:.4f}, acc is {:.4f}'.format(mAP, stats[0]['acc']))
+
+teacher = LogitFeatureModel(build_model(teacher_config))
+a_input, v_input = torch.randn(1, args.target_length, 128), torch.randn(1, 3, im_res, im_res)
+latency = {}
+for name, mdl in [('teacher', teacher), ('student', LogitFeatureModel(student.module.to('cpu')))]:
+    mdl.eval()
+    with torch.no_grad():
+        mdl(a_input, v_input, args.ftmode)
+        begin_time = time.time()
+        for i in range(10):
+            mdl(a_input, v_input, args.ftmode)
+    latency[name] = (time.time() - begin_time) / 10
+    print('{:s}: {:.3f} million parameters, {:.1f} ms per clip on cpu'.format(name, sum(p.numel() for p in mdl.parameters()) / 1e6, 1000 * latency[name]))
+print('the student is {:.2f}x faster'.format(latency['teacher'] / latency['student']))
+np.savetxt(args.exp_dir + '/student_res.csv', [mAP, stats[0]['acc'], latency['teacher'], latency['student']], delimiter=',')
@@ -17,12 +17,15 @@ from torch.utils.data import WeightedRandomSampler
 basepath = os.path.dirname(os.path.dirname(sys.path[0]))
 sys.path.append(basepath)
 import dataloader as dataloader
-import models
+# builds the (a, v) models.cav_mae.CAVMAEFT, dataloader.py yields (audio, image, label), models.CAVMAEFT is the three-input midi model
+from model_loader import build_model, save_model_config
+from models.pos_embed import interpolate_pos_embed_audio
 import numpy as np
 import warnings
 import json
 from sklearn import metrics
-from traintest_ft import train, validate
+from traintest_ft import train, validate, validate_multiframe, validate_early_exit
+from utilities import calculate_stats
 
 # finetune cav-mae model
 
@@ -62,9 +65,13 @@ parser.add_argument('--timem', help='time mask max length', type=int, default=0)
 parser.add_argument("--wa", help='if do weight averaging in finetuning', type=ast.literal_eval)
 parser.add_argument("--wa_start", type=int, default=1, help="which epoch to start weight averaging in finetuning")
 parser.add_argument("--wa_end", type=int, default=10, help="which epoch to end weight averaging in finetuning")
+parser.add_argument("--wa_decay", type=float, default=None, help="ema decay of weight averaging, None means equal-weight averaging")
+parser.add_argument("--wa_interval", type=int, default=0, help="update the weight average every N steps, 0 means at the end of each epoch")
+parser.add_argument("--wa_cpu", help='keep the weight average on cpu', type=ast.literal_eval, default='False')
 
 parser.add_argument("--n-print-steps", type=int, default=100, help="number of steps to print statistics")
 parser.add_argument('--save_model', help='save the model or not', type=ast.literal_eval)
+parser.add_argument("--auto_resume", help='if resume from exp_dir/models/checkpoint.pth (model, optimizer, weight average) when it exists', type=ast.literal_eval, default=True)
 
 parser.add_argument("--mixup", type=float, default=0, help="how many (0-1) samples need to be mixup during training")
 parser.add_argument("--bal", type=str, default=None, help="use balanced sampling or not")
@@ -73,10 +80,24 @@ parser.add_argument("--label_smooth", type=float, default=0.1, help="label smoot
 parser.add_argument("--weight_file", type=str, default=None, help="path to weight file")
 parser.add_argument("--pretrain_path", type=str, default='None', help="pretrained model path")
 parser.add_argument("--ftmode", type=str, default='multimodal', help="how to fine-tune the model")
+parser.add_argument("--pos_embed_method", type=str, default='truncate', help="how the audio positional embedding of the pretrained model is resized if target_length differs, truncate only for a shorter target_length", choices=["truncate", "interpolate", "sincos"])
+parser.add_argument("--model_config", type=str, default=None, help="model_config.json of a pruned model (see prune.py), the model is built from it, e.g., to finetune the pruned model given as pretrain_path")
 
 parser.add_argument("--head_lr", type=float, default=50.0, help="learning rate ratio the newly initialized layers / pretrained weights")
 parser.add_argument('--freeze_base', help='freeze the backbone or not', type=ast.literal_eval)
 parser.add_argument('--skip_frame_agg', help='if do frame agg', type=ast.literal_eval)
+parser.add_argument("--token_keep_a", type=float, default=1.0, help="fraction of audio tokens randomly kept in each training step (FLIP-style token drop), 1.0 keeps all tokens, evaluation always uses all tokens")
+parser.add_argument("--token_keep_v", type=float, default=1.0, help="fraction of visual tokens randomly kept in each training step, 1.0 keeps all tokens")
+parser.add_argument("--exit_layers", type=ast.literal_eval, default=None, help="early exit, e.g., [4,6,8]: auxiliary heads after the 4th, 6th and 8th layer of blocks_a / blocks_v, trained jointly, only for cav-mae-ft-exit and cav-mae-ft-pruned")
+parser.add_argument("--exit_weight", type=float, default=1.0, help="weight of the average loss of the exit heads")
+parser.add_argument("--exit_thresholds", type=ast.literal_eval, default=[0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99], help="confidence thresholds of the early-exit evaluation")
+parser.add_argument("--full_token_epochs", type=int, default=0, help="number of final epochs trained with all tokens when token drop is used")
+parser.add_argument('--shared_audio_eval', help='multi-frame evaluation in one pass, the audio of each clip is decoded and encoded once for all frames', type=ast.literal_eval, default='True')
+parser.add_argument("--streaming_eval", help='evaluate with per-class score histograms instead of keeping all predictions (approximate mAP / AUC with an error bound)', type=ast.literal_eval, default='False')
+parser.add_argument("--streaming_bins", type=int, default=4096, help="number of score histogram bins per class in streaming evaluation")
+parser.add_argument("--feature_cache", type=str, default=None, help="train the head from cached backbone features instead of running the frozen backbone every epoch", choices=[None, "pooled", "token"])
+parser.add_argument("--feature_cache_dir", type=str, default=None, help="directory of the feature cache, default exp_dir/feature_cache")
+parser.add_argument("--cache_frame", type=int, default=-1, help="the frame used when building the feature cache, -1 means the middle frame")
 
 args = parser.parse_args()
 
@@ -114,11 +135,25 @@ if args.data_eval != None:
         dataloader.AudiosetDataset(args.data_eval, label_csv=args.label_csv, audio_conf=val_audio_conf),
         batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers, pin_memory=True)
 
+# the constructor arguments are saved as exp_dir/models/model_config.json, model_loader.py loads the checkpoints with it
 if args.model == 'cav-mae-ft':
     print('finetune a cav-mae model with 11 modality-specific layers and 1 modality-sharing layers')
-    audio_model = models.CAVMAEFT(label_dim=args.n_class, modality_specific_depth=11)
+    model_config = {'label_dim': args.n_class, 'audio_length': args.target_length, 'modality_specific_depth': 11}
+elif args.model == 'cav-mae-ft-pruned':
+    # the pruned model keeps the number of heads / mlp units of each block in its config
+    with open(args.model_config, 'r') as f:
+        model_config = json.load(f)
+    model_config['label_dim'], model_config['audio_length'] = args.n_class, args.target_length
+    if args.exit_layers != None:
+        model_config['exit_layers'] = args.exit_layers
+    print('finetune a pruned cav-mae model from ', args.model_config)
+elif args.model == 'cav-mae-ft-exit':
+    print('finetune a cav-mae model with early-exit heads after layers', args.exit_layers)
+    model_config = {'label_dim': args.n_class, 'audio_length': args.target_length, 'modality_specific_depth': 11, 'exit_layers': args.exit_layers}
 else:
     raise ValueError('model not supported')
+model_config['model_type'] = 'ft'
+audio_model = build_model(model_config)
 
 if args.pretrain_path == 'None':
     warnings.warn("Note you are finetuning a model without any finetuning.")
@@ -129,6 +164,8 @@ if args.pretrain_path != 'None':
     mdl_weight = torch.load(args.pretrain_path)
     if not isinstance(audio_model, torch.nn.DataParallel):
         audio_model = torch.nn.DataParallel(audio_model)
+    # a model pretrained with a different audio length, e.g., 1024 frames pretrained and 512 frames finetuned
+    mdl_weight = interpolate_pos_embed_audio(audio_model, mdl_weight, args.pos_embed_method)
     miss, unexpected = audio_model.load_state_dict(mdl_weight, strict=False)
     print('now load cav-mae pretrained weights from ', args.pretrain_path)
     print(miss, unexpected)
@@ -142,31 +179,34 @@ with open("%s/args.pkl" % args.exp_dir, "wb") as f:
     pickle.dump(args, f)
 with open(args.exp_dir + '/args.json', 'w') as f:
     json.dump(args.__dict__, f, indent=2)
+save_model_config(model_config, args.exp_dir + '/models/model_config.json')
+
+# run the frozen backbone once and train from the cached features, the final multi-frame evaluation still uses the raw data
+if args.feature_cache != None:
+    import feature_cache
+    cache_dir = args.feature_cache_dir if args.feature_cache_dir != None else args.exp_dir + '/feature_cache'
+    # the cache is built without augmentation and with a fixed frame, the same input is used in every epoch
+    cache_audio_conf = dict(val_audio_conf)
+    cache_audio_conf['frame_use'] = args.cache_frame
+    cache_sampler = sampler if args.bal == 'bal' else None
+    train_loader = feature_cache.get_feature_cache_loader(audio_model,
+        torch.utils.data.DataLoader(dataloader.AudiosetDataset(args.data_train, label_csv=args.label_csv, audio_conf=cache_audio_conf),
+                                    batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers, pin_memory=True),
+        cache_dir + '/train', args.feature_cache, args, args.data_train, shuffle=True, sampler=cache_sampler)
+    val_loader = feature_cache.get_feature_cache_loader(audio_model,
+        torch.utils.data.DataLoader(dataloader.AudiosetDataset(args.data_val, label_csv=args.label_csv, audio_conf=cache_audio_conf),
+                                    batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers, pin_memory=True),
+        cache_dir + '/val', args.feature_cache, args, args.data_val, shuffle=False)
 
 print('Now starting training for {:d} epochs.'.format(args.n_epochs))
 train(audio_model, train_loader, val_loader, args)
 
-# average the model weights of checkpoints, note it is not ensemble, and does not increase computational overhead
-# Wa -> Weight Averaging
-def wa_model(exp_dir, start_epoch, end_epoch):
-    sdA = torch.load(exp_dir + '/models/audio_model.' + str(start_epoch) + '.pth', map_location='cpu')
-    model_cnt = 1
-    for epoch in range(start_epoch+1, end_epoch+1):
-        sdB = torch.load(exp_dir + '/models/audio_model.' + str(epoch) + '.pth', map_location='cpu')
-        for key in sdA:
-            sdA[key] = sdA[key] + sdB[key]
-        model_cnt += 1
-    print('wa {:d} models from {:d} to {:d}'.format(model_cnt, start_epoch, end_epoch))
-    for key in sdA:
-        sdA[key] = sdA[key] / float(model_cnt)
-    return sdA
-
 # evaluate with multiple frames
 if not isinstance(audio_model, torch.nn.DataParallel):
     audio_model = torch.nn.DataParallel(audio_model)
 if args.wa == True:
-    sdA = wa_model(args.exp_dir, start_epoch=args.wa_start, end_epoch=args.wa_end)
-    torch.save(sdA, args.exp_dir + "/models/audio_model_wa.pth")
+    # the weight average is kept in memory during training and saved at the end of training, note it is not ensemble
+    sdA = torch.load(args.exp_dir + "/models/audio_model_wa.pth", map_location='cpu')
 else:
     # if no wa, use the best checkpint
     sdA = torch.load(args.exp_dir + '/models/best_audio_model.pth', map_location='cpu')
@@ -174,6 +214,11 @@ msg = audio_model.load_state_dict(sdA, strict=True)
 print(msg)
 audio_model.eval()
 
+# early-exit evaluation of the single frame val_loader, mAP and the average number of layers used at each threshold
+if len(getattr(audio_model.module, 'exit_layers', [])) > 0:
+    exit_res = validate_early_exit(audio_model, val_loader, args)
+    np.savetxt(args.exp_dir + '/early_exit_res.csv', exit_res, delimiter=',', header='threshold,mAP,acc,layers,exit_fraction,ms_per_sample')
+
 # skil multi-frame evaluation, for audio-only model
 if args.skip_frame_agg == True:
     val_audio_conf['frame_use'] = 5
@@ -191,12 +236,25 @@ else:
     res = []
     multiframe_pred = []
     total_frames = 10 # change if your total frame is different
-    for frame in range(total_frames):
-        val_audio_conf['frame_use'] = frame
+    if args.shared_audio_eval == True:
+        # the dataset returns all frames of each clip, the audio branch runs once per clip
+        val_audio_conf['multi_frame'] = True
+        val_audio_conf['total_frame'] = total_frames
+        # each clip holds all its frames, so the visual branch sees the usual number of images per batch
         val_loader = torch.utils.data.DataLoader(
             dataloader.AudiosetDataset(args.data_val, label_csv=args.label_csv, audio_conf=val_audio_conf),
-            batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers, pin_memory=True)
-        stats, audio_output, target = validate(audio_model, val_loader, args, output_pred=True)
+            batch_size=max(1, args.batch_size // total_frames), shuffle=False, num_workers=args.num_workers, pin_memory=True)
+        frame_output, target = validate_multiframe(audio_model, val_loader, args)
+    for frame in range(total_frames):
+        if args.shared_audio_eval == True:
+            audio_output = frame_output[frame]
+            stats = calculate_stats(audio_output, target)
+        else:
+            val_audio_conf['frame_use'] = frame
+            val_loader = torch.utils.data.DataLoader(
+                dataloader.AudiosetDataset(args.data_val, label_csv=args.label_csv, audio_conf=val_audio_conf),
+                batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers, pin_memory=True)
+            stats, audio_output, target = validate(audio_model, val_loader, args, output_pred=True)
         print(audio_output.shape)
         if args.metrics == 'acc':
             audio_output = torch.nn.functional.softmax(audio_output.float(), dim=-1)
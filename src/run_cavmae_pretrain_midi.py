@@ -178,6 +178,12 @@ parser.add_argument(
     type=ast.literal_eval,
     default=None,
 )
+parser.add_argument(
+    "--skip_missing",
+    help="if skip the encoder / decoder compute of missing modalities (filled with 0.01 by the dataloader), changes the losses of batches mixing complete and incomplete samples",
+    type=ast.literal_eval,
+    default=False,
+)
 parser.add_argument("--masking_ratio", type=float, default=0.75, help="masking ratio")
 parser.add_argument(
     "--mask_mode",
@@ -203,6 +209,7 @@ audio_conf = {
     "noise": args.noise,
     "label_smooth": 0,
     "im_res": im_res,
+    "skip_missing": args.skip_missing,
 }
 val_audio_conf = {
     "num_mel_bins": 128,
@@ -216,6 +223,7 @@ val_audio_conf = {
     "std": args.dataset_std,
     "noise": False,
     "im_res": im_res,
+    "skip_missing": args.skip_missing,
 }
 
 print(
@@ -291,6 +299,7 @@ if args.model == "cav-mae":
         norm_pix_loss=args.norm_pix_loss,
         modality_specific_depth=11,
         tr_pos=args.tr_pos,
+        skip_missing=args.skip_missing,
     )
 else:
     raise ValueError("model not supported")
@@ -19,6 +19,7 @@ basepath = os.path.dirname(os.path.dirname(sys.path[0]))
 sys.path.append(basepath)
 import dataloader_piano_roll as dataloader
 import models
+from models.pos_embed import interpolate_pos_embed_audio
 import numpy as np
 from traintest_cavmae_piano_roll import train
 import wandb
@@ -159,9 +160,51 @@ def parse_args():
         "--bal", type=str, default=None, help="use balanced sampling or not"
     )
 
+    parser.add_argument(
+        "--modality_batch",
+        help="if make every batch modality-homogeneous (audio+video, audio+midi, or all three)",
+        type=ast.literal_eval,
+        default=False,
+    )
+    parser.add_argument(
+        "--modality_weights",
+        type=str,
+        default=None,
+        help="proportion of batches drawn from each modality group, e.g., av:0.5,am:0.5, default is proportional to group size",
+    )
     parser.add_argument(
         "--cont_model", help="previous pretrained model", type=str, default=None
     )
+    parser.add_argument(
+        "--auto_resume",
+        help="if resume from exp_dir/models/checkpoint.pth when it exists",
+        type=ast.literal_eval,
+        default=True,
+    )
+    parser.add_argument(
+        "--save_steps",
+        type=int,
+        default=1000,
+        help="save a resumable checkpoint every N steps, 0 means only at the end of each epoch",
+    )
+    parser.add_argument(
+        "--eval_steps",
+        type=int,
+        default=0,
+        help="evaluate on a fixed subset of the validation set every N steps, 0 means only at the end of each epoch",
+    )
+    parser.add_argument(
+        "--eval_batches",
+        type=int,
+        default=50,
+        help="number of validation batches per process used by the evaluation every eval_steps",
+    )
+    parser.add_argument(
+        "--preempt_check_steps",
+        type=int,
+        default=10,
+        help="check for SIGTERM / SIGUSR1 on all processes every N steps",
+    )
     parser.add_argument("--weight_file", type=str, default=None, help="path to weight file")
     parser.add_argument(
         "--norm_pix_loss", help="if use norm_pix_loss", type=ast.literal_eval, default=None
@@ -169,6 +212,20 @@ def parse_args():
     parser.add_argument(
         "--pretrain_path", type=str, default="None", help="pretrained model path"
     )
+    parser.add_argument("--im_res", type=int, default=224, help="the image resolution")
+    parser.add_argument(
+        "--progressive_schedule",
+        type=str,
+        default=None,
+        help="progressive input size, comma separated epoch:im_res:target_length entries each starting a stage, e.g., 1:112:512,4:160:768,7:224:1024, needs tr_pos False. Only implemented for this piano-roll pretraining (traintest_cavmae_piano_roll.py), run_cavmae_pretrain.py always trains at full size",
+    )
+    parser.add_argument(
+        "--pos_embed_method",
+        type=str,
+        default="truncate",
+        help="how the audio / piano-roll positional embedding of pretrain_path is resized if target_length differs, truncate only for a shorter target_length",
+        choices=["truncate", "interpolate", "sincos"],
+    )
     parser.add_argument(
         "--contrast_loss_weight",
         type=float,
@@ -184,6 +241,12 @@ def parse_args():
         type=ast.literal_eval,
         default=None,
     )
+    parser.add_argument(
+        "--skip_missing",
+        help="if skip the encoder / decoder compute of missing modalities (filled with 0.01 by the dataloader), changes the losses of batches mixing complete and incomplete samples",
+        type=ast.literal_eval,
+        default=False,
+    )
     parser.add_argument("--masking_ratio", type=float, default=0.75, help="masking ratio")
     parser.add_argument(
         "--mask_mode",
@@ -256,7 +319,7 @@ def main(args):
     
     run = setup_run(args)
 
-    im_res = 224
+    im_res = args.im_res
     audio_conf = {
         "num_mel_bins": 128,
         "target_length": args.target_length,
@@ -270,6 +333,7 @@ def main(args):
         "noise": args.noise,
         "label_smooth": 0,
         "im_res": im_res,
+        "skip_missing": args.skip_missing,
     }
     val_audio_conf = {
         "num_mel_bins": 128,
@@ -283,6 +347,7 @@ def main(args):
         "std": args.dataset_std,
         "noise": False,
         "im_res": im_res,
+        "skip_missing": args.skip_missing,
     }
 
     fabric.print(
@@ -291,39 +356,66 @@ def main(args):
         )
     )
 
-    if args.bal == "bal":
-        fabric.print("balanced sampler is being used")
-        if args.weight_file == None:
-            samples_weight = np.loadtxt(args.data_train[:-5] + "_weight.csv", delimiter=",")
+    if args.modality_batch == True:
+        fabric.print("modality-homogeneous batch sampler is being used")
+        if args.modality_weights != None:
+            group_weights = {}
+            for item in args.modality_weights.split(","):
+                group, weight = item.split(":")
+                group_weights[group.strip()] = float(weight)
         else:
-            samples_weight = np.loadtxt(
-                args.data_train[:-5] + "_" + args.weight_file + ".csv", delimiter=","
-            )
-        sampler = WeightedRandomSampler(
-            samples_weight, len(samples_weight), replacement=True
+            group_weights = None
+        train_dataset = dataloader.AudiosetDataset(
+            args.data_train, label_csv=args.label_csv, audio_conf=audio_conf
+        )
+        # the files of every sample are checked once by rank 0 and cached next to the json, the other processes read the cache
+        if fabric.global_rank == 0:
+            dataloader.get_modality_groups(train_dataset, args.data_train)
+        fabric.barrier()
+        modality_groups = dataloader.get_modality_groups(train_dataset, args.data_train, compute=False)
+        # the sampler shards every batch across processes itself, so fabric should not add a DistributedSampler
+        batch_sampler = dataloader.ModalityBatchSampler(
+            train_dataset,
+            args.batch_size,
+            group_weights=group_weights,
+            num_replicas=fabric.world_size,
+            rank=fabric.global_rank,
+            modality_groups=modality_groups,
         )
-
         train_loader = torch.utils.data.DataLoader(
-            dataloader.AudiosetDataset(
-                args.data_train, label_csv=args.label_csv, audio_conf=audio_conf
-            ),
-            batch_size=args.batch_size,
-            sampler=sampler,
+            train_dataset,
+            batch_sampler=batch_sampler,
             num_workers=args.num_workers,
             pin_memory=False,
-            drop_last=True,
         )
     else:
-        fabric.print("balanced sampler is not used")
+        # the sampler shards every batch across processes and can skip to a step when training is resumed
+        if args.bal == "bal":
+            fabric.print("balanced sampler is being used")
+            if args.weight_file == None:
+                samples_weight = np.loadtxt(args.data_train[:-5] + "_weight.csv", delimiter=",")
+            else:
+                samples_weight = np.loadtxt(
+                    args.data_train[:-5] + "_" + args.weight_file + ".csv", delimiter=","
+                )
+        else:
+            fabric.print("balanced sampler is not used")
+            samples_weight = None
+        train_dataset = dataloader.AudiosetDataset(
+            args.data_train, label_csv=args.label_csv, audio_conf=audio_conf
+        )
+        batch_sampler = dataloader.ResumableBatchSampler(
+            len(train_dataset),
+            args.batch_size,
+            weights=samples_weight,
+            num_replicas=fabric.world_size,
+            rank=fabric.global_rank,
+        )
         train_loader = torch.utils.data.DataLoader(
-            dataloader.AudiosetDataset(
-                args.data_train, label_csv=args.label_csv, audio_conf=audio_conf
-            ),
-            batch_size=args.batch_size,
-            shuffle=True,
+            train_dataset,
+            batch_sampler=batch_sampler,
             num_workers=args.num_workers,
             pin_memory=False,
-            drop_last=True,
         )
 
     val_loader = torch.utils.data.DataLoader(
@@ -358,6 +450,7 @@ def main(args):
             norm_pix_loss=args.norm_pix_loss,
             modality_specific_depth=11,
             tr_pos=args.tr_pos,
+            skip_missing=args.skip_missing,
         )
     else:
         raise ValueError("model not supported")
@@ -372,17 +465,22 @@ def main(args):
         if not isinstance(audio_model, torch.nn.parallel.DistributedDataParallel):
             audio_model = torch.nn.parallel.DistributedDataParallel(audio_model)
         audio_model = audio_model.to(device)
+        # a checkpoint pretrained with a different audio / piano-roll length
+        mdl_weight = interpolate_pos_embed_audio(audio_model, mdl_weight, args.pos_embed_method)
         miss, unexpected = audio_model.load_state_dict(mdl_weight, strict=False)
         fabric.print("now load mae pretrained weights from ", args.pretrain_path)
         fabric.print(miss, unexpected)
     
-    # if args.cont_model != None:
-    #     print('now load pretrained weights from : ' + args.cont_model)
-    #     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    #     sdA = fabric.load(args.cont_model, map_location=device)
-    #     if isinstance(audio_model, torch.nn.DataParallel) == False:
-    #         audio_model = torch.nn.DataParallel(audio_model)
-    #     audio_model.load_state_dict(sdA, strict=True)
+    # initialized with the weights of a previous run, e.g., best_audio_model.pth, the optimizer state is not loaded
+    # to continue an interrupted run, use --auto_resume, which also restores the optimizer, scheduler and data order
+    if args.cont_model != None:
+        fabric.print("now load pretrained weights from : " + args.cont_model)
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        sdA = torch.load(args.cont_model, map_location=torch.device("cpu"))
+        audio_model = audio_model.to(device)
+        if not isinstance(audio_model, torch.nn.parallel.DistributedDataParallel):
+            audio_model = torch.nn.parallel.DistributedDataParallel(audio_model)
+        audio_model.load_state_dict(sdA, strict=True)
 
     fabric.print("\nCreating experiment directory: %s" % args.exp_dir)
     try:
@@ -22,6 +22,32 @@ import pickle
 from torch.cuda.amp import autocast, GradScaler
 from lightning.fabric import Fabric  # Importing Fabric
 
+def get_base_model(audio_model):
+    # the CAVMAE inside the fabric / DDP wrappers
+    while hasattr(audio_model, "module"):
+        audio_model = audio_model.module
+    return audio_model
+
+
+def get_progressive_stage(args, epoch):
+    """
+    The (target_length, im_res) of an epoch in the progressive schedule args.progressive_schedule,
+    "epoch:im_res:target_length,...", e.g., "1:112:512,4:160:768,7:224:1024", each entry starts a stage at its epoch.
+    Full size (args.target_length, args.im_res) without a schedule or before the first stage.
+    Only this piano-roll pretraining supports the schedule, traintest_cavmae.py always trains at full size.
+    """
+    stage = (args.target_length, args.im_res)
+    if getattr(args, "progressive_schedule", None) in [None, "None", ""]:
+        return stage
+    for entry in sorted([[int(x) for x in e.split(":")] for e in args.progressive_schedule.split(",")]):
+        start_epoch, im_res, target_length = entry
+        if im_res % 16 != 0 or target_length % 16 != 0:
+            raise ValueError("im_res and target_length of the progressive schedule should be multiples of 16")
+        if start_epoch <= epoch:
+            stage = (target_length, im_res)
+    return stage
+
+
 def train(audio_model, train_loader, test_loader, args, fabric, run=None):
     device = fabric.device
     fabric.print("running on " + str(device))
@@ -34,13 +60,23 @@ def train(audio_model, train_loader, test_loader, args, fabric, run=None):
         per_sample_data_time,
         per_sample_dnn_time,
     ) = (AverageMeter(), AverageMeter(), AverageMeter(), AverageMeter(), AverageMeter())
-    loss_av_meter, loss_a1_meter, loss_a2_meter, loss_v_meter, loss_c_meter = (
-        AverageMeter(),
-        AverageMeter(),
-        AverageMeter(),
-        AverageMeter(),
-        AverageMeter(),
+    # loss meters accumulate on the device and are only synced (and all-reduced across processes) every n_print_steps
+    loss_av_meter, loss_a1_meter, loss_a2_meter, loss_v_meter, loss_c_meter, c_acc_meter = (
+        DeviceAverageMeter(),
+        DeviceAverageMeter(),
+        DeviceAverageMeter(),
+        DeviceAverageMeter(),
+        DeviceAverageMeter(),
+        DeviceAverageMeter(),
     )
+    loss_meters = [loss_av_meter, loss_a1_meter, loss_a2_meter, loss_v_meter, loss_c_meter, c_acc_meter]
+
+    def _sync_loss_meters():
+        sync_device_meters(
+            loss_meters,
+            all_reduce=lambda stats: fabric.all_reduce(stats, reduce_op="sum"),
+            world_size=fabric.world_size,
+        )
     progress = []
 
     best_epoch, best_loss = 0, np.inf
@@ -109,11 +145,106 @@ def train(audio_model, train_loader, test_loader, args, fabric, run=None):
     fabric.print("start training...")
     result = np.zeros([args.n_epochs, 12])  # for each epoch, 12 metrics to record
 
+    # progressive schedule, the train set and the model are resized at the start of every epoch, validation is at full size
+    train_dataset = train_loader.dataset
+    cur_size = (args.target_length, args.im_res)
+
+    def _set_input_size(size, set_dataset=False):
+        nonlocal cur_size
+        if size != cur_size:
+            get_base_model(audio_model).set_input_size(size[0], size[1])
+            cur_size = size
+        if set_dataset:
+            train_dataset.set_input_size(size[0], size[1])
+
     # Setup model and optimizer with Fabric
     audio_model, optimizer = fabric.setup(audio_model, optimizer)
-    train_loader = fabric.setup_dataloaders(train_loader)
+    # a modality batch sampler already shards batches across processes
+    batch_sampler = train_loader.batch_sampler
+    sharded_sampler = hasattr(batch_sampler, "set_epoch")
+    train_loader = fabric.setup_dataloaders(
+        train_loader, use_distributed_sampler=not sharded_sampler
+    )
     test_loader = fabric.setup_dataloaders(test_loader)
 
+    # resumable checkpoint, written at the end of every epoch, every save_steps steps, and before the job is preempted
+    # files are written on a background thread, the model / optimizer state is the same on all processes so only rank 0 writes it
+    checkpointer = AsyncCheckpointer()
+    preemption = PreemptionHandler()
+    ckpt_path = "%s/models/checkpoint.pth" % exp_dir
+    rng_path = "%s/models/checkpoint_rng.%d.pth" % (exp_dir, fabric.global_rank)
+    meters = {
+        "batch_time": batch_time,
+        "per_sample_time": per_sample_time,
+        "data_time": data_time,
+        "per_sample_data_time": per_sample_data_time,
+        "per_sample_dnn_time": per_sample_dnn_time,
+        "loss_av_meter": loss_av_meter,
+        "loss_a1_meter": loss_a1_meter,
+        "loss_a2_meter": loss_a2_meter,
+        "loss_v_meter": loss_v_meter,
+        "loss_c_meter": loss_c_meter,
+        "c_acc_meter": c_acc_meter,
+    }
+    start_step = 0
+
+    def _save_checkpoint(step_in_epoch):
+        checkpointer.save({"global_step": global_step, "rng": get_rng_state()}, rng_path)
+        if fabric.global_rank == 0:
+            checkpointer.save(
+                {
+                    "model": audio_model.state_dict(),
+                    "optimizer": optimizer.state_dict(),
+                    "scheduler": scheduler.state_dict(),
+                    "epoch": epoch,
+                    "global_step": global_step,
+                    "step_in_epoch": step_in_epoch,
+                    "best_epoch": best_epoch,
+                    "best_loss": best_loss,
+                    "result": result,
+                    "progress": progress,
+                    "meters": {name: meter.__dict__ for name, meter in meters.items()},
+                },
+                ckpt_path,
+            )
+
+    def _preemption_requested():
+        # all processes have to stop at the same step
+        if fabric.world_size == 1:
+            return preemption.requested
+        requested = torch.tensor(float(preemption.requested), device=device)
+        return fabric.all_reduce(requested, reduce_op="sum").item() > 0
+
+    if args.auto_resume == True and os.path.exists(ckpt_path):
+        checkpoint = torch.load(ckpt_path, map_location="cpu", weights_only=False)
+        # a checkpoint saved during a progressive stage has the positional embeddings of that stage
+        pos_embed_shape = {k.split(".")[-1]: v.shape[1] for k, v in checkpoint["model"].items() if k.split(".")[-1] in ["pos_embed_a1", "pos_embed_v"]}
+        _set_input_size((pos_embed_shape["pos_embed_a1"] * 2, int(round(pos_embed_shape["pos_embed_v"] ** 0.5)) * 16))
+        audio_model.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        scheduler.load_state_dict(checkpoint["scheduler"])
+        epoch, global_step = checkpoint["epoch"], checkpoint["global_step"]
+        start_step = checkpoint["step_in_epoch"]
+        best_epoch, best_loss = checkpoint["best_epoch"], checkpoint["best_loss"]
+        num_rows = min(len(result), len(checkpoint["result"]))
+        result[:num_rows] = checkpoint["result"][:num_rows]
+        progress.extend(checkpoint["progress"])
+        for name, meter in meters.items():
+            meter.__dict__.update(checkpoint["meters"].get(name, {}))
+        if os.path.exists(rng_path):
+            rng_state = torch.load(rng_path, map_location="cpu", weights_only=False)
+            if rng_state["global_step"] == global_step:
+                set_rng_state(rng_state["rng"])
+        if start_step > 0 and not sharded_sampler:
+            fabric.print("the train sampler cannot skip batches, epoch {:d} restarts from the first batch".format(epoch))
+            start_step = 0
+        fabric.print(
+            "now resume training from {:s}, epoch {:d}, step {:d} of the epoch, #steps={:d}".format(
+                ckpt_path, epoch, start_step, global_step
+            )
+        )
+        del checkpoint
+
     audio_model.train()
     while epoch < args.n_epochs + 1:
         begin_time = time.time()
@@ -127,9 +258,17 @@ def train(audio_model, train_loader, test_loader, args, fabric, run=None):
                 args.masking_ratio, args.mask_mode
             )
         )
+        if sharded_sampler:
+            batch_sampler.set_epoch(epoch)
+            batch_sampler.set_start_step(start_step)
+        stage_size = get_progressive_stage(args, epoch)
+        _set_input_size(stage_size, set_dataset=True)
+        fabric.print(
+            "current input size: audio length {:d}, image resolution {:d}".format(stage_size[0], stage_size[1])
+        )
         fabric.print("start dataloader")
         fabric.print("train loader length is %s" % len(train_loader))
-        for i, (a1_input, a2_input, v_input, _) in enumerate(train_loader):
+        for i, (a1_input, a2_input, v_input, _) in enumerate(train_loader, start_step):
             
             batch_size = a1_input.size(0)
             a1_input = a1_input.to(device, non_blocking=True)
@@ -139,7 +278,6 @@ def train(audio_model, train_loader, test_loader, args, fabric, run=None):
             data_time.update(time.time() - end_time)
             per_sample_data_time.update((time.time() - end_time) / a1_input.shape[0])
             dnn_start_time = time.time()
-            fabric.print("start forward")
            
             (
                 loss,
@@ -180,11 +318,12 @@ def train(audio_model, train_loader, test_loader, args, fabric, run=None):
             # scaler.update()
 
             # loss_av is the main loss
-            loss_av_meter.update(loss.item(), batch_size)
-            loss_a1_meter.update(loss_mae_a1.item(), batch_size)
-            loss_a2_meter.update(loss_mae_a2.item(), batch_size)
-            loss_v_meter.update(loss_mae_v.item(), batch_size)
-            loss_c_meter.update(loss_c.item(), batch_size)
+            loss_av_meter.update(loss, batch_size)
+            loss_a1_meter.update(loss_mae_a1, batch_size)
+            loss_a2_meter.update(loss_mae_a2, batch_size)
+            loss_v_meter.update(loss_mae_v, batch_size)
+            loss_c_meter.update(loss_c, batch_size)
+            c_acc_meter.update(c_acc, batch_size)
             batch_time.update(time.time() - end_time)
             per_sample_time.update((time.time() - end_time) / a1_input.shape[0])
             per_sample_dnn_time.update(
@@ -201,6 +340,7 @@ def train(audio_model, train_loader, test_loader, args, fabric, run=None):
             print_step = print_step or early_print_step
 
             if print_step and global_step != 0:
+                _sync_loss_meters()
                 fabric.print(
                     "Epoch: [{0}][{1}/{2}]\t"
                     "Per Sample Total Time {per_sample_time.avg:.5f}\t"
@@ -223,7 +363,7 @@ def train(audio_model, train_loader, test_loader, args, fabric, run=None):
                         loss_a2_meter=loss_a2_meter,
                         loss_v_meter=loss_v_meter,
                         loss_c_meter=loss_c_meter,
-                        c_acc=c_acc,
+                        c_acc=c_acc_meter.val,
                     ),
                     flush=True,
                 )
@@ -234,18 +374,69 @@ def train(audio_model, train_loader, test_loader, args, fabric, run=None):
                     "Loss/MAE_Midi_Audio": loss_a2_meter.val,
                     "Loss/MAE_Visual": loss_v_meter.val,
                     "Loss/Contrastive": loss_c_meter.val,
-                    "Accuracy/Contrastive": c_acc,
+                    "Accuracy/Contrastive": c_acc_meter.val,
                 }
                 # log metrics to wandb
                 run.log(values)
 
                 if np.isnan(loss_av_meter.avg):
                     fabric.print("training diverged...")
+                    checkpointer.wait()
                     return
 
             end_time = time.time()
             global_step += 1
 
+            if global_step % args.preempt_check_steps == 0 and _preemption_requested():
+                _save_checkpoint(i + 1)
+                checkpointer.wait()
+                fabric.print("checkpoint saved at epoch {:d}, #steps={:d}, exit".format(epoch, global_step))
+                return
+            if args.save_steps > 0 and global_step % args.save_steps == 0:
+                _save_checkpoint(i + 1)
+
+            # evaluate on a fixed subset of the validation set during the epoch
+            if args.eval_steps > 0 and global_step % args.eval_steps == 0:
+                _set_input_size((args.target_length, args.im_res))
+                (
+                    eval_loss_av,
+                    eval_loss_mae,
+                    eval_loss_mae_a1,
+                    eval_loss_mae_a2,
+                    eval_loss_mae_v,
+                    eval_loss_c,
+                    eval_c_acc,
+                ) = validate(audio_model, test_loader, args, fabric, max_batches=args.eval_batches)
+                fabric.print(
+                    "Subset Eval #steps={:d}\tTotal Loss {:.4f}\tAudio MAE Loss {:.4f}\tMIDI Audio MAE Loss {:.4f}\t"
+                    "Visual MAE Loss {:.4f}\tContrastive Loss {:.4f}\tContrastive Accuracy {:.4f}".format(
+                        global_step,
+                        eval_loss_av,
+                        eval_loss_mae_a1,
+                        eval_loss_mae_a2,
+                        eval_loss_mae_v,
+                        eval_loss_c,
+                        eval_c_acc,
+                    )
+                )
+                run.log(
+                    {
+                        "Subset Eval Total Loss": eval_loss_av,
+                        "Subset Eval Audio MAE Loss": eval_loss_mae_a1,
+                        "Subset Eval MIDI Audio MAE Loss": eval_loss_mae_a2,
+                        "Subset Eval Visual MAE Loss": eval_loss_mae_v,
+                        "Subset Eval Contrastive Loss": eval_loss_c,
+                        "Subset Eval Contrastive Accuracy": eval_c_acc,
+                    }
+                )
+                audio_model.train()
+                _set_input_size(stage_size)
+
+        start_step = 0
+
+        _sync_loss_meters()
+        # validate and save the model at full size
+        _set_input_size((args.target_length, args.im_res))
         fabric.print("start validation")
         (
             eval_loss_av,
@@ -303,16 +494,16 @@ def train(audio_model, train_loader, test_loader, args, fabric, run=None):
             best_loss = eval_loss_av
             best_epoch = epoch
 
-        if best_epoch == epoch:
-            fabric.save(
+        if best_epoch == epoch and fabric.global_rank == 0:
+            checkpointer.save(
                 audio_model.state_dict(), "%s/models/best_audio_model.pth" % (exp_dir)
             )
-            fabric.save(
+            checkpointer.save(
                 optimizer.state_dict(), "%s/models/best_optim_state.pth" % (exp_dir)
             )
 
-        if args.save_model == True:
-            fabric.save(
+        if args.save_model == True and fabric.global_rank == 0:
+            checkpointer.save(
                 audio_model.state_dict(),
                 "%s/models/audio_model.%d.pth" % (exp_dir, epoch),
             )
@@ -343,46 +534,33 @@ def train(audio_model, train_loader, test_loader, args, fabric, run=None):
         loss_a2_meter.reset()
         loss_v_meter.reset()
         loss_c_meter.reset()
+        c_acc_meter.reset()
 
+        _save_checkpoint(0)
 
-def validate(audio_model, val_loader, args, fabric):
-    device = fabric.device
-    batch_time = AverageMeter()
-    audio_model = fabric.to_device(audio_model)
-    if not isinstance(audio_model, nn.parallel.DistributedDataParallel):
-        audio_model = nn.parallel.DistributedDataParallel(audio_model)
-    audio_model = fabric.to_device(audio_model)
+    checkpointer.wait()
 
-    audio_model = fabric.setup(audio_model)  # Setup model for validation
-    # val_loader = fabric.setup_dataloaders(val_loader)
 
+def validate(audio_model, val_loader, args, fabric, max_batches=None):
+    """
+    Evaluate the model already set up by fabric.setup on val_loader (set up by fabric.setup_dataloaders, so each process
+    evaluates its own shard). Losses are accumulated as running sums on the device and all-reduced once at the end,
+    so all processes return the same values.
+    :param max_batches: only evaluate the first max_batches batches of each shard (a fixed subset, the loader is not shuffled)
+    """
+    device = fabric.device
     audio_model.eval()
 
-    end = time.time()
-    (
-        A_loss,
-        A_loss_mae,
-        A_loss_mae_a1,
-        A_loss_mae_a2,
-        A_loss_mae_v,
-        A_loss_c,
-        A_c_acc,
-    ) = (
-        [],
-        [],
-        [],
-        [],
-        [],
-        [],
-        [],
-    )
+    # weighted sums of loss, loss_mae, loss_mae_a1, loss_mae_a2, loss_mae_v, loss_c, c_acc, and the number of samples
+    sums = torch.zeros(8, device=device)
     with torch.no_grad():
         for i, (a1_input, a2_input, v_input, _) in enumerate(val_loader):
+            if max_batches != None and i >= max_batches:
+                break
             a1_input = fabric.to_device(a1_input)
             a2_input = fabric.to_device(a2_input)
             v_input = fabric.to_device(v_input)
-            
-                
+
             (loss,
             loss_mae,
             loss_mae_a1,
@@ -403,33 +581,17 @@ def validate(audio_model, val_loader, args, fabric):
             mask_mode=args.mask_mode,
             )
 
-            # loss, loss_mae, loss_mae_a1, loss_mae_a2, loss_mae_v, loss_c, c_acc = (
-            #     loss.sum(),
-            #     loss_mae.sum(),
-            #     loss_mae_a1.sum(),
-            #     loss_mae_a2.sum(),
-            #     loss_mae_v.sum(),
-            #     loss_c.sum(),
-            #     c_acc.mean(),
-            # )
-
-            A_loss.append(loss.to("cpu").detach())
-            A_loss_mae.append(loss_mae.to("cpu").detach())
-            A_loss_mae_a1.append(loss_mae_a1.to("cpu").detach())
-            A_loss_mae_a2.append(loss_mae_a2.to("cpu").detach())
-            A_loss_mae_v.append(loss_mae_v.to("cpu").detach())
-            A_loss_c.append(loss_c.to("cpu").detach())
-            A_c_acc.append(c_acc.to("cpu").detach())
-            batch_time.update(time.time() - end)
-            end = time.time()
-
-        loss = np.mean(A_loss)
-        loss_mae = np.mean(A_loss_mae)
-        loss_mae_a1 = np.mean(A_loss_mae_a1)
-        loss_mae_a2 = np.mean(A_loss_mae_a2)
-        loss_mae_v = np.mean(A_loss_mae_v)
-        loss_c = np.mean(A_loss_c)
-        c_acc = np.mean(A_c_acc)
+            batch_size = a1_input.size(0)
+            batch_stats = torch.stack(
+                [loss, loss_mae, loss_mae_a1, loss_mae_a2, loss_mae_v, loss_c, c_acc]
+            ).float()
+            sums[:7] += batch_stats * batch_size
+            sums[7] += batch_size
+
+    sums = fabric.all_reduce(sums, reduce_op="sum").tolist()
+    count = max(sums[7], 1.0)
+    loss, loss_mae, loss_mae_a1, loss_mae_a2, loss_mae_v, loss_c, c_acc = [
+        total / count for total in sums[:7]
+    ]
 
     return loss, loss_mae, loss_mae_a1, loss_mae_a2, loss_mae_v, loss_c, c_acc
-
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+# @Time    : 10/19/26 9:00 PM
+# @Author  : Ben Chou
+# @Affiliation  : Purdue University
+# @Email   : chou150@purdue.edu
+# @File    : traintest_distill.py
+
+# knowledge distillation of a finetuned CAVMAEFT teacher into a smaller CAVMAEFT student.
+# the student is trained with the label loss, a logit loss (soft targets of the teacher at temperature kd_temperature)
+# and a pooled feature loss (mse between the projected pooled student representation and the pooled teacher representation).
+# the teacher outputs are either computed online on the same (augmented) batch, or cached once to disk
+# (float16 memory-mapped .npy), in which case the student is trained on the same un-augmented inputs as the cache.
+
+import sys
+import os
+import datetime
+import json
+sys.path.append(os.path.dirname(os.path.dirname(sys.path[0])))
+from utilities import *
+import time
+import torch
+from torch import nn
+import numpy as np
+import pickle
+from torch.utils.data import Dataset
+from torch.cuda.amp import autocast, GradScaler
+from models.audio_mdl import CAVMAEFTAudio
+from feature_cache import get_frame_use, load_cache_meta, write_memmap_cache
+from traintest_ft import validate
+
+class LogitFeatureModel(nn.Module):
+    """
+    Returns both the logits and the pooled representation (the input of mlp_head) of a CAVMAEFT or CAVMAEFTAudio
+    (which always runs its audio only path, v and mode are not used).
+    If proj_dim is given, the pooled representation is linearly projected to proj_dim (the teacher dimension).
+    """
+    def __init__(self, audio_model, proj_dim=None):
+        super().__init__()
+        self.audio_model = audio_model
+        embed_dim = audio_model.mlp_head[1].in_features
+        self.feat_proj = nn.Linear(embed_dim, proj_dim) if proj_dim != None else None
+
+    def forward(self, a, v, mode):
+        if isinstance(self.audio_model, CAVMAEFTAudio):
+            x = self.audio_model(a).mean(dim=1)
+        else:
+            a, v = self.audio_model.forward_modality_specific(a, v, mode)
+            x = self.audio_model.forward_unified(a, v, mode)
+        logits = self.audio_model.mlp_head(x)
+        if self.feat_proj != None:
+            x = self.feat_proj(x)
+        return logits, x
+
+def distill_loss(student_logits, student_feat, teacher_logits, teacher_feat, labels, args):
+    """
+    (1 - kd_alpha) * label loss + kd_alpha * logit loss + feat_weight * feature loss.
+    The logit loss is bce with the teacher sigmoid for BCE tasks and kl divergence with the teacher softmax for CE tasks,
+    both at temperature kd_temperature and scaled by kd_temperature ** 2. Returns the total loss and the three parts.
+    """
+    student_logits, teacher_logits = student_logits.float(), teacher_logits.float()
+    t = args.kd_temperature
+    label_loss = args.loss_fn(student_logits, labels)
+    if args.loss == 'BCE':
+        logit_loss = nn.functional.binary_cross_entropy_with_logits(student_logits / t, torch.sigmoid(teacher_logits / t))
+    else:
+        logit_loss = nn.functional.kl_div(nn.functional.log_softmax(student_logits / t, dim=-1), nn.functional.log_softmax(teacher_logits / t, dim=-1),
+                                          reduction='batchmean', log_target=True)
+    logit_loss = logit_loss * t * t
+    feat_loss = nn.functional.mse_loss(student_feat.float(), teacher_feat.float())
+    loss = (1 - args.kd_alpha) * label_loss + args.kd_alpha * logit_loss + args.feat_weight * feat_loss
+    return loss, label_loss, logit_loss, feat_loss
+
+def get_teacher_cache_meta(dataset, ftmode, data, teacher_path, teacher_config=None, label_csv=None):
+    return {'ftmode': ftmode, 'frame_use': get_frame_use(dataset), 'num_samples': len(dataset), 'data': data, 'teacher_path': teacher_path, 'teacher_config': teacher_config,
+            'label_csv': label_csv, 'audio_conf': json.loads(json.dumps(dataset.audio_conf, sort_keys=True))}
+
+def build_teacher_cache(teacher, data_loader, cache_dir, ftmode, meta):
+    """
+    Run the teacher over data_loader (must not shuffle or drop samples) and write
+    cache_dir/{logits,feat}.npy [num_samples, ...] in float16 (see write_memmap_cache).
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    teacher = LogitFeatureModel(teacher)
+    teacher = nn.DataParallel(teacher).to(device)
+    teacher.eval()
+
+    def compute_fn(a_input, v_input, labels):
+        with autocast():
+            logits, feat = teacher(a_input.to(device), v_input.to(device), ftmode)
+        return {'logits': logits, 'feat': feat}
+
+    begin_time = time.time()
+    print('now cache the teacher outputs of {:d} samples to {:s}'.format(meta['num_samples'], cache_dir))
+    write_memmap_cache(compute_fn, data_loader, cache_dir, meta)
+    print('teacher caching finished in {:.3f} seconds'.format(time.time() - begin_time))
+
+class TeacherCacheDataset(Dataset):
+    def __init__(self, dataset, cache_dir):
+        """
+        Returns the samples of dataset (built without augmentation, the same as the cache) with the cached teacher outputs,
+        i.e., (fbank, image, label, teacher_logits, teacher_feat).
+        """
+        self.dataset = dataset
+        self.logits = np.load(os.path.join(cache_dir, 'logits.npy'), mmap_mode='r')
+        self.feat = np.load(os.path.join(cache_dir, 'feat.npy'), mmap_mode='r')
+
+    def __getitem__(self, index):
+        fbank, image, label = self.dataset[index]
+        logits = torch.from_numpy(self.logits[index].astype(np.float32))
+        feat = torch.from_numpy(self.feat[index].astype(np.float32))
+        return fbank, image, label, logits, feat
+
+    def __len__(self):
+        return len(self.dataset)
+
+def get_teacher_cache_loader(teacher, cache_loader, cache_dir, args, data, shuffle=True, sampler=None):
+    """
+    Build the teacher cache from cache_loader if it does not exist or was built with a different setting,
+    returns a loader of TeacherCacheDataset over the same dataset.
+    """
+    meta = get_teacher_cache_meta(cache_loader.dataset, args.ftmode, data, args.teacher_path, args.teacher_config, args.label_csv)
+    if load_cache_meta(cache_dir) != meta:
+        build_teacher_cache(teacher, cache_loader, cache_dir, args.ftmode, meta)
+    else:
+        print('now load the teacher cache from {:s}'.format(cache_dir))
+    return torch.utils.data.DataLoader(TeacherCacheDataset(cache_loader.dataset, cache_dir), batch_size=args.batch_size, shuffle=shuffle if sampler == None else False,
+                                       sampler=sampler, num_workers=args.num_workers, pin_memory=True, drop_last=True)
+
+def train(student, teacher, train_loader, test_loader, args):
+    """
+    Train student (CAVMAEFT) from teacher (CAVMAEFT or CAVMAEFTAudio), teacher can be None if train_loader returns cached teacher outputs.
+    The best student is saved as exp_dir/models/best_audio_model.pth, loadable as a CAVMAEFT wrapped in DataParallel.
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print('running on ' + str(device))
+    torch.set_grad_enabled(True)
+
+    batch_time, per_sample_time, data_time, per_sample_data_time, per_sample_dnn_time = AverageMeter(), AverageMeter(), AverageMeter(), AverageMeter(), AverageMeter()
+    loss_meter, label_loss_meter, logit_loss_meter, feat_loss_meter = DeviceAverageMeter(), DeviceAverageMeter(), DeviceAverageMeter(), DeviceAverageMeter()
+    progress = []
+    best_epoch, best_mAP, best_acc = 0, -np.inf, -np.inf
+    global_step, epoch = 0, 0
+    start_time = time.time()
+    exp_dir = args.exp_dir
+
+    def _save_progress():
+        progress.append([epoch, global_step, best_epoch, best_mAP, time.time() - start_time])
+        with open('%s/progress.pkl' % exp_dir, 'wb') as f:
+            pickle.dump(progress, f)
+
+    if isinstance(student, nn.DataParallel):
+        student = student.module
+    if isinstance(teacher, nn.DataParallel):
+        teacher = teacher.module
+    # the student pooled representation is projected to the teacher dimension for the feature loss
+    teacher_dim = teacher.mlp_head[1].in_features if teacher != None else train_loader.dataset.feat.shape[1]
+    student_model = nn.DataParallel(LogitFeatureModel(student, teacher_dim)).to(device)
+    # the plain student, used for validation and saving
+    audio_model = nn.DataParallel(student)
+    if teacher != None:
+        teacher = nn.DataParallel(LogitFeatureModel(teacher)).to(device)
+        teacher.eval()
+        for param in teacher.parameters():
+            param.requires_grad = False
+
+    trainables = [p for p in student_model.parameters() if p.requires_grad]
+    print('Total student parameter number is : {:.3f} million'.format(sum(p.numel() for p in student.parameters()) / 1e6))
+    if teacher != None:
+        print('Total teacher parameter number is : {:.3f} million'.format(sum(p.numel() for p in teacher.parameters()) / 1e6))
+    else:
+        print('Train from the teacher cache.')
+
+    optimizer = torch.optim.AdamW(trainables, lr=args.lr, weight_decay=5e-7, betas=(0.95, 0.999))
+    print('student lr : ', args.lr)
+
+    scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, list(range(args.lrscheduler_start, 1000, args.lrscheduler_step)), gamma=args.lrscheduler_decay)
+    print('The learning rate scheduler starts at {:d} epoch with decay rate of {:.3f} every {:d} epoches'.format(args.lrscheduler_start, args.lrscheduler_decay, args.lrscheduler_step))
+    main_metrics = args.metrics
+    if args.loss == 'BCE':
+        loss_fn = nn.BCEWithLogitsLoss()
+    elif args.loss == 'CE':
+        loss_fn = nn.CrossEntropyLoss()
+    args.loss_fn = loss_fn
+
+    print('now distilling with {:s}, main metrics: {:s}, loss function: {:s}, kd alpha {:.3f}, kd temperature {:.3f}, feature loss weight {:.3f}'.format(
+        str(args.dataset), str(main_metrics), str(loss_fn), args.kd_alpha, args.kd_temperature, args.feat_weight))
+
+    epoch += 1
+    scaler = GradScaler()
+
+    print("current #steps=%s, #epochs=%s" % (global_step, epoch))
+    print("start training...")
+    result = np.zeros([args.n_epochs, 4])
+    while epoch < args.n_epochs + 1:
+        begin_time = time.time()
+        end_time = time.time()
+        student_model.train()
+        print('---------------')
+        print(datetime.datetime.now())
+        print("current #epochs=%s, #steps=%s" % (epoch, global_step))
+
+        for i, batch in enumerate(train_loader):
+            a_input, v_input, labels = batch[0], batch[1], batch[2]
+            batch_size = a_input.size(0)
+            a_input, v_input = a_input.to(device, non_blocking=True), v_input.to(device, non_blocking=True)
+            labels = labels.to(device, non_blocking=True)
+
+            data_time.update(time.time() - end_time)
+            per_sample_data_time.update((time.time() - end_time) / a_input.shape[0])
+            dnn_start_time = time.time()
+
+            with autocast():
+                if teacher != None:
+                    with torch.no_grad():
+                        teacher_logits, teacher_feat = teacher(a_input, v_input, args.ftmode)
+                else:
+                    teacher_logits = batch[3].to(device, non_blocking=True)
+                    teacher_feat = batch[4].to(device, non_blocking=True)
+                student_logits, student_feat = student_model(a_input, v_input, args.ftmode)
+                loss, label_loss, logit_loss, feat_loss = distill_loss(student_logits, student_feat, teacher_logits, teacher_feat, labels, args)
+
+            optimizer.zero_grad()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+
+            # accumulated on the device, synced every n_print_steps
+            loss_meter.update(loss, batch_size)
+            label_loss_meter.update(label_loss, batch_size)
+            logit_loss_meter.update(logit_loss, batch_size)
+            feat_loss_meter.update(feat_loss, batch_size)
+            batch_time.update(time.time() - end_time)
+            per_sample_time.update((time.time() - end_time) / a_input.shape[0])
+            per_sample_dnn_time.update((time.time() - dnn_start_time) / a_input.shape[0])
+
+            print_step = global_step % args.n_print_steps == 0
+            early_print_step = epoch == 0 and global_step % (args.n_print_steps / 10) == 0
+            print_step = print_step or early_print_step
+
+            if print_step and global_step != 0:
+                sync_device_meters([loss_meter, label_loss_meter, logit_loss_meter, feat_loss_meter])
+                print('Epoch: [{0}][{1}/{2}]\t'
+                  'Per Sample Total Time {per_sample_time.avg:.5f}\t'
+                  'Per Sample Data Time {per_sample_data_time.avg:.5f}\t'
+                  'Per Sample DNN Time {per_sample_dnn_time.avg:.5f}\t'
+                  'Train Loss {loss_meter.val:.4f}\t'
+                  'Label Loss {label_loss_meter.val:.4f}\t'
+                  'Logit Loss {logit_loss_meter.val:.4f}\t'
+                  'Feature Loss {feat_loss_meter.val:.4f}\t'.format(
+                   epoch, i, len(train_loader), per_sample_time=per_sample_time, per_sample_data_time=per_sample_data_time,
+                      per_sample_dnn_time=per_sample_dnn_time, loss_meter=loss_meter, label_loss_meter=label_loss_meter,
+                      logit_loss_meter=logit_loss_meter, feat_loss_meter=feat_loss_meter), flush=True)
+                if np.isnan(loss_meter.avg):
+                    print('training diverged...')
+                    return
+
+            end_time = time.time()
+            global_step += 1
+
+        sync_device_meters([loss_meter, label_loss_meter, logit_loss_meter, feat_loss_meter])
+        print('start validation')
+
+        stats, valid_loss = validate(audio_model, test_loader, args)
+
+        mAP = np.mean([stat['AP'] for stat in stats])
+        mAUC = np.mean([stat['auc'] for stat in stats])
+        acc = stats[0]['acc']
+
+        if main_metrics == 'mAP':
+            print("mAP: {:.6f}".format(mAP))
+        else:
+            print("acc: {:.6f}".format(acc))
+        print("AUC: {:.6f}".format(mAUC))
+        print("d_prime: {:.6f}".format(d_prime(mAUC)))
+        print("train_loss: {:.6f}".format(loss_meter.avg))
+        print("valid_loss: {:.6f}".format(valid_loss))
+
+        result[epoch - 1, :] = [acc, mAP, mAUC, optimizer.param_groups[0]['lr']]
+        np.savetxt(exp_dir + '/result.csv', result, delimiter=',')
+        print('validation finished')
+
+        if mAP > best_mAP:
+            best_mAP = mAP
+            if main_metrics == 'mAP':
+                best_epoch = epoch
+
+        if acc > best_acc:
+            best_acc = acc
+            if main_metrics == 'acc':
+                best_epoch = epoch
+
+        if best_epoch == epoch:
+            torch.save(audio_model.state_dict(), "%s/models/best_audio_model.pth" % (exp_dir))
+            torch.save(optimizer.state_dict(), "%s/models/best_optim_state.pth" % (exp_dir))
+        if args.save_model == True:
+            torch.save(audio_model.state_dict(), "%s/models/audio_model.%d.pth" % (exp_dir, epoch))
+
+        scheduler.step()
+
+        print('Epoch-{0} lr: {1}'.format(epoch, optimizer.param_groups[0]['lr']))
+
+        with open(exp_dir + '/stats_' + str(epoch) + '.pickle', 'wb') as handle:
+            pickle.dump(stats, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        _save_progress()
+
+        finish_time = time.time()
+        print('epoch {:d} training time: {:.3f}'.format(epoch, finish_time - begin_time))
+
+        epoch += 1
+
+        batch_time.reset()
+        per_sample_time.reset()
+        data_time.reset()
+        per_sample_data_time.reset()
+        per_sample_dnn_time.reset()
+        loss_meter.reset()
+        label_loss_meter.reset()
+        logit_loss_meter.reset()
+        feat_loss_meter.reset()
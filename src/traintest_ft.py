@@ -36,7 +36,7 @@ def train(audio_model, train_loader, test_loader, args):
         AverageMeter(),
         AverageMeter(),
         AverageMeter(),
-        AverageMeter(),
+        DeviceAverageMeter(),
         AverageMeter(),
     )
     progress = []
@@ -80,12 +80,24 @@ def train(audio_model, train_loader, test_loader, args):
         "mlp_head_concat.1.weight",
         "mlp_head_concat.1.bias",
     ]
+    # the early-exit heads are also newly initialized
+    is_mlp = lambda name: name in mlp_list or name.startswith("exit_heads.")
     mlp_params = list(
-        filter(lambda kv: kv[0] in mlp_list, audio_model.module.named_parameters())
+        filter(lambda kv: is_mlp(kv[0]), audio_model.module.named_parameters())
     )
     base_params = list(
-        filter(lambda kv: kv[0] not in mlp_list, audio_model.module.named_parameters())
+        filter(lambda kv: not is_mlp(kv[0]), audio_model.module.named_parameters())
     )
+    # when training from a feature cache (see feature_cache.py), the layers before the cached features are never run, so freeze them
+    # 'pooled': only mlp_head is trained; 'token': blocks_u, the final norms and mlp_head are trained
+    feature_level = getattr(train_loader.dataset, "feature_level", None)
+    unified_prefix = ("blocks_u.", "norm.", "norm_a.", "norm_v.")
+    cached_params = [
+        i[1]
+        for i in base_params
+        if feature_level == "pooled"
+        or (feature_level == "token" and not i[0].startswith(unified_prefix))
+    ]
     mlp_params = [i[1] for i in mlp_params]
     base_params = [i[1] for i in base_params]
 
@@ -94,6 +106,10 @@ def train(audio_model, train_loader, test_loader, args):
         print("Pretrained backbone parameters are frozen.")
         for param in base_params:
             param.requires_grad = False
+    if feature_level != None:
+        print("Train from {:s} feature cache, cached backbone parameters are frozen.".format(feature_level))
+        for param in cached_params:
+            param.requires_grad = False
 
     trainables = [p for p in audio_model.parameters() if p.requires_grad]
     print(
@@ -165,12 +181,47 @@ def train(audio_model, train_loader, test_loader, args):
         )
     )
 
+    # in-memory weight averaging over epochs [wa_start, wa_end], replaces saving and reloading every epoch checkpoint
+    # updated every wa_interval steps, or at the end of each epoch if wa_interval is 0
+    if args.wa == True:
+        wa_averager = WeightAverager(
+            audio_model, decay=args.wa_decay, device="cpu" if args.wa_cpu == True else None
+        )
+        print(
+            "weight averaging from epoch {:d} to {:d}, {:s}, updated every {:s}".format(
+                args.wa_start,
+                args.wa_end,
+                "equal weight" if args.wa_decay == None else "ema decay {:.5f}".format(args.wa_decay),
+                "epoch" if args.wa_interval == 0 else "{:d} steps".format(args.wa_interval),
+            )
+        )
+    else:
+        wa_averager = None
+
     epoch += 1
     scaler = GradScaler()
 
+    result = np.zeros([args.n_epochs, 4])
+    # resumable checkpoint written at the end of every epoch, it holds the weight average so a restarted run keeps it
+    ckpt_path = "%s/models/checkpoint.pth" % exp_dir
+    if args.auto_resume == True and os.path.exists(ckpt_path):
+        checkpoint = torch.load(ckpt_path, map_location="cpu", weights_only=False)
+        audio_model.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        scheduler.load_state_dict(checkpoint["scheduler"])
+        scaler.load_state_dict(checkpoint["scaler"])
+        epoch, global_step = checkpoint["epoch"] + 1, checkpoint["global_step"]
+        best_epoch, best_mAP, best_acc = checkpoint["best_epoch"], checkpoint["best_mAP"], checkpoint["best_acc"]
+        num_rows = min(len(result), len(checkpoint["result"]))
+        result[:num_rows] = checkpoint["result"][:num_rows]
+        progress.extend(checkpoint["progress"])
+        if wa_averager != None and checkpoint["wa"] != None:
+            wa_averager.load_state_dict(checkpoint["wa"])
+        print("now resume training from {:s}, epoch {:d}, #steps={:d}".format(ckpt_path, epoch, global_step))
+        del checkpoint
+
     print("current #steps=%s, #epochs=%s" % (global_step, epoch))
     print("start training...")
-    result = np.zeros([args.n_epochs, 4])
     audio_model.train()
     while epoch < args.n_epochs + 1:
         begin_time = time.time()
@@ -180,6 +231,17 @@ def train(audio_model, train_loader, test_loader, args):
         print(datetime.datetime.now())
         print("current #epochs=%s, #steps=%s" % (epoch, global_step))
 
+        # token drop fine-tuning, the last full_token_epochs epochs are trained with all tokens
+        if args.token_keep_a < 1.0 or args.token_keep_v < 1.0:
+            full_token = epoch > args.n_epochs - args.full_token_epochs
+            audio_model.module.token_keep_a = 1.0 if full_token else args.token_keep_a
+            audio_model.module.token_keep_v = 1.0 if full_token else args.token_keep_v
+            print(
+                "keep {:.2f} of audio tokens and {:.2f} of visual tokens in training".format(
+                    audio_model.module.token_keep_a, audio_model.module.token_keep_v
+                )
+            )
+
         for i, (a_input, v_input, labels) in enumerate(train_loader):
             batch_size = a_input.size(0)
             a_input, v_input = a_input.to(device, non_blocking=True), v_input.to(
@@ -192,15 +254,32 @@ def train(audio_model, train_loader, test_loader, args):
             dnn_start_time = time.time()
 
             with autocast():
-                audio_output = audio_model(a_input, v_input, args.ftmode)
-                loss = loss_fn(audio_output, labels)
+                audio_output = audio_model(a_input, v_input, args.ftmode, feature_level)
+                if isinstance(audio_output, tuple):
+                    # the model has early-exit heads, trained jointly with the average loss of the exits
+                    audio_output, exit_output = audio_output
+                    exit_loss = torch.stack(
+                        [loss_fn(exit_output[:, k], labels) for k in range(exit_output.shape[1])]
+                    ).mean()
+                    loss = loss_fn(audio_output, labels) + args.exit_weight * exit_loss
+                else:
+                    loss = loss_fn(audio_output, labels)
 
             optimizer.zero_grad()
             scaler.scale(loss).backward()
             scaler.step(optimizer)
             scaler.update()
 
-            loss_meter.update(loss.item(), batch_size)
+            if (
+                wa_averager != None
+                and args.wa_interval > 0
+                and args.wa_start <= epoch <= args.wa_end
+                and global_step % args.wa_interval == 0
+            ):
+                wa_averager.update(audio_model)
+
+            # accumulated on the device, synced every n_print_steps
+            loss_meter.update(loss, batch_size)
             batch_time.update(time.time() - end_time)
             per_sample_time.update((time.time() - end_time) / a_input.shape[0])
             per_sample_dnn_time.update(
@@ -214,6 +293,7 @@ def train(audio_model, train_loader, test_loader, args):
             print_step = print_step or early_print_step
 
             if print_step and global_step != 0:
+                sync_device_meters([loss_meter])
                 print(
                     "Epoch: [{0}][{1}/{2}]\t"
                     "Per Sample Total Time {per_sample_time.avg:.5f}\t"
@@ -237,6 +317,7 @@ def train(audio_model, train_loader, test_loader, args):
             end_time = time.time()
             global_step += 1
 
+        sync_device_meters([loss_meter])
         print("start validation")
 
         stats, valid_loss = validate(audio_model, test_loader, args)
@@ -283,6 +364,10 @@ def train(audio_model, train_loader, test_loader, args):
                 "%s/models/audio_model.%d.pth" % (exp_dir, epoch),
             )
 
+        if wa_averager != None and args.wa_start <= epoch <= args.wa_end:
+            if args.wa_interval == 0:
+                wa_averager.update(audio_model)
+
         if isinstance(scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
             if main_metrics == "mAP":
                 scheduler.step(mAP)
@@ -296,6 +381,23 @@ def train(audio_model, train_loader, test_loader, args):
         with open(exp_dir + "/stats_" + str(epoch) + ".pickle", "wb") as handle:
             pickle.dump(stats, handle, protocol=pickle.HIGHEST_PROTOCOL)
         _save_progress()
+        torch.save(
+            {
+                "model": audio_model.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "scheduler": scheduler.state_dict(),
+                "scaler": scaler.state_dict(),
+                "epoch": epoch,
+                "global_step": global_step,
+                "best_epoch": best_epoch,
+                "best_mAP": best_mAP,
+                "best_acc": best_acc,
+                "result": result,
+                "progress": progress,
+                "wa": wa_averager.state_dict() if wa_averager != None else None,
+            },
+            ckpt_path,
+        )
 
         finish_time = time.time()
         print(
@@ -311,6 +413,10 @@ def train(audio_model, train_loader, test_loader, args):
         loss_meter.reset()
         per_sample_dnn_time.reset()
 
+    if wa_averager != None:
+        print("wa {:d} updates from epoch {:d} to {:d}".format(wa_averager.n_averaged, args.wa_start, args.wa_end))
+        torch.save(wa_averager.model_state_dict(), "%s/models/audio_model_wa.pth" % (exp_dir))
+
 
 def validate(audio_model, val_loader, args, output_pred=False):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -319,6 +425,12 @@ def validate(audio_model, val_loader, args, output_pred=False):
         audio_model = nn.DataParallel(audio_model)
     audio_model = audio_model.to(device)
     audio_model.eval()
+    feature_level = getattr(val_loader.dataset, "feature_level", None)
+
+    # streaming evaluation keeps per-class score histograms instead of all predictions (approximate mAP / AUC),
+    # not used when the predictions are returned
+    if getattr(args, "streaming_eval", False) == True and output_pred == False:
+        return validate_streaming(audio_model, val_loader, args, feature_level)
 
     end = time.time()
     A_predictions, A_targets, A_loss = [], [], []
@@ -329,7 +441,7 @@ def validate(audio_model, val_loader, args, output_pred=False):
 
             # perform automatic mixed precision (AMP) training
             with autocast():
-                audio_output = audio_model(a_input, v_input, args.ftmode)
+                audio_output = audio_model(a_input, v_input, args.ftmode, feature_level)
 
             predictions = audio_output.to("cpu").detach()
 
@@ -355,3 +467,117 @@ def validate(audio_model, val_loader, args, output_pred=False):
     else:
         # used for multi-frame evaluation (i.e., ensemble over frames), so return prediction and target
         return stats, audio_output, target
+
+
+def validate_early_exit(audio_model, val_loader, args):
+    """
+    Early-exit evaluation of a model with exit heads at each threshold of args.exit_thresholds, and without early exit.
+    Each batch is run once per threshold. Returns one row per threshold (the last row without early exit):
+    [threshold, mAP, acc, average layers used, fraction of the samples exited early, ms per sample].
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if isinstance(audio_model, nn.DataParallel):
+        audio_model = audio_model.module
+    audio_model = audio_model.to(device)
+    audio_model.eval()
+    num_layers = len(audio_model.blocks_a) + len(audio_model.blocks_u)
+    # a threshold above 1 never exits
+    thresholds = list(args.exit_thresholds) + [float("inf")]
+
+    A_predictions = [[] for t in thresholds]
+    A_layers = [[] for t in thresholds]
+    A_time = [0.0 for t in thresholds]
+    A_targets = []
+    with torch.no_grad():
+        for i, (a_input, v_input, labels) in enumerate(val_loader):
+            a_input = a_input.to(device)
+            v_input = v_input.to(device)
+            for j, threshold in enumerate(thresholds):
+                begin_time = time.time()
+                with autocast():
+                    audio_output, layers = audio_model.forward_early_exit(
+                        a_input, v_input, args.ftmode, threshold, softmax=args.loss == "CE"
+                    )
+                audio_output = audio_output.to("cpu")
+                A_time[j] += time.time() - begin_time
+                A_predictions[j].append(audio_output)
+                A_layers[j].append(layers.to("cpu"))
+            A_targets.append(labels)
+
+    target = torch.cat(A_targets)
+    res = []
+    for j, threshold in enumerate(thresholds):
+        stats = calculate_stats(torch.cat(A_predictions[j]), target)
+        layers = torch.cat(A_layers[j]).float()
+        res.append(
+            [
+                threshold,
+                np.mean([stat["AP"] for stat in stats]),
+                stats[0]["acc"],
+                layers.mean().item(),
+                (layers < num_layers).float().mean().item(),
+                1000 * A_time[j] / target.shape[0],
+            ]
+        )
+        print(
+            "threshold {:s}: mAP {:.4f}, acc {:.4f}, average layers {:.2f} / {:d}, {:.3f} exited early, {:.2f} ms per sample".format(
+                "none" if threshold > 1 else "{:.3f}".format(threshold), res[-1][1], res[-1][2], res[-1][3], num_layers, res[-1][4], res[-1][5]
+            )
+        )
+    return res
+
+
+def validate_multiframe(audio_model, val_loader, args):
+    """
+    Multi-frame evaluation in one pass, the dataset is built with multi_frame=True and returns all frames of each clip.
+    The audio of a clip is decoded and run through blocks_a once, all frames run through blocks_v as one batch.
+    Returns the per-frame predictions [total_frame, num_samples, n_class] and the target.
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if not isinstance(audio_model, nn.DataParallel):
+        audio_model = nn.DataParallel(audio_model)
+    audio_model = audio_model.to(device)
+    audio_model.eval()
+
+    A_predictions, A_targets = [], []
+    with torch.no_grad():
+        for i, (a_input, v_input, labels) in enumerate(val_loader):
+            a_input = a_input.to(device)
+            v_input = v_input.to(device)
+
+            with autocast():
+                audio_output = audio_model(a_input, v_input, args.ftmode)
+
+            A_predictions.append(audio_output.to("cpu").detach())
+            A_targets.append(labels)
+
+    # [num_samples, total_frame, n_class] -> [total_frame, num_samples, n_class]
+    audio_output = torch.cat(A_predictions).transpose(0, 1)
+    target = torch.cat(A_targets)
+    return audio_output, target
+
+
+def validate_streaming(audio_model, val_loader, args, feature_level=None):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    stats_meter = StreamingStats(args.n_class, bins=args.streaming_bins, device=device)
+    loss_sum, loss_count = torch.zeros([], device=device), 0
+    with torch.no_grad():
+        for i, (a_input, v_input, labels) in enumerate(val_loader):
+            a_input = a_input.to(device)
+            v_input = v_input.to(device)
+            labels = labels.to(device)
+
+            with autocast():
+                audio_output = audio_model(a_input, v_input, args.ftmode, feature_level)
+
+            stats_meter.update(audio_output, labels)
+            loss_sum += args.loss_fn(audio_output, labels).float() * labels.shape[0]
+            loss_count += labels.shape[0]
+
+    stats = stats_meter.compute()
+    print(
+        "streaming evaluation with {:d} bins, mAP error bound {:.6f}".format(
+            args.streaming_bins, np.mean([stat["AP_error"] for stat in stats])
+        )
+    )
+    return stats, loss_sum.item() / max(loss_count, 1)
@@ -6,4 +6,5 @@
 # @File    : __init__.py
 
 from .util import *
-from .stats import *
\ No newline at end of file
+from .stats import *
+from .checkpoint import *
@@ -0,0 +1,94 @@
+import os
+import copy
+import queue
+import random
+import signal
+import threading
+import numpy as np
+import torch
+
+
+def state_to_cpu(state):
+    """Copy a (nested) checkpoint state to cpu, so it is not changed by the following training steps."""
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, np.ndarray):
+        return state.copy()
+    if isinstance(state, dict):
+        return {k: state_to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(v) for v in state)
+    return copy.deepcopy(state)
+
+
+def get_rng_state():
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state["cuda"])
+
+
+class AsyncCheckpointer(object):
+    """
+    Writes checkpoints with torch.save on a background thread.
+    save() copies the state to cpu and returns, the file is written while training continues.
+    Files are written to a temporary path and renamed, so a killed job never leaves a partial checkpoint.
+    """
+
+    def __init__(self, max_pending=4):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _worker(self):
+        while True:
+            state, path = self.queue.get()
+            try:
+                tmp_path = path + ".tmp"
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("failed to write checkpoint") from error
+
+    def save(self, state, path):
+        self._check_error()
+        self.queue.put((state_to_cpu(state), path))
+
+    def wait(self):
+        # block until all pending checkpoints are written
+        self.queue.join()
+        self._check_error()
+
+
+class PreemptionHandler(object):
+    """
+    Records SIGTERM / SIGUSR1 (sent by the scheduler before a job is preempted or killed) instead of exiting immediately,
+    so the training loop can save a checkpoint at the end of the current step and then exit.
+    """
+
+    def __init__(self, signals=(signal.SIGTERM, signal.SIGUSR1)):
+        self.requested = False
+        for signum in signals:
+            signal.signal(signum, self._handler)
+
+    def _handler(self, signum, frame):
+        print("received signal {:d}, save a checkpoint and exit after the current step".format(signum), flush=True)
+        self.requested = True
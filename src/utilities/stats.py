@@ -8,7 +8,120 @@ def d_prime(auc):
     d_prime = standard_normal.ppf(auc) * np.sqrt(2.0)
     return d_prime
 
-def calculate_stats(output, target):
+def _binary_curves(sorted_score, sorted_target):
+    """Precision/recall and ROC curves of one class from its scores sorted in descending order, same as sklearn
+    precision_recall_curve and roc_curve (with drop_intermediate), before down-sampling."""
+    # the last sample of each group of tied scores is a threshold
+    threshold_idxs = np.r_[np.where(np.diff(sorted_score))[0], sorted_score.size - 1]
+    tps = np.cumsum(sorted_target)[threshold_idxs]
+    fps = 1 + threshold_idxs - tps
+
+    precisions = np.hstack(((tps / (tps + fps))[::-1], 1))
+    recalls = np.hstack(((tps / tps[-1])[::-1], 0))
+
+    if fps.shape[0] > 2:
+        optimal_idxs = np.where(np.r_[True, np.logical_or(np.diff(fps, 2), np.diff(tps, 2)), True])[0]
+        fps, tps = fps[optimal_idxs], tps[optimal_idxs]
+    fpr = np.r_[0, fps] / fps[-1]
+    tpr = np.r_[0, tps] / tps[-1]
+    return precisions, recalls, fpr, tpr
+
+
+def calculate_stats(output, target, class_chunk=128):
+    """Calculate statistics including mAP, AUC, etc.
+
+    Each class column is sorted once and AP / AUC of all classes are computed with array operations,
+    the output is the same as calculate_stats_sklearn up to floating point rounding.
+
+    Args:
+      output: 2d array, (samples_num, classes_num)
+      target: 2d array, (samples_num, classes_num)
+      class_chunk: number of classes processed together, bounds the memory use
+
+    Returns:
+      stats: list of statistic of each class.
+    """
+
+    output = np.asarray(output)
+    target = np.asarray(target)
+    samples_num, classes_num = target.shape
+    stats = []
+
+    # Accuracy, only used for single-label classification such as esc-50, not for multiple label one such as AudioSet
+    acc = metrics.accuracy_score(np.argmax(target, 1), np.argmax(output, 1))
+
+    positives = (target == 1).sum(0)
+    negatives = samples_num - positives
+    rank = np.arange(1, samples_num + 1, dtype=np.float64)
+    position = np.arange(samples_num)
+
+    for start in range(0, classes_num, class_chunk):
+        # [classes, samples], so that each class is a contiguous row
+        score = np.ascontiguousarray(output[:, start : start + class_chunk].T)
+        label = np.ascontiguousarray((target[:, start : start + class_chunk] == 1).T).astype(np.float64)
+        pos = positives[start : start + class_chunk]
+        neg = negatives[start : start + class_chunk]
+
+        # sort each class once, in descending order of score, the order within tied scores does not change the result
+        order = np.argsort(score, axis=1)[:, ::-1]
+        sorted_score = np.take_along_axis(score, order, 1)
+        sorted_label = np.take_along_axis(label, order, 1)
+
+        # tied scores form a group, the last sample of a group is a threshold
+        is_threshold = np.ones(sorted_score.shape, dtype=bool)
+        is_threshold[:, :-1] = sorted_score[:, 1:] != sorted_score[:, :-1]
+        group_end = np.where(is_threshold, position, samples_num - 1)
+        group_end = np.minimum.accumulate(group_end[:, ::-1], 1)[:, ::-1]
+        is_group_start = np.ones(sorted_score.shape, dtype=bool)
+        is_group_start[:, 1:] = is_threshold[:, :-1]
+        group_start = np.maximum.accumulate(np.where(is_group_start, position, 0), 1)
+
+        # Average precision: sum over thresholds of the recall increment times the precision at the threshold
+        tps = np.cumsum(sorted_label, 1)
+        threshold_precision = np.take_along_axis(tps / rank, group_end, 1)
+        avg_precisions = (sorted_label * threshold_precision).sum(1) / np.maximum(pos, 1)
+
+        # AUC: for each positive, the negatives with a lower score, tied negatives count one half,
+        # same as the area under the ROC curve
+        fps = rank - tps
+        fps_end = np.take_along_axis(fps, group_end, 1)
+        fps_before = np.take_along_axis(fps - (1.0 - sorted_label), group_start, 1)
+        aucs = (sorted_label * (neg[:, None] - 0.5 * (fps_end + fps_before))).sum(1) / np.maximum(pos * neg, 1)
+
+        for c in range(score.shape[0]):
+            k = start + c
+            avg_precision = avg_precisions[c]
+            if positives[k] > 0 and negatives[k] > 0:
+                precisions, recalls, fpr, tpr = _binary_curves(sorted_score[c], sorted_label[c])
+
+                save_every_steps = 1000     # Sample statistics to reduce size
+                dict = {'precisions': precisions[0::save_every_steps],
+                        'recalls': recalls[0::save_every_steps],
+                        'AP': avg_precision,
+                        'fpr': fpr[0::save_every_steps],
+                        'fnr': 1. - tpr[0::save_every_steps],
+                        'auc': aucs[c],
+                        # note acc is not class-wise, this is just to keep consistent with other metrics
+                        'acc': acc
+                        }
+            else:
+                dict = {'precisions': -1,
+                        'recalls': -1,
+                        'AP': avg_precision,
+                        'fpr': -1,
+                        'fnr': -1,
+                        'auc': -1,
+                        # note acc is not class-wise, this is just to keep consistent with other metrics
+                        'acc': acc
+                        }
+                print('class {:s} no true sample'.format(str(k)))
+            stats.append(dict)
+
+    return stats
+
+
+# reference implementation with a per-class sklearn loop, calculate_stats gives the same output
+def calculate_stats_sklearn(output, target):
     """Calculate statistics including mAP, AUC, etc.
 
     Args:
@@ -66,4 +179,118 @@ def calculate_stats(output, target):
             print('class {:s} no true sample'.format(str(k)))
         stats.append(dict)
 
-    return stats
\ No newline at end of file
+    return stats
+
+class StreamingStats(object):
+    """
+    Streaming approximation of calculate_stats with O(classes x bins) memory, for evaluation sets too large to keep all predictions.
+    Scores (logits by default) are clipped to score_range and counted in bins uniformly spaced in it, separately for
+    positive and negative samples of each class. AP and AUC are then exact for the scores quantized to the bins, i.e.,
+    all scores in a bin are treated as tied.
+
+    Error bound: only the order of samples within a bin is lost, so for each class the returned
+    'AP_error' and 'auc_error' bound the difference to the exact AP / AUC (the calculate_stats values):
+      auc_error = 0.5 * sum_b pos_b * neg_b / (P * N)
+      AP_error = sum_b pos_b / P * ((tp_b + pos_b) / (tp_b + fp_b + pos_b) - (tp_b + 1) / (tp_b + fp_b + neg_b + 1))
+    where pos_b / neg_b are the positives / negatives in bin b and tp_b / fp_b those in higher bins.
+    Both shrink as more bins are used or scores are spread more evenly over score_range.
+
+    Accumulators from different processes are combined with merge() or all_reduce().
+    """
+
+    def __init__(self, classes_num, bins=4096, score_range=(-15.0, 15.0), device=None):
+        self.classes_num = classes_num
+        self.bins = bins
+        self.score_range = score_range
+        self.pos_hist = torch.zeros(classes_num, bins, dtype=torch.long, device=device)
+        self.neg_hist = torch.zeros(classes_num, bins, dtype=torch.long, device=device)
+        # samples_num and the number of samples whose argmax prediction is the argmax target, for acc
+        self.counts = torch.zeros(2, dtype=torch.long, device=device)
+
+    def update(self, output, target):
+        output = output.detach().to(self.pos_hist.device).float()
+        target = target.to(self.pos_hist.device)
+        low, high = self.score_range
+        bin_idx = ((output.clamp(low, high) - low) / (high - low) * self.bins).long().clamp_(0, self.bins - 1)
+        # flattened index of (class, bin)
+        bin_idx = bin_idx + torch.arange(self.classes_num, device=bin_idx.device) * self.bins
+        positive = (target == 1).long()
+        self.pos_hist.view(-1).scatter_add_(0, bin_idx.view(-1), positive.view(-1))
+        self.neg_hist.view(-1).scatter_add_(0, bin_idx.view(-1), (1 - positive).view(-1))
+        self.counts[0] += output.shape[0]
+        self.counts[1] += (output.argmax(1) == target.argmax(1)).sum()
+
+    def merge(self, other):
+        self.pos_hist += other.pos_hist.to(self.pos_hist.device)
+        self.neg_hist += other.neg_hist.to(self.neg_hist.device)
+        self.counts += other.counts.to(self.counts.device)
+
+    def all_reduce(self, all_reduce):
+        # all_reduce: function that sums a tensor across processes, e.g., fabric.all_reduce with reduce_op='sum'
+        state = all_reduce(torch.cat([self.pos_hist.view(-1), self.neg_hist.view(-1), self.counts]))
+        size = self.pos_hist.numel()
+        self.pos_hist.view(-1).copy_(state[:size])
+        self.neg_hist.view(-1).copy_(state[size : 2 * size])
+        self.counts.copy_(state[2 * size :])
+
+    def compute(self, save_every_bins=100):
+        """Returns the list of per-class statistic dicts as calculate_stats, with the additional 'AP_error' and 'auc_error'."""
+        # from the highest bin to the lowest, each bin is a threshold
+        pos_hist = self.pos_hist.flip(1).double().cpu().numpy()
+        neg_hist = self.neg_hist.flip(1).double().cpu().numpy()
+        samples_num, correct = self.counts.tolist()
+        acc = correct / max(samples_num, 1)
+
+        tps = np.cumsum(pos_hist, 1)
+        fps = np.cumsum(neg_hist, 1)
+        tps_before = tps - pos_hist
+        fps_before = fps - neg_hist
+        positives = tps[:, -1]
+        negatives = fps[:, -1]
+
+        precision = tps / np.maximum(tps + fps, 1)
+        avg_precisions = (pos_hist * precision).sum(1) / np.maximum(positives, 1)
+        ap_errors = (
+            pos_hist
+            * (
+                (tps_before + pos_hist) / np.maximum(tps_before + fps_before + pos_hist, 1)
+                - (tps_before + 1) / (tps_before + fps_before + neg_hist + 1)
+            )
+        ).sum(1) / np.maximum(positives, 1)
+        aucs = (pos_hist * (negatives[:, None] - fps_before - 0.5 * neg_hist)).sum(1) / np.maximum(positives * negatives, 1)
+        auc_errors = 0.5 * (pos_hist * neg_hist).sum(1) / np.maximum(positives * negatives, 1)
+
+        stats = []
+        for k in range(self.classes_num):
+            if positives[k] > 0 and negatives[k] > 0:
+                # curves at the non-empty bins
+                nonempty = (pos_hist[k] + neg_hist[k]) > 0
+                k_tps, k_fps = tps[k][nonempty], fps[k][nonempty]
+                precisions = np.hstack(((k_tps / (k_tps + k_fps))[::-1], 1))
+                recalls = np.hstack(((k_tps / positives[k])[::-1], 0))
+                fpr = np.r_[0, k_fps] / negatives[k]
+                tpr = np.r_[0, k_tps] / positives[k]
+                dict = {'precisions': precisions[0::save_every_bins],
+                        'recalls': recalls[0::save_every_bins],
+                        'AP': avg_precisions[k],
+                        'fpr': fpr[0::save_every_bins],
+                        'fnr': 1. - tpr[0::save_every_bins],
+                        'auc': aucs[k],
+                        'acc': acc,
+                        'AP_error': ap_errors[k],
+                        'auc_error': auc_errors[k]
+                        }
+            else:
+                dict = {'precisions': -1,
+                        'recalls': -1,
+                        'AP': avg_precisions[k],
+                        'fpr': -1,
+                        'fnr': -1,
+                        'auc': -1,
+                        'acc': acc,
+                        'AP_error': ap_errors[k],
+                        'auc_error': -1
+                        }
+                print('class {:s} no true sample'.format(str(k)))
+            stats.append(dict)
+        return stats
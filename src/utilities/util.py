@@ -7,6 +7,37 @@ import random
 from collections import namedtuple
 
 
+def get_gt_ranks(query, gallery, chunk_size=1024, device=None):
+    """
+    Rank (0-based) of the ground truth gallery[i] for each query[i], i.e., the number of gallery items more similar to query[i].
+    Similarity is the dot product (cosine similarity for L2-normalized features), computed chunk_size queries at a time,
+    so the full similarity matrix is never materialized or sorted.
+    """
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    gallery = torch.as_tensor(gallery).to(device).float()
+    query = torch.as_tensor(query)
+    ranks = []
+    for start in range(0, query.shape[0], chunk_size):
+        q = query[start : start + chunk_size].to(device).float()
+        sim = q @ gallery.t()
+        # the ground truth score is taken from the same matmul, so it compares exactly with the other scores of the row
+        gt = sim[torch.arange(q.shape[0], device=device), torch.arange(start, start + q.shape[0], device=device)]
+        ranks.append((sim > gt[:, None]).sum(1).cpu())
+    return torch.cat(ranks)
+
+
+def compute_rank_metrics(ranks):
+    """R@1, R@5, R@10 and median rank (1-based) from the 0-based ranks of the ground truth."""
+    ranks = np.asarray(ranks)
+    metrics = {}
+    metrics["R1"] = float(np.sum(ranks == 0)) / len(ranks)
+    metrics["R5"] = float(np.sum(ranks < 5)) / len(ranks)
+    metrics["R10"] = float(np.sum(ranks < 10)) / len(ranks)
+    metrics["MR"] = np.median(ranks) + 1
+    return metrics
+
+
 def calc_recalls(S):
     """
     Computes recall at 1, 5, and 10 given a similarity matrix S.
@@ -16,58 +47,18 @@ def calc_recalls(S):
     assert S.size(0) == S.size(1)
     if isinstance(S, torch.autograd.Variable):
         S = S.data
-    n = S.size(0)
-    A2I_scores, A2I_ind = S.topk(10, 0)
-    I2A_scores, I2A_ind = S.topk(10, 1)
-    A_r1 = AverageMeter()
-    A_r5 = AverageMeter()
-    A_r10 = AverageMeter()
-    I_r1 = AverageMeter()
-    I_r5 = AverageMeter()
-    I_r10 = AverageMeter()
-    for i in range(n):
-        A_foundind = -1
-        I_foundind = -1
-        for ind in range(10):
-            if A2I_ind[ind, i] == i:
-                I_foundind = ind
-            if I2A_ind[i, ind] == i:
-                A_foundind = ind
-        # do r1s
-        if A_foundind == 0:
-            A_r1.update(1)
-        else:
-            A_r1.update(0)
-        if I_foundind == 0:
-            I_r1.update(1)
-        else:
-            I_r1.update(0)
-        # do r5s
-        if A_foundind >= 0 and A_foundind < 5:
-            A_r5.update(1)
-        else:
-            A_r5.update(0)
-        if I_foundind >= 0 and I_foundind < 5:
-            I_r5.update(1)
-        else:
-            I_r5.update(0)
-        # do r10s
-        if A_foundind >= 0 and A_foundind < 10:
-            A_r10.update(1)
-        else:
-            A_r10.update(0)
-        if I_foundind >= 0 and I_foundind < 10:
-            I_r10.update(1)
-        else:
-            I_r10.update(0)
+    # rank of the matched pair S[i, i] in its row (image -> audio) and its column (audio -> image)
+    diag = S.diag()
+    A_rank = (S > diag[:, None]).sum(1).cpu().numpy()
+    I_rank = (S > diag[None, :]).sum(0).cpu().numpy()
 
     recalls = {
-        "A_r1": A_r1.avg,
-        "A_r5": A_r5.avg,
-        "A_r10": A_r10.avg,
-        "I_r1": I_r1.avg,
-        "I_r5": I_r5.avg,
-        "I_r10": I_r10.avg,
+        "A_r1": float(np.mean(A_rank < 1)),
+        "A_r5": float(np.mean(A_rank < 5)),
+        "A_r10": float(np.mean(A_rank < 10)),
+        "I_r1": float(np.mean(I_rank < 1)),
+        "I_r5": float(np.mean(I_rank < 5)),
+        "I_r10": float(np.mean(I_rank < 10)),
     }
     #'A_meanR':A_meanR.avg, 'I_meanR':I_meanR.avg}
 
@@ -295,6 +286,109 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+class DeviceAverageMeter(object):
+    """
+    AverageMeter for tensors on the device. update() only adds to a running sum on the device and does not sync with the host,
+    val / avg / sum / count are updated by sync_device_meters (e.g., every n_print_steps).
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.val = 0
+        self.avg = 0
+        self.sum = 0
+        self.count = 0
+        self.device_val = None
+        self.device_sum = None
+        self.device_count = 0
+
+    # n is batch size
+    def update(self, val, n=1):
+        val = val.detach().float()
+        self.device_val = val
+        self.device_sum = val * n if self.device_sum is None else self.device_sum + val * n
+        self.device_count += n
+
+
+def sync_device_meters(meters, all_reduce=None, world_size=1):
+    """
+    Copy the running sums of DeviceAverageMeters to the host with a single transfer.
+    all_reduce: function that sums a tensor across processes (e.g., fabric.all_reduce with reduce_op='sum'),
+    then avg / sum / count are over all processes and val is the mean of the last value of each process.
+    """
+    meters = [meter for meter in meters if meter.device_sum is not None]
+    if len(meters) == 0:
+        return
+    stats = torch.stack(
+        [
+            torch.stack(
+                [meter.device_sum, meter.device_val, meter.device_sum.new_tensor(float(meter.device_count))]
+            )
+            for meter in meters
+        ]
+    )
+    if all_reduce is not None:
+        stats = all_reduce(stats)
+    stats = stats.tolist()
+    for meter, (total, val, count) in zip(meters, stats):
+        meter.sum = total
+        meter.val = val / world_size
+        meter.count = count
+        meter.avg = total / count
+
+
+class WeightAverager(object):
+    """
+    Keeps an average of the model weights in memory during training.
+    decay=None: equal-weight average of all updates (same as averaging the checkpoints the updates are taken at)
+    decay in (0, 1): exponential moving average, avg = decay * avg + (1 - decay) * weights
+    device: where the average is stored, e.g., 'cpu' to save GPU memory, None keeps the device of the model
+    """
+
+    def __init__(self, model, decay=None, device=None):
+        self.decay = decay
+        self.device = device
+        self.n_averaged = 0
+        self.avg = {
+            k: v.detach().clone().to(device) if device != None else v.detach().clone()
+            for k, v in model.state_dict().items()
+        }
+        # integer buffers (e.g., counters) are copied, not averaged
+        self.float_keys = [k for k, v in self.avg.items() if v.is_floating_point()]
+        self.other_keys = [k for k, v in self.avg.items() if not v.is_floating_point()]
+
+    @torch.no_grad()
+    def update(self, model):
+        sd = model.state_dict()
+        avg = [self.avg[k] for k in self.float_keys]
+        # blocking copy, a non_blocking gpu to cpu copy may not be finished when the cpu lerp reads it
+        cur = [sd[k].detach().to(self.avg[k].device) for k in self.float_keys]
+        if self.n_averaged == 0:
+            torch._foreach_copy_(avg, cur)
+        else:
+            weight = (1.0 - self.decay) if self.decay != None else 1.0 / (self.n_averaged + 1)
+            torch._foreach_lerp_(avg, cur, weight)
+        for k in self.other_keys:
+            self.avg[k].copy_(sd[k])
+        self.n_averaged += 1
+
+    def model_state_dict(self):
+        # the averaged weights, can be loaded with model.load_state_dict
+        return self.avg
+
+    def state_dict(self):
+        # the averaged weights and the number of updates, saved with the training checkpoint to resume the average
+        return {"avg": {k: v.cpu() for k, v in self.avg.items()}, "n_averaged": self.n_averaged}
+
+    @torch.no_grad()
+    def load_state_dict(self, state_dict):
+        for k, v in state_dict["avg"].items():
+            self.avg[k].copy_(v)
+        self.n_averaged = state_dict["n_averaged"]
+
+
 def adjust_learning_rate(base_lr, lr_decay, optimizer, epoch):
     """Sets the learning rate to the initial LR decayed by 10 every lr_decay epochs"""
     lr = base_lr * (0.1 ** (epoch // lr_decay))